@@ -1,16 +1,34 @@
-from fastapi import APIRouter, Depends
+from functools import partial
+from http import HTTPStatus
+from uuid import UUID
+
+from fastapi import APIRouter, Depends, Header, Request, UploadFile
 
 router = APIRouter(prefix="/llm", tags=["LLM"])
 
+from depends import llm_batch
 from depends.llm import LLMService
-from api.schemas.llm import RequestValidation, RequestValidationOllama
+from depends.llm_admission import admission, get_api_key
+from depends.llm_body import body_schema, json_body
+from depends.llm_transcripts import transcripts
+from api.schemas.llm import (RequestValidation, RequestValidationOllama, JobConstant, JobMessage,
+                             JobResponse, BatchRequest, BatchResponse, ConversationRequest, ConversationResponse)
+from core.settings import load_settings, RabbitMQSettings
+from database.models import Conversation, Job
+from database.session import get_db_session
+from exceptions.llm import NotFoundError
 from fastapi.responses import StreamingResponse
 from rabbitmq.producer import RabbitMQProducer
 from rabbitmq.producer_instance import get_producer
+from rabbitmq.queues import message_priority
+from rabbitmq.stream import JobStream, format_sse
+
+rabbitmq_settings: RabbitMQSettings = load_settings("RabbitMQSettings")
 
 
-@router.post("/anthropic")
-async def create_stream(body: RequestValidation) -> StreamingResponse:
+@router.post("/anthropic", openapi_extra=body_schema(RequestValidation))
+async def create_stream(request: Request, body: RequestValidation = Depends(json_body(RequestValidation)),
+                        api_key: str = Depends(get_api_key)) -> StreamingResponse:
     """
     Create stream message on LLM service.
 
@@ -20,11 +38,14 @@ async def create_stream(body: RequestValidation) -> StreamingResponse:
     Returns:
         StreamingResponse: LLM Message response.
     """
-    return await LLMService.create_stream_anthropic(body=body)
+    return await admission.stream(api_key, body.model,
+                                  lambda: LLMService.create_stream_anthropic(body=body, request=request))
 
 
-@router.post("/ollama")
-async def create_stream_ollama(body: RequestValidationOllama) -> StreamingResponse:
+@router.post("/ollama", openapi_extra=body_schema(RequestValidationOllama))
+async def create_stream_ollama(request: Request,
+                               body: RequestValidationOllama = Depends(json_body(RequestValidationOllama)),
+                               api_key: str = Depends(get_api_key)) -> StreamingResponse:
     """
     Create stream message on LLM service.
 
@@ -34,23 +55,249 @@ async def create_stream_ollama(body: RequestValidationOllama) -> StreamingRespon
     Returns:
         StreamingResponse: LLM Message response.
     """
-    return await LLMService.create_stream_ollama(body=body)   
+    return await admission.stream(api_key, body.model,
+                                  lambda: LLMService.create_stream_ollama(body=body, request=request))
 
-@router.post("/ollama/mq")
-async def create_stream_ollama(body: RequestValidationOllama, producer: RabbitMQProducer = Depends(get_producer)) -> StreamingResponse:
+@router.post("/ollama/mq", status_code=HTTPStatus.ACCEPTED, openapi_extra=body_schema(RequestValidationOllama))
+async def create_job_ollama(body: RequestValidationOllama = Depends(json_body(RequestValidationOllama)),
+                            producer: RabbitMQProducer = Depends(get_producer),
+                            api_key: str = Depends(get_api_key),
+                            x_request_timeout: float | None = Header(None, gt=0)) -> JobResponse:
     """
-    Create stream message on LLM service.
+    Queue a generation job for the Ollama workers. The job is queued with the
+    priority of its class, and dropped if no worker takes it before the request
+    timeout of the client, or RABBITMQ_JOB_TTL. A job that could not be published
+    is failed, and if refused by a full queue, the client asked to retry later.
 
     Args:
-        body (RequestValidation): LLM request validation.
+        body (RequestValidationOllama): LLM request validation.
+        x_request_timeout (float): Seconds the client waits for the job.
 
     Returns:
-        StreamingResponse: LLM Message response.
+        JobResponse: The queued job, to be polled on /llm/jobs/{job_id}.
     """
-    # return await LLMService.create_stream_ollama(body=body)   
+    if admission.enabled:
+        await admission.limit(api_key, body.model)
+    job = JobMessage(body=body)
+    payload = job.model_dump_json()
+    ttl = min(filter(None, (x_request_timeout, rabbitmq_settings.job_ttl)), default=None)
+
+    async with get_db_session() as session:
+        session.add(Job(id=job.job_id, request=payload))
 
     try:
-        await producer.publish("ollama", await LLMService.create_stream_ollama(body=body))
-        return "OK"
+        await producer.publish(rabbitmq_settings.ollama_queue, payload, ttl=ttl,
+                               priority=message_priority(body.priority),
+                               message_id=str(job.job_id), content_type="application/json")
     except Exception as e:
-        return str(e)
\ No newline at end of file
+        # The job is stored already, it would otherwise stay queued without a message.
+        async with get_db_session() as session:
+            await Job.set_status(job.job_id, JobConstant.Status.FAILED, session,
+                                 current=[JobConstant.Status.QUEUED], error=getattr(e, "message", None) or str(e))
+        raise
+    return JobResponse(job_id=job.job_id, status=JobConstant.Status.QUEUED)
+
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: UUID) -> JobResponse:
+    """
+    Get the status of a queued job, and its result once completed.
+
+    Args:
+        job_id (UUID): Job ID.
+
+    Returns:
+        JobResponse: The job.
+    """
+    async with get_db_session() as session:
+        job = await Job.get_by_id(job_id, session)
+    if job is None:
+        raise NotFoundError(f"Job {job_id} not found.")
+    return JobResponse(job_id=job.id, status=job.status, result=job.result, error=job.error)
+
+
+@router.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: UUID, producer: RabbitMQProducer = Depends(get_producer)) -> JobResponse:
+    """
+    Cancel a job. A queued job is skipped by the workers, a running one is
+    stopped and its generation aborted. A job already done is left as is.
+
+    Args:
+        job_id (UUID): Job ID.
+
+    Returns:
+        JobResponse: The job.
+    """
+    async with get_db_session() as session:
+        cancelled = await Job.set_status(job_id, JobConstant.Status.CANCELLED, session,
+                                         current=[JobConstant.Status.QUEUED, JobConstant.Status.RUNNING])
+        job = await Job.get_by_id(job_id, session)
+    if job is None:
+        raise NotFoundError(f"Job {job_id} not found.")
+    if cancelled:
+        await producer.broadcast(rabbitmq_settings.cancel_exchange, str(job_id), message_id=str(job_id))
+    return JobResponse(job_id=job.id, status=job.status, result=job.result, error=job.error)
+
+
+@router.get("/jobs/{job_id}/stream")
+async def stream_job(job_id: UUID, offset: int = 0, last_event_id: int | None = Header(None),
+                     producer: RabbitMQProducer = Depends(get_producer)) -> StreamingResponse:
+    """
+    Relay the chunks of a job as server-sent events while the worker generates them.
+
+    Every event carries the offset of the chunk as its ID. A client that lost the
+    connection resumes with the Last-Event-ID header, or with the offset query
+    parameter set to the next chunk.
+
+    Args:
+        job_id (UUID): Job ID.
+        offset (int): Offset of the first chunk to send.
+        last_event_id (int): ID of the last event received before a disconnect.
+
+    Returns:
+        StreamingResponse: Job events.
+    """
+    async with get_db_session() as session:
+        job = await Job.get_by_id(job_id, session)
+    if job is None:
+        raise NotFoundError(f"Job {job_id} not found.")
+    if last_event_id is not None:
+        offset = last_event_id + 1
+
+    if job.status in (JobConstant.Status.COMPLETED, JobConstant.Status.FAILED, JobConstant.Status.CANCELLED):
+        channel = await producer.open_channel()
+        if not await JobStream(channel, job_id).exists():
+            # The stream expired, the stored job is all there is left to send.
+            if job.status == JobConstant.Status.FAILED:
+                events = format_sse(0, JobConstant.Event.ERROR, job.error or "")
+            elif job.status == JobConstant.Status.CANCELLED:
+                events = format_sse(0, JobConstant.Event.CANCELLED, "")
+            else:
+                events = format_sse(0, JobConstant.Event.CHUNK, job.result or "") + \
+                         format_sse(1, JobConstant.Event.DONE, "")
+            return StreamingResponse(content=iter([events]), media_type="text/event-stream")
+        await channel.close()
+
+    async def events():
+        channel = await producer.open_channel()
+        try:
+            async for id, event, data in JobStream(channel, job_id).read(offset=offset):
+                yield format_sse(id, event, data)
+        finally:
+            await channel.close()
+
+    return StreamingResponse(content=events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@router.post("/batch", status_code=HTTPStatus.ACCEPTED)
+async def create_batch(body: BatchRequest, producer: RabbitMQProducer = Depends(get_producer),
+                       api_key: str = Depends(get_api_key)) -> BatchResponse:
+    """
+    Queue a batch of requests for the workers. Every request is sent to its
+    backend on its own, and its result is kept in the order of the batch. Every
+    request counts against the rate limit of the API key.
+
+    Args:
+        body (BatchRequest): Batch request validation.
+
+    Returns:
+        BatchResponse: The queued batch, to be polled on /llm/batch/{batch_id}.
+    """
+    return await llm_batch.submit(body.requests, producer, 
+                                  limit=partial(admission.limit, api_key) if admission.enabled else None)
+
+
+@router.post("/batch/upload", status_code=HTTPStatus.ACCEPTED)
+async def upload_batch(file: UploadFile, producer: RabbitMQProducer = Depends(get_producer),
+                       api_key: str = Depends(get_api_key)) -> BatchResponse:
+    """
+    Queue a batch of requests uploaded as a JSONL file, one BatchItemRequest per
+    line. The file is parsed as it is stored, it is never loaded whole.
+
+    Args:
+        file (UploadFile): JSONL file of requests.
+
+    Returns:
+        BatchResponse: The queued batch, to be polled on /llm/batch/{batch_id}.
+    """
+    return await llm_batch.submit(llm_batch.parse_jsonl(file.file), producer, 
+                                  limit=partial(admission.limit, api_key) if admission.enabled else None)
+
+
+@router.get("/batch/{batch_id}")
+async def get_batch(batch_id: UUID) -> BatchResponse:
+    """
+    Get the progress of a batch.
+
+    Args:
+        batch_id (UUID): Batch ID.
+
+    Returns:
+        BatchResponse: The batch and the number of items of every status.
+    """
+    return await llm_batch.progress(batch_id)
+
+
+@router.get("/batch/{batch_id}/results")
+async def get_batch_results(batch_id: UUID) -> StreamingResponse:
+    """
+    Download the results of a batch as JSONL, in the order of its requests.
+    While the batch runs, only the items done so far are sent.
+
+    Args:
+        batch_id (UUID): Batch ID.
+
+    Returns:
+        StreamingResponse: A BatchItemResult per line.
+    """
+    await llm_batch.progress(batch_id)
+    return StreamingResponse(content=llm_batch.results(batch_id), media_type="application/x-ndjson")
+
+
+@router.post("/batch/{batch_id}/resume")
+async def resume_batch(batch_id: UUID, producer: RabbitMQProducer = Depends(get_producer)) -> BatchResponse:
+    """
+    Queue again the items of a batch that failed or were lost, e.g. when a
+    worker stopped while running them. Completed items are kept.
+
+    Args:
+        batch_id (UUID): Batch ID.
+
+    Returns:
+        BatchResponse: The batch.
+    """
+    return await llm_batch.resume(batch_id, producer)
+
+
+@router.post("/conversations", status_code=HTTPStatus.CREATED)
+async def create_conversation(body: ConversationRequest) -> ConversationResponse:
+    """
+    Start a conversation. Requests sent with its ID only carry the new messages,
+    the previous turns are loaded and the reply is kept.
+
+    Args:
+        body (ConversationRequest): Conversation request.
+
+    Returns:
+        ConversationResponse: The new conversation.
+    """
+    conversation = Conversation(model=body.model)
+    async with get_db_session() as session:
+        session.add(conversation)
+    return ConversationResponse(conversation_id=conversation.id)
+
+
+@router.get("/conversations/{conversation_id}")
+async def get_conversation(conversation_id: UUID) -> ConversationResponse:
+    """
+    Get the messages of a conversation.
+
+    Args:
+        conversation_id (UUID): Conversation ID.
+
+    Returns:
+        ConversationResponse: The conversation and its messages, oldest first.
+    """
+    return ConversationResponse(conversation_id=conversation_id,
+                                messages=await transcripts.history(conversation_id))
@@ -1,8 +1,8 @@
 from pydantic import BaseModel, Field, model_validator
-from typing import Iterable, Annotated
+from typing import List, Annotated, Any
+from uuid import UUID, uuid4
 from enum import Enum
 from os import PathLike
-import json
 
 class StrEnum(str, Enum):
     pass
@@ -33,6 +33,7 @@ class AnthropicConstant:
         END_TURN = "end_turn"
         MAX_TOKENS = "max_tokens"
         STOP_SEQUENCE = "stop_sequence"
+        TOOL_USE = "tool_use"
 
     class Type(StrEnum):
         MESSAGE = "message"
@@ -47,11 +48,45 @@ class AnthropicConstant:
         LLAMA_3_0 = "llama3"
         LLAMA_2_UNCENSORED = "llama2-uncensored"
 
+class SchedulerConstant:
+    class Priority(StrEnum):
+        INTERACTIVE = "interactive"
+        NORMAL = "normal"
+        BATCH = "batch"
+
+class JobConstant:
+    class Status(StrEnum):
+        QUEUED = "queued"
+        RUNNING = "running"
+        COMPLETED = "completed"
+        FAILED = "failed"
+        CANCELLED = "cancelled"
+
+    class Event(StrEnum):
+        CHUNK = "chunk"
+        DONE = "done"
+        ERROR = "error"
+        CANCELLED = "cancelled"
+        HEARTBEAT = "heartbeat"
+
+class BatchConstant:
+    class Backend(StrEnum):
+        ANTHROPIC = "anthropic"
+        OLLAMA = "ollama"
+
+class StreamConstant:
+    class Format(StrEnum):
+        TEXT = "text"
+        SSE = "sse"
+        NDJSON = "ndjson"
+
 
 class ImageSource(BaseModel):
     media_type: AnthropicConstant.ImageBlock.MediaType
     type: AnthropicConstant.ImageBlock.DataFormat
-    data: Annotated[str | PathLike, dict(format=AnthropicConstant.ImageBlock.DataFormat.BASE64)]
+    # A base64 string is taken as it is, without being tried as a path first.
+    data: Annotated[str | PathLike, Field(union_mode="left_to_right"),
+                    dict(format=AnthropicConstant.ImageBlock.DataFormat.BASE64)]
 
 class TextBlock(BaseModel):
     text: str
@@ -62,7 +97,7 @@ class ImageBlock(BaseModel):
     type: AnthropicConstant.ImageBlock.Type
 
 class MessageRequestValidation(BaseModel):
-    content: str | Iterable[TextBlock | ImageBlock]
+    content: str | List[TextBlock | ImageBlock]
     role: AnthropicConstant.Role
 
 class MessageRequestOllama(BaseModel):
@@ -78,32 +113,112 @@ class RequestValidation(BaseModel):
                                       description='The sampling temperature.')
     model: AnthropicConstant.Model | None = Field(AnthropicConstant.Model.CLAUDE_3_OPUS_20240229,
                                                   title='Model', description='The model name.')
+    conversation_id: UUID | None = Field(None, title='Conversation ID',
+                                         description='The conversation the messages are appended to.')
+    stream_format: StreamConstant.Format | None = Field(None, title='Stream Format',
+                                                        description='The wire format of the response.')
 
-    @model_validator(mode="before")
-    @classmethod
-    def to_py_dict(cls, data):
-        if isinstance(data, dict):
-            # If data is already a dictionary, return it directly
-            return data
-        else:
-            # If data is not a dictionary, assume it's a JSON string
-            return json.loads(data)
-        
 class RequestValidationOllama(BaseModel):
-    messages: MessageRequestOllama
+    messages: MessageRequestOllama | list[MessageRequestValidation]
     system: str | None = Field("You are a personal AI assistant",
                                title='System', description='The system name.')
     temperature: float | None = Field(0.8, title='Temperature', gt=0.0, le=1.0,
                                       description='The sampling temperature.')
     model: AnthropicConstant.Model | None = Field(AnthropicConstant.Model.LLAMA_3_0,
                                                   title='Model', description='The model name.')
+    num_predict: int | None = Field(None, ge=1, title='Num Predict',
+                                    description='The maximum number of tokens to generate.')
+    keep_alive: str | float | None = Field(None, title='Keep Alive',
+                                           description='How long the model stays loaded after the request.')
+    options: dict[str, Any] | None = Field(None, title='Options',
+                                           description='Other Ollama model options.')
+    priority: SchedulerConstant.Priority = Field(SchedulerConstant.Priority.INTERACTIVE, title='Priority',
+                                                 description='The scheduling priority class.')
+    conversation_id: UUID | None = Field(None, title='Conversation ID',
+                                         description='The conversation the messages are appended to.')
+    stream_format: StreamConstant.Format | None = Field(None, title='Stream Format',
+                                                        description='The wire format of the response.')
+
+class JobMessage(BaseModel):
+    """
+    Message published on the job queue for a worker to process.
+    """
+    job_id: UUID = Field(default_factory=uuid4, title='Job ID', description='The job identifier.')
+    body: RequestValidationOllama
+
+class JobResponse(BaseModel):
+    job_id: UUID
+    status: JobConstant.Status
+    result: str | None = None
+    error: str | None = None
+
+class BatchItemRequest(BaseModel):
+    """
+    Request of a batch, validated as an Anthropic or an Ollama request
+    depending on its backend.
+    """
+    custom_id: str | None = Field(None, title='Custom ID', description='The ID the result is reported with.')
+    backend: BatchConstant.Backend = Field(title='Backend', description='The backend the request is sent to.')
+    body: RequestValidation | RequestValidationOllama
 
     @model_validator(mode="before")
     @classmethod
-    def to_py_dict(cls, data):
-        if isinstance(data, dict):
-            # If data is already a dictionary, return it directly
-            return data
-        else:
-            # If data is not a dictionary, assume it's a JSON string
-            return json.loads(data)
\ No newline at end of file
+    def validate_body(cls, data):
+        if isinstance(data, dict) and isinstance(data.get("body"), (dict, str)):
+            schema = RequestValidationOllama if data.get("backend") == BatchConstant.Backend.OLLAMA \
+                else RequestValidation
+            body = data["body"]
+            data = {**data, "body": schema.model_validate_json(body) if isinstance(body, str)
+                    else schema.model_validate(body)}
+        return data
+
+class BatchRequest(BaseModel):
+    requests: list[BatchItemRequest] = Field(min_length=1, title='Requests',
+                                             description='The requests, results keep their order.')
+
+class BatchItemMessage(BaseModel):
+    """
+    Message published on the batch queue for a worker to process an item.
+    """
+    batch_id: UUID
+    item_id: UUID
+
+class BatchResponse(BaseModel):
+    batch_id: UUID
+    status: JobConstant.Status
+    total: int
+    counts: dict[JobConstant.Status, int] = {}
+
+class StreamUsage(BaseModel):
+    """
+    Usage of a generation, sent in the last event of a stream. Counts are None
+    when the response did not come from the model, e.g. on a cache hit. The
+    prompt cache counts are the input tokens written to and read from the
+    prompt cache of Anthropic, not included in input_tokens.
+    """
+    model: str | None = None
+    stop_reason: AnthropicConstant.StopReason | None = None
+    input_tokens: int | None = None
+    output_tokens: int | None = None
+    cache_creation_input_tokens: int | None = None
+    cache_read_input_tokens: int | None = None
+    ttft: float | None = None
+    latency: float | None = None
+
+class BatchItemResult(BaseModel):
+    """
+    Result of a batch item, one line of the results of a batch.
+    """
+    position: int
+    custom_id: str | None = None
+    status: JobConstant.Status
+    result: str | None = None
+    error: str | None = None
+    usage: StreamUsage | None = None
+
+class ConversationRequest(BaseModel):
+    model: str | None = Field(None, title='Model', description='The model the conversation is started with.')
+
+class ConversationResponse(BaseModel):
+    conversation_id: UUID
+    messages: list[dict[str, Any]] = []
@@ -0,0 +1,50 @@
+"""
+API under benchmark.
+
+Serves main:app with the RabbitMQ producer replaced by the in-memory broker,
+and runs the queue worker in the same process. Run with:
+
+    python -m bench.app --port 8901
+"""
+
+import argparse
+import asyncio
+from contextlib import asynccontextmanager
+
+import uvicorn
+from fastapi import FastAPI
+
+import rabbitmq.worker as worker
+from bench.broker import InMemoryBroker, InMemoryProducer, consume
+from core.lifespan import lifespan
+from main import app
+from rabbitmq.producer_instance import get_producer
+
+broker = InMemoryBroker()
+producer = InMemoryProducer(broker)
+
+
+@asynccontextmanager
+async def bench_lifespan(app: FastAPI):
+    async with lifespan(app):
+        worker.stream_channel = broker.channel()
+        broker.subscribe(worker.settings.cancel_exchange, worker.cancel_job)
+        consumer = asyncio.create_task(consume(broker, worker.settings.ollama_queue, worker.run_job,
+                                               worker.settings.consumers * worker.settings.prefetch_count))
+        batch_consumer = asyncio.create_task(consume(broker, worker.settings.batch_queue, worker.run_batch_item,
+                                                     worker.batch_settings.anthropic_concurrency
+                                                     + worker.batch_settings.ollama_concurrency))
+        yield
+        consumer.cancel()
+        batch_consumer.cancel()
+
+
+app.dependency_overrides[get_producer] = lambda: producer
+app.router.lifespan_context = bench_lifespan
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--port", type=int, default=8901)
+    args = parser.parse_args()
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
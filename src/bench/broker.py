@@ -0,0 +1,181 @@
+"""
+In-memory stand-in for the RabbitMQ broker.
+
+Implements the part of the aio-pika API used by the producer, the worker and the
+job streams, so that the queue path can be benchmarked without a broker.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List
+
+from aio_pika import Message
+from aio_pika.exceptions import ChannelNotFoundEntity
+
+from rabbitmq.producer import RabbitMQProducer
+
+
+class InMemoryMessage:
+    def __init__(self, message: Message, offset: int | None = None):
+        self.body = message.body
+        self.headers = dict(message.headers or {})
+        self.message_id = message.message_id
+        self.redelivered = False
+        if offset is not None:
+            self.headers["x-stream-offset"] = offset
+
+    async def ack(self) -> None:
+        pass
+
+    @asynccontextmanager
+    async def process(self, **kwargs) -> AsyncIterator["InMemoryMessage"]:
+        yield self
+
+
+class InMemoryQueue:
+    def __init__(self, broker: "InMemoryBroker", name: str, stream: bool):
+        self.broker = broker
+        self.name = name
+        self.stream = stream
+        self.messages: List[Message] = []
+        self.ready: asyncio.Queue[Message] = asyncio.Queue()
+        self.changed = asyncio.Condition()
+
+    @property
+    def declaration_result(self) -> SimpleNamespace:
+        return SimpleNamespace(message_count=self.ready.qsize())
+
+    async def put(self, message: Message) -> None:
+        if not self.stream:
+            self.ready.put_nowait(message)
+            return
+        async with self.changed:
+            self.messages.append(message)
+            self.changed.notify_all()
+
+    def iterator(self, arguments: Dict[str, Any] | None = None, **kwargs) -> "InMemoryStreamIterator":
+        return InMemoryStreamIterator(self, (arguments or {}).get("x-stream-offset", 0))
+
+
+class InMemoryStreamIterator:
+    def __init__(self, queue: InMemoryQueue, offset: int):
+        self.queue = queue
+        self.offset = offset
+
+    async def __aenter__(self) -> "InMemoryStreamIterator":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        pass
+
+    def __aiter__(self) -> "InMemoryStreamIterator":
+        return self
+
+    async def __anext__(self) -> InMemoryMessage:
+        async with self.queue.changed:
+            await self.queue.changed.wait_for(lambda: self.offset < len(self.queue.messages))
+            message = InMemoryMessage(self.queue.messages[self.offset], offset=self.offset)
+        self.offset += 1
+        return message
+
+
+class InMemoryExchange:
+    def __init__(self, broker: "InMemoryBroker"):
+        self.broker = broker
+
+    async def publish(self, message: Message, routing_key: str) -> None:
+        await self.broker.queue(routing_key).put(message)
+
+
+class InMemoryChannel:
+    def __init__(self, broker: "InMemoryBroker"):
+        self.broker = broker
+        self.default_exchange = InMemoryExchange(broker)
+        self.is_closed = False
+
+    async def set_qos(self, **kwargs) -> None:
+        pass
+
+    async def declare_queue(self, name: str, passive: bool = False, arguments: Dict[str, Any] | None = None,
+                            **kwargs) -> InMemoryQueue:
+        if passive and name not in self.broker.queues:
+            self.is_closed = True
+            raise ChannelNotFoundEntity(f"no queue '{name}'")
+        return self.broker.queue(name, stream=(arguments or {}).get("x-queue-type") == "stream")
+
+    async def queue_delete(self, name: str) -> None:
+        self.broker.queues.pop(name, None)
+
+    async def close(self) -> None:
+        self.is_closed = True
+
+
+class InMemoryBroker:
+    def __init__(self):
+        self.queues: Dict[str, InMemoryQueue] = {}
+        self.subscribers: Dict[str, List[Callable[[InMemoryMessage], Awaitable[None]]]] = {}
+
+    def subscribe(self, exchange_name: str, handler: Callable[[InMemoryMessage], Awaitable[None]]) -> None:
+        self.subscribers.setdefault(exchange_name, []).append(handler)
+
+    def queue(self, name: str, stream: bool = False) -> InMemoryQueue:
+        if name not in self.queues:
+            self.queues[name] = InMemoryQueue(self, name, stream)
+        return self.queues[name]
+
+    def channel(self) -> InMemoryChannel:
+        return InMemoryChannel(self)
+
+
+class InMemoryProducer:
+    """
+    Stand-in for RabbitMQProducer.
+    """
+
+    def __init__(self, broker: InMemoryBroker):
+        self.broker = broker
+
+    async def publish(self, queue_name: str, message_content: str | bytes, **properties) -> None:
+        await self.broker.queue(queue_name).put(RabbitMQProducer.build_message(message_content, **properties))
+
+    async def publish_batch(self, queue_name: str, messages: Iterable[Message]) -> None:
+        for message in messages:
+            await self.broker.queue(queue_name).put(message)
+
+    async def broadcast(self, exchange_name: str, message_content: str | bytes, **properties) -> None:
+        message = InMemoryMessage(RabbitMQProducer.build_message(message_content, **properties))
+        for handler in self.broker.subscribers.get(exchange_name, []):
+            await handler(message)
+
+    async def open_channel(self) -> InMemoryChannel:
+        return self.broker.channel()
+
+    async def close(self) -> None:
+        pass
+
+
+async def consume(broker: InMemoryBroker, queue_name: str, handler, concurrency: int) -> None:
+    """
+    Stand-in for RabbitMQClient.consume: run the handler on the messages of a
+    queue, at most concurrency at a time.
+
+    Args:
+        broker (InMemoryBroker): The broker.
+        queue_name (str): Queue name.
+        handler (Callable): Coroutine called with every message.
+        concurrency (int): Maximum number of messages handled at once.
+    """
+    queue = broker.queue(queue_name)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def handle(message: Message) -> None:
+        try:
+            await handler(InMemoryMessage(message))
+        finally:
+            semaphore.release()
+
+    while True:
+        message = await queue.ready.get()
+        await semaphore.acquire()
+        asyncio.create_task(handle(message))
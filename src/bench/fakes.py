@@ -0,0 +1,146 @@
+"""
+Fake Anthropic and Ollama servers for the benchmarks.
+
+Both APIs are served by one app, with a configurable time to first token, token
+rate and response length. The Anthropic server caches the prompt prefixes marked
+with cache_control under the prompt caching beta, and its time to first token
+shrinks with the share of the prompt read from the cache. Run with:
+
+    python -m bench.fakes --port 8900 --ttft 0.2 --rate 50 --tokens 64
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import time
+from typing import Any, AsyncGenerator, Dict, List
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+
+def create_app(ttft: float, rate: float, tokens: int) -> FastAPI:
+    """
+    Create the fake servers app.
+
+    Args:
+        ttft (float): Seconds before the first token.
+        rate (float): Tokens per second after the first one.
+        tokens (int): Tokens per response.
+
+    Returns:
+        FastAPI: The app.
+    """
+    app = FastAPI()
+    # Digests of the cached prompt prefixes.
+    cached: set[str] = set()
+
+    async def generate(delay: float = ttft) -> AsyncGenerator[str, None]:
+        await asyncio.sleep(delay)
+        for index in range(tokens):
+            if index:
+                await asyncio.sleep(1 / rate)
+            yield f"tok{index} "
+
+    def sse(event: str, data: dict) -> str:
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    def prompt_cache(body: Dict[str, Any]) -> Dict[str, int]:
+        """
+        Read the longest cached prefix of a prompt, and cache its prefixes ending
+        at a breakpoint. Tokens are counted as four characters.
+
+        Returns:
+            dict: The input, cache creation and cache read tokens.
+        """
+        system = body.get("system")
+        blocks: List[tuple[str, Any]] = [("system", block) for block in system] if isinstance(system, list) else []
+        for message in body["messages"]:
+            content = message["content"]
+            blocks += [(message["role"], block) for block in
+                       ([{"type": "text", "text": content}] if isinstance(content, str) else content)]
+        prefixes = []
+        for index, (_, block) in enumerate(blocks):
+            prefix = json.dumps([(role, {key: value for key, value in block.items() if key != "cache_control"})
+                                 for role, block in blocks[:index + 1]])
+            prefixes.append((hashlib.sha256(prefix.encode()).hexdigest(), len(prefix) // 4,
+                             "cache_control" in block))
+        total = prefixes[-1][1] if prefixes else 16
+        read = max((tokens for digest, tokens, _ in prefixes if digest in cached), default=0)
+        written = max((tokens for _, tokens, breakpoint in prefixes if breakpoint), default=0)
+        cached.update(digest for digest, _, breakpoint in prefixes if breakpoint)
+        created = max(written - read, 0)
+        return {"input_tokens": total - read - created, "cache_creation_input_tokens": created,
+                "cache_read_input_tokens": read}
+
+    @app.post("/v1/messages")
+    async def anthropic_messages(request: Request) -> StreamingResponse:
+        body = await request.json()
+        usage = {"input_tokens": 16}
+        delay = ttft
+        if "prompt-caching" in request.headers.get("anthropic-beta", ""):
+            usage = prompt_cache(body)
+            total = sum(usage.values())
+            delay = ttft * max(0.1, 1 - usage["cache_read_input_tokens"] / max(total, 1))
+
+        async def events():
+            yield sse("message_start", {"type": "message_start", "message": {
+                "id": "msg_bench", "type": "message", "role": "assistant", "content": [],
+                "model": body["model"], "stop_reason": None, "stop_sequence": None,
+                "usage": {**usage, "output_tokens": 1}}})
+            yield sse("content_block_start", {"type": "content_block_start", "index": 0,
+                                              "content_block": {"type": "text", "text": ""}})
+            async for token in generate(delay):
+                yield sse("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                                  "delta": {"type": "text_delta", "text": token}})
+            yield sse("content_block_stop", {"type": "content_block_stop", "index": 0})
+            yield sse("message_delta", {"type": "message_delta",
+                                        "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                        "usage": {"output_tokens": tokens}})
+            yield sse("message_stop", {"type": "message_stop"})
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.post("/api/chat")
+    async def ollama_chat(request: Request) -> Response:
+        body = await request.json()
+        if not body["messages"]:
+            # A preload: the model is loaded, nothing generated.
+            return JSONResponse({"model": body["model"], "created_at": time.time(),
+                                 "message": {"role": "assistant", "content": ""}, "done": True,
+                                 "done_reason": "load"})
+
+        async def lines():
+            async for token in generate():
+                yield json.dumps({"model": body["model"], "created_at": time.time(),
+                                  "message": {"role": "assistant", "content": token}, "done": False}) + "\n"
+            yield json.dumps({"model": body["model"], "created_at": time.time(),
+                              "message": {"role": "assistant", "content": ""}, "done": True,
+                              "done_reason": "stop", "eval_count": tokens, "prompt_eval_count": 16}) + "\n"
+
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    @app.get("/api/ps")
+    @app.get("/api/tags")
+    async def ollama_models() -> dict:
+        return {"models": [{"name": "llama3:latest"}, {"name": "llama2-uncensored:latest"}]}
+
+    @app.post("/api/embeddings")
+    async def ollama_embeddings(request: Request) -> dict:
+        body = await request.json()
+        return {"embedding": [float(len(body["prompt"])), 1.0]}
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--ttft", type=float, default=0.2)
+    parser.add_argument("--rate", type=float, default=50)
+    parser.add_argument("--tokens", type=int, default=64)
+    args = parser.parse_args()
+    uvicorn.run(create_app(args.ttft, args.rate, args.tokens), host="127.0.0.1", port=args.port,
+                log_level="warning")
@@ -0,0 +1,258 @@
+"""
+Load test of the LLM endpoints against fake backends.
+
+Starts the fake Anthropic and Ollama servers and the API with an in-memory
+broker, drives the endpoints at a set concurrency and writes throughput, time to
+first token and total latency percentiles, and memory per open stream as JSON.
+With a baseline, exits with an error when a scenario regressed. Run with:
+
+    python -m bench.run --scenario anthropic ollama ollama_mq --concurrency 32 \\
+        --requests 256 --output bench-results.json --baseline previous.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, List
+
+import httpx
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+SCENARIOS = ("anthropic", "ollama", "ollama_mq")
+
+
+@dataclass
+class Sample:
+    ttft: float | None = None
+    latency: float | None = None
+    error: str | None = None
+
+
+@dataclass
+class Result:
+    scenario: str
+    concurrency: int
+    requests: int
+    errors: int
+    duration: float
+    throughput: float
+    ttft: Dict[str, float] = field(default_factory=dict)
+    latency: Dict[str, float] = field(default_factory=dict)
+    memory_per_stream: float | None = None
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99), "mean": float(np.mean(values))}
+
+
+def rss(pid: int) -> int:
+    """
+    Get the resident memory of a process, in bytes.
+    """
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+async def stream_text(client: httpx.AsyncClient, path: str, body: dict) -> Sample:
+    start = time.perf_counter()
+    sample = Sample()
+    async with client.stream("POST", path, json=body) as response:
+        if response.status_code != 200:
+            return Sample(error=f"HTTP {response.status_code}")
+        async for chunk in response.aiter_raw():
+            if chunk and sample.ttft is None:
+                sample.ttft = time.perf_counter() - start
+    sample.latency = time.perf_counter() - start
+    return sample
+
+
+async def stream_job(client: httpx.AsyncClient, body: dict) -> Sample:
+    start = time.perf_counter()
+    sample = Sample()
+    response = await client.post("/llm/ollama/mq", json=body)
+    if response.status_code != 202:
+        return Sample(error=f"HTTP {response.status_code}")
+    async with client.stream("GET", f"/llm/jobs/{response.json()['job_id']}/stream") as events:
+        async for line in events.aiter_lines():
+            if line == "event: chunk" and sample.ttft is None:
+                sample.ttft = time.perf_counter() - start
+            elif line == "event: error":
+                sample.error = "job failed"
+    sample.latency = time.perf_counter() - start
+    return sample
+
+
+async def request(client: httpx.AsyncClient, scenario: str, index: int) -> Sample:
+    prompt = f"Benchmark prompt {index} {time.time_ns()}"
+    try:
+        if scenario == "anthropic":
+            return await stream_text(client, "/llm/anthropic", {"messages": [{"role": "user", "content": prompt}]})
+        if scenario == "ollama":
+            return await stream_text(client, "/llm/ollama", {"messages": {"input": prompt}})
+        return await stream_job(client, {"messages": {"input": prompt}})
+    except httpx.HTTPError as e:
+        return Sample(error=repr(e))
+
+
+async def run_scenario(base_url: str, pid: int, scenario: str, concurrency: int, requests: int) -> Result:
+    """
+    Drive a scenario and measure it.
+
+    Args:
+        base_url (str): URL of the API.
+        pid (int): Process ID of the API, to sample its memory.
+        scenario (str): Scenario name.
+        concurrency (int): Requests in flight at once.
+        requests (int): Total number of requests.
+
+    Returns:
+        Result: The measures.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency * 2, max_keepalive_connections=concurrency * 2)
+    async with httpx.AsyncClient(base_url=base_url, timeout=300, limits=limits) as client:
+        await asyncio.gather(*(request(client, scenario, -index) for index in range(1, min(concurrency, 8) + 1)))
+        idle = peak = rss(pid)
+
+        async def bounded(index: int) -> Sample:
+            async with semaphore:
+                return await request(client, scenario, index)
+
+        async def sample_memory() -> None:
+            nonlocal peak
+            while True:
+                peak = max(peak, rss(pid))
+                await asyncio.sleep(0.05)
+
+        sampler = asyncio.create_task(sample_memory())
+        start = time.perf_counter()
+        samples = await asyncio.gather(*(bounded(index) for index in range(requests)))
+        duration = time.perf_counter() - start
+        sampler.cancel()
+
+    succeeded = [sample for sample in samples if sample.error is None]
+    return Result(
+        scenario=scenario, concurrency=concurrency, requests=requests,
+        errors=requests - len(succeeded), duration=duration,
+        throughput=len(succeeded) / duration,
+        ttft=percentiles([sample.ttft for sample in succeeded if sample.ttft is not None]),
+        latency=percentiles([sample.latency for sample in succeeded]),
+        memory_per_stream=(peak - idle) / concurrency,
+    )
+
+
+def regressions(results: List[dict], baseline: List[dict], tolerance: float) -> List[str]:
+    """
+    Compare results with a baseline.
+
+    Args:
+        results (list): Results of this run.
+        baseline (list): Results of the baseline run.
+        tolerance (float): Allowed relative degradation, e.g. 0.1 for 10%.
+
+    Returns:
+        list: Description of every regression.
+    """
+    found = []
+    previous = {result["scenario"]: result for result in baseline}
+    for result in results:
+        before = previous.get(result["scenario"])
+        if before is None:
+            continue
+        if result["throughput"] < before["throughput"] * (1 - tolerance):
+            found.append(f"{result['scenario']}: throughput {before['throughput']:.1f} -> {result['throughput']:.1f}")
+        for metric in ("ttft", "latency"):
+            now, then = result[metric].get("p95"), before[metric].get("p95")
+            if now is not None and then is not None and now > then * (1 + tolerance):
+                found.append(f"{result['scenario']}: {metric} p95 {then:.3f}s -> {now:.3f}s")
+    return found
+
+
+def wait_ready(url: str, process: subprocess.Popen, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{process.args} exited with {process.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} not ready after {timeout}s")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scenario", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=256)
+    parser.add_argument("--ttft", type=float, default=0.2, help="Fake backend time to first token.")
+    parser.add_argument("--rate", type=float, default=50, help="Fake backend tokens per second.")
+    parser.add_argument("--tokens", type=int, default=64, help="Fake backend tokens per response.")
+    parser.add_argument("--fake-port", type=int, default=8900)
+    parser.add_argument("--app-port", type=int, default=8901)
+    parser.add_argument("--output", default="bench-results.json")
+    parser.add_argument("--baseline", help="Results of a previous run to compare with.")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    fake_url = f"http://127.0.0.1:{args.fake_port}"
+    app_url = f"http://127.0.0.1:{args.app_port}"
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    env = {
+        **os.environ,
+        "ANTHROPIC_API_KEY": "bench",
+        "ANTHROPIC_BASE_URL": fake_url,
+        "OLLAMA_BASE_URL": fake_url,
+        "DB_URL": f"sqlite+aiosqlite:///{workdir}/bench.db",
+        # The bench drives a single client far over the per-key rate limit, and
+        # measures the app rather than its admission control.
+        "ADMISSION_ENABLED": "false",
+    }
+    processes = [
+        subprocess.Popen([sys.executable, "-m", "bench.fakes", "--port", str(args.fake_port),
+                          "--ttft", str(args.ttft), "--rate", str(args.rate), "--tokens", str(args.tokens)],
+                         cwd=ROOT, env=env),
+        subprocess.Popen([sys.executable, "-m", "bench.app", "--port", str(args.app_port)], cwd=ROOT, env=env),
+    ]
+    try:
+        wait_ready(f"{fake_url}/api/tags", processes[0])
+        wait_ready(f"{app_url}/", processes[1])
+        results = []
+        for scenario in args.scenario:
+            result = asyncio.run(run_scenario(app_url, processes[1].pid, scenario, args.concurrency, args.requests))
+            print(json.dumps(asdict(result)))
+            results.append(asdict(result))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    report = {"timestamp": time.time(), "fake": {"ttft": args.ttft, "rate": args.rate, "tokens": args.tokens},
+              "results": results}
+    Path(args.output).write_text(json.dumps(report, indent=2))
+
+    if args.baseline:
+        found = regressions(results, json.loads(Path(args.baseline).read_text())["results"], args.tolerance)
+        for regression in found:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""
+Cold start measurement of the API.
+
+Measures, over several fresh processes, the time to import main:app and the time
+from spawning uvicorn to the first successful response, with the backends given
+configured. Fails when the median of a measure is over its target. Run with:
+
+    python -m bench.startup --backends ollama --runs 5 --output startup-results.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import httpx
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+BACKENDS = ("anthropic", "ollama")
+# Modules that only a configured backend, or an optional feature, should import.
+LAZY_MODULES = ("anthropic", "ollama", "httpx", "numpy", "tokenizers", "aiosqlite", "asyncpg")
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import main
+print(json.dumps({"seconds": time.perf_counter() - start, "modules": len(sys.modules),
+                  "lazy": [name for name in %r if name in sys.modules]}))
+""" % (LAZY_MODULES,)
+
+
+def summary(values: List[float]) -> Dict[str, float]:
+    return {"p50": float(np.median(values)), "max": float(np.max(values)), "min": float(np.min(values))}
+
+
+def measure_import(env: Dict[str, str]) -> dict:
+    """
+    Import main:app in a fresh interpreter.
+
+    Returns:
+        dict: The import time, the number of modules loaded and the lazy modules that were.
+    """
+    output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def measure_ready(env: Dict[str, str], port: int, timeout: float = 60) -> float:
+    """
+    Spawn the API and wait for its first successful response. The lifespan, i.e.
+    the database setup and the clients of the configured backends, is included.
+
+    Returns:
+        float: Seconds from spawn to the first response.
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port),
+                                "--log-level", "warning"], cwd=ROOT, env=env)
+    try:
+        with httpx.Client(timeout=1) as client:
+            while time.perf_counter() - start < timeout:
+                if process.poll() is not None:
+                    raise RuntimeError(f"{process.args} exited with {process.returncode}")
+                try:
+                    if client.get(f"http://127.0.0.1:{port}/").status_code == 200:
+                        return time.perf_counter() - start
+                except httpx.HTTPError:
+                    pass
+                time.sleep(0.01)
+        raise RuntimeError(f"API not ready after {timeout}s")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--backends", nargs="*", choices=BACKENDS, default=list(BACKENDS),
+                        help="Backends configured, the others are disabled.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8902)
+    parser.add_argument("--import-target", type=float, default=1.5, help="Median import time target, in seconds.")
+    parser.add_argument("--ready-target", type=float, default=2.5, help="Median time to ready target, in seconds.")
+    parser.add_argument("--output", default="startup-results.json")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    env = {**os.environ, "DB_URL": f"sqlite+aiosqlite:///{workdir}/bench.db",
+           "OLLAMA_ENABLED": str("ollama" in args.backends), "OLLAMA_BASE_URL": "http://127.0.0.1:9"}
+    env.pop("ANTHROPIC_API_KEY", None)
+    if "anthropic" in args.backends:
+        env["ANTHROPIC_API_KEY"] = "bench"
+
+    # A first import writes the bytecode caches, as a deployed image would have them.
+    measure_import(env)
+    imports = [measure_import(env) for _ in range(args.runs)]
+    ready = [measure_ready(env, args.port) for _ in range(args.runs)]
+    result = {
+        "backends": args.backends,
+        "import": summary([run["seconds"] for run in imports]),
+        "ready": summary(ready),
+        "modules": imports[-1]["modules"],
+        "lazy_modules_imported": imports[-1]["lazy"],
+    }
+    print(json.dumps(result, indent=2))
+    Path(args.output).write_text(json.dumps(result, indent=2))
+
+    failed = []
+    if result["import"]["p50"] > args.import_target:
+        failed.append(f"import p50 {result['import']['p50']:.3f}s over {args.import_target}s")
+    if result["ready"]["p50"] > args.ready_target:
+        failed.append(f"ready p50 {result['ready']['p50']:.3f}s over {args.ready_target}s")
+    for line in failed:
+        print(f"TARGET MISSED {line}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
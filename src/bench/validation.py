@@ -0,0 +1,115 @@
+"""
+Microbenchmarks of the request validation and serialization path.
+
+Times, on a long multi-turn body and on an image-heavy body, every step a body
+goes through before it is sent upstream, the way FastAPI and the SDKs do it by
+default against the way the API does it: parsing and validation, the hashes of
+the context and the cache, and the serialization of the upstream request. Fails
+when a step of the API is slower than the default. Run with:
+
+    python -m bench.validation --turns 200 --images 4 --image-kb 1024 --output validation-results.json
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import sys
+import timeit
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+import orjson
+
+from api.schemas.llm import RequestValidation
+from depends.llm_cache import cache_key
+from depends.llm_context import message_hash
+
+
+def multi_turn_body(turns: int, words: int = 200) -> bytes:
+    messages = [{"role": "user" if turn % 2 == 0 else "assistant",
+                 "content": [{"type": "text", "text": " ".join(["word"] * words)}]}
+                for turn in range(turns - 1 if turns % 2 == 0 else turns)]
+    return json.dumps({"messages": messages, "model": "claude-3-haiku-20240307", "max_tokens": 256}).encode()
+
+
+def image_body(images: int, image_kb: int) -> bytes:
+    content: List[Dict[str, Any]] = [{"type": "text", "text": "Describe the images."}]
+    for _ in range(images):
+        data = base64.b64encode(os.urandom(image_kb * 768)).decode()
+        content.append({"type": "image", "source": {"type": "base64", "media_type": "image/jpeg", "data": data}})
+    return json.dumps({"messages": [{"role": "user", "content": content}]}).encode()
+
+
+def default_hash(messages: List[Dict[str, Any]]) -> List[str]:
+    return [hashlib.sha256(json.dumps(message, sort_keys=True, separators=(",", ":"),
+                                      ensure_ascii=False).encode()).hexdigest() for message in messages]
+
+
+def default_cache_key(model: str, messages: List[Dict[str, Any]]) -> str:
+    payload = json.dumps([model, "", messages, 0.8, 256, {}], sort_keys=True, separators=(",", ":"),
+                         ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def steps(raw: bytes) -> Dict[str, tuple[Callable[[], Any], Callable[[], Any]]]:
+    """
+    Get the steps of a body, as the default and the API implementations.
+    """
+    body = RequestValidation.model_validate_json(raw)
+    messages = [message.model_dump(mode="json", exclude_none=True) for message in body.messages]
+    upstream = {"model": body.model.value, "max_tokens": body.max_tokens, "system": body.system,
+                "messages": messages, "temperature": body.temperature, "stream": True}
+    return {
+        "validate": (lambda: RequestValidation.model_validate(json.loads(raw)),
+                     lambda: RequestValidation.model_validate_json(raw)),
+        "context_hash": (lambda: default_hash(messages),
+                         lambda: [message_hash(message) for message in messages]),
+        "cache_key": (lambda: default_cache_key(body.model.value, messages),
+                      lambda: cache_key(body.model.value, None, messages, 0.8, 256)),
+        "serialize": (lambda: json.dumps(upstream).encode(),
+                      lambda: orjson.dumps(upstream)),
+    }
+
+
+def measure(function: Callable[[], Any], runs: int, number: int) -> float:
+    """
+    Returns:
+        float: Median milliseconds per call.
+    """
+    return float(np.median(timeit.repeat(function, number=number, repeat=runs))) / number * 1000
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--turns", type=int, default=200, help="Messages of the multi-turn body.")
+    parser.add_argument("--images", type=int, default=4, help="Images of the image-heavy body.")
+    parser.add_argument("--image-kb", type=int, default=1024, help="Size of every image, base64 encoded.")
+    parser.add_argument("--runs", type=int, default=7)
+    parser.add_argument("--number", type=int, default=10, help="Calls per run.")
+    parser.add_argument("--output", default="validation-results.json")
+    args = parser.parse_args()
+
+    bodies = {"multi_turn": multi_turn_body(args.turns), "images": image_body(args.images, args.image_kb)}
+    result: Dict[str, Any] = {}
+    failed = []
+    for name, raw in bodies.items():
+        result[name] = {"bytes": len(raw)}
+        for step, (default, api) in steps(raw).items():
+            default_ms, api_ms = measure(default, args.runs, args.number), measure(api, args.runs, args.number)
+            result[name][step] = {"default_ms": round(default_ms, 3), "api_ms": round(api_ms, 3),
+                                  "speedup": round(default_ms / api_ms, 2)}
+            if api_ms > default_ms:
+                failed.append(f"{name} {step} {api_ms:.3f}ms over the default {default_ms:.3f}ms")
+    print(json.dumps(result, indent=2))
+    Path(args.output).write_text(json.dumps(result, indent=2))
+
+    for line in failed:
+        print(f"REGRESSION {line}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,9 +2,24 @@ from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from typing import AsyncGenerator
 
+from database.session import dispose_engine, init_db, warm_pool
+from depends.llm_client import start_clients, stop_clients
+from depends.llm_images import image_processor
+from depends.llm_scheduler import ollama_scheduler
+from depends.llm_transcripts import transcripts
+from rabbitmq.producer_instance import producer_instance
+
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncGenerator:
-    await app.startup()
-    await app.init()
+    await init_db()
+    await warm_pool()
+    start_clients()
+    ollama_scheduler.start()
+    transcripts.start()
     yield
-    await app.shutdown()
\ No newline at end of file
+    await ollama_scheduler.stop()
+    await transcripts.stop()
+    await stop_clients()
+    image_processor.shutdown()
+    await producer_instance.close()
+    await dispose_engine()
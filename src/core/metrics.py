@@ -0,0 +1,167 @@
+"""
+Prometheus metrics.
+
+Generation metrics are labeled by backend and model. The labeled children are
+looked up once per stream, so a chunk only costs a clock read and two histogram
+observations.
+"""
+
+import os
+import time
+from contextlib import aclosing
+from typing import TYPE_CHECKING, AsyncGenerator, AsyncIterator, Callable, Dict, List
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.registry import Collector
+
+if TYPE_CHECKING:
+    from api.schemas.llm import StreamUsage
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKEN_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+RATE_BUCKETS = (1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 400)
+
+# Set by the server when it runs several API processes, see server.py.
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+TIME_TO_FIRST_TOKEN = Histogram("llm_time_to_first_token_seconds", "Time to the first chunk of a generation.",
+                                ["backend", "model"], buckets=LATENCY_BUCKETS)
+INTER_TOKEN_LATENCY = Histogram("llm_inter_token_latency_seconds", "Time between two chunks of a generation.",
+                                ["backend", "model"], buckets=TOKEN_BUCKETS)
+GENERATION_TIME = Histogram("llm_generation_seconds", "Total time of a generation.",
+                            ["backend", "model"], buckets=LATENCY_BUCKETS)
+TOKENS_PER_SECOND = Histogram("llm_tokens_per_second", "Tokens generated per second after the first chunk.",
+                              ["backend", "model"], buckets=RATE_BUCKETS)
+TOKENS = Counter("llm_tokens", "Tokens generated, counted as chunks when the backend reported no usage.",
+                 ["backend", "model"])
+GENERATION_ERRORS = Counter("llm_generation_errors", "Generations that failed.", ["backend", "model"])
+PROMPT_CACHE_TOKENS = Counter("llm_prompt_cache_tokens", "Input tokens written to or read from the prompt cache.",
+                              ["backend", "model", "operation"])
+
+QUEUE_DEPTH = Gauge("rabbitmq_queue_depth", "Messages ready in a queue.", ["queue"])
+PUBLISH_LATENCY = Histogram("rabbitmq_publish_seconds", "Time to publish a message, confirmation included.",
+                            ["queue"], buckets=LATENCY_BUCKETS)
+CONSUMER_LAG = Histogram("rabbitmq_consumer_lag_seconds", "Time between the publish and the consume of a message.",
+                         ["queue"], buckets=LATENCY_BUCKETS)
+QUEUE_SHED = Counter("rabbitmq_shed", "Messages refused by a full queue.", ["queue"])
+QUEUE_RETRIES = Counter("rabbitmq_retries", "Messages queued again after their handler failed.", ["queue"])
+QUEUE_EXPIRED = Counter("rabbitmq_expired", "Messages skipped by a worker as past their deadline.", ["queue"])
+DEAD_LETTERS = Counter("rabbitmq_dead_letters", "Messages dead-lettered, by the queue they left and why.",
+                       ["queue", "reason"])
+
+
+async def instrument(stream: AsyncIterator[str], backend: str, model: str,
+                     usage: "StreamUsage | None" = None) -> AsyncGenerator[str, None]:
+    """
+    Record the latency metrics of a generation while streaming it. A chunk may
+    carry several tokens, so the tokens are those of the usage the backend
+    reports at the end of the stream, and the chunks only when it reported none,
+    e.g. on a stream cut short.
+
+    Args:
+        stream (AsyncIterator): Generation stream.
+        backend (str): Backend name, e.g. anthropic or ollama.
+        model (str): Model name.
+        usage (StreamUsage): Filled by the stream once it ends.
+
+    Yields:
+        str: The chunks of the stream.
+    """
+    labels = (backend, getattr(model, "value", model))
+    inter_token = INTER_TOKEN_LATENCY.labels(*labels)
+    start = last = time.perf_counter()
+    first = None
+    count = 0
+    try:
+        async with aclosing(stream):
+            async for chunk in stream:
+                now = time.perf_counter()
+                if first is None:
+                    first = now
+                    TIME_TO_FIRST_TOKEN.labels(*labels).observe(now - start)
+                else:
+                    inter_token.observe(now - last)
+                last = now
+                count += 1
+                yield chunk
+    except Exception:
+        GENERATION_ERRORS.labels(*labels).inc()
+        raise
+    finally:
+        end = time.perf_counter()
+        GENERATION_TIME.labels(*labels).observe(end - start)
+        tokens = count if usage is None or usage.output_tokens is None else usage.output_tokens
+        TOKENS.labels(*labels).inc(tokens)
+        if first is not None and count > 1 and last > first:
+            # The tokens of the first chunk are not known, they are taken as its share of the chunks.
+            TOKENS_PER_SECOND.labels(*labels).observe(tokens * (count - 1) / count / (last - first))
+
+
+class StatsCollector(Collector):
+    def __init__(self, prefix: str, documentation: str, stats: Callable[[], Dict[str, float]],
+                 counters: tuple[str, ...] = ()):
+        """
+        Collect metrics read from an object at scrape time.
+
+        Args:
+            prefix (str): Metric name prefix.
+            documentation (str): Metric documentation.
+            stats (Callable): Returns the current values by name.
+            counters (tuple): Names of the values that are counters, the others are gauges.
+        """
+        self.prefix = prefix
+        self.documentation = documentation
+        self.stats = stats
+        self.counters = counters
+
+    def collect(self):
+        for name, value in self.stats().items():
+            family = CounterMetricFamily if name in self.counters else GaugeMetricFamily
+            if not MULTIPROCESS:
+                yield family(f"{self.prefix}_{name}", f"{self.documentation} {name}.", value=value)
+                continue
+            # The values of the process serving the scrape, told apart by its pid.
+            metric = family(f"{self.prefix}_{name}", f"{self.documentation} {name}.", labels=["pid"])
+            metric.add_metric([str(os.getpid())], value)
+            yield metric
+
+
+collectors: List[StatsCollector] = []
+
+
+def track(prefix: str, documentation: str, stats: Callable[[], Dict[str, float]],
+          counters: tuple[str, ...] = ()) -> None:
+    """
+    Expose values read from an object at scrape time, e.g. the pool of an engine.
+
+    Args:
+        prefix (str): Metric name prefix.
+        documentation (str): Metric documentation.
+        stats (Callable): Returns the current values by name.
+        counters (tuple): Names of the values that are counters, the others are gauges.
+    """
+    collector = StatsCollector(prefix, documentation, stats, counters)
+    collectors.append(collector)
+    REGISTRY.register(collector)
+
+
+def exposition() -> bytes:
+    """
+    Get the metrics in the Prometheus text format. When the server runs several
+    processes, the metrics are aggregated from the files every process writes,
+    and the tracked values, which only live in memory, are the ones of the
+    process serving the scrape.
+
+    Returns:
+        bytes: The metrics.
+    """
+    if not MULTIPROCESS:
+        return generate_latest()
+    from prometheus_client import multiprocess
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    for collector in collectors:
+        registry.register(collector)
+    return generate_latest(registry)
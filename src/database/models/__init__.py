@@ -0,0 +1,5 @@
+from database.models.base import VSQLModel
+from database.models.job import Job
+from database.models.llm_cache import CachedResponse
+from database.models.conversation import Conversation, ConversationMessage
+from database.models.batch import Batch, BatchItem
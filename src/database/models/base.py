@@ -1,8 +1,9 @@
 from uuid import UUID, uuid4
 from sqlmodel import SQLModel as _SQLModel, Field, select
+from sqlalchemy import ColumnElement, DateTime, Row, delete, func, tuple_, update
 from sqlalchemy.orm import declared_attr
 from datetime import datetime, timezone
-from typing import Type, TypeVar, List
+from typing import Any, AsyncGenerator, Sequence, Type, TypeVar, List
 from sqlalchemy.ext.asyncio import AsyncSession
 
 class SQLModel(_SQLModel):
@@ -38,16 +39,19 @@ class VSQLModel(SQLModel):
 
     updated_at: datetime = Field(
         default_factory=lambda: datetime.now(timezone.utc),
-        sa_column_kwargs={"onupdate": datetime.now(timezone.utc)}
+        sa_type=DateTime(timezone=True),
+        sa_column_kwargs={"onupdate": lambda: datetime.now(timezone.utc)}
     )
     created_at: datetime = Field(
         default_factory=lambda: datetime.now(timezone.utc),
-        sa_column_kwargs={"server_default": "CURRENT_TIMESTAMP"}
+        sa_type=DateTime(timezone=True),
+        sa_column_kwargs={"server_default": func.now()}
     )
     @classmethod
     async def get_all(cls: Type[VSQLModelType], session: AsyncSession) -> List[VSQLModelType]:
         """
-        Get all the model items.
+        Get all the model items. Every row is loaded in memory, use get_page or
+        stream on large tables.
 
         Args:
             session (AsyncSession): An async session.
@@ -61,7 +65,69 @@ class VSQLModel(SQLModel):
 
 
     @classmethod
-    async def delete_all(cls: Type[VSQLModelType], session: AsyncSession) -> List[VSQLModelType]:
+    async def get_page(cls: Type[VSQLModelType], session: AsyncSession, *where: ColumnElement[bool],
+                       after: Sequence[Any] | None = None, limit: int = 100,
+                       order_by: Sequence[str] = ("id",),
+                       columns: Sequence[str] | None = None) -> tuple[List[VSQLModelType | Row], tuple | None]:
+        """
+        Get a page of model items with keyset pagination: the next page starts
+        after the sort key of the last item, so every page costs the same
+        whatever its depth.
+
+        Args:
+            session (AsyncSession): An async session.
+            *where: Filter conditions.
+            after (Sequence): Cursor returned with the previous page, None for the first one.
+            limit (int): Page size.
+            order_by (Sequence): Sort columns, the ID is appended to make the key unique.
+                They should be covered by an index.
+            columns (Sequence): Columns to load, e.g. to skip large ones. All by default.
+
+        Returns:
+            tuple: The items, model items or rows of the selected columns, and the
+            cursor of the next page, None after the last page.
+        """
+        keys = [getattr(cls, name) for name in dict.fromkeys([*order_by, "id"])]
+        if columns is None:
+            query = select(cls)
+        else:
+            query = select(*(getattr(cls, name) for name in dict.fromkeys([*columns, *order_by, "id"])))
+        if after is not None:
+            query = query.where(tuple_(*keys) > tuple_(*after))
+        data = await session.execute(query.where(*where).order_by(*keys).limit(limit))
+        items = data.scalars().all() if columns is None else data.all()
+        if len(items) < limit:
+            return items, None
+        return items, tuple(getattr(items[-1], key.key) for key in keys)
+
+    @classmethod
+    async def stream(cls: Type[VSQLModelType], session: AsyncSession, *where: ColumnElement[bool],
+                     columns: Sequence[str] | None = None,
+                     batch_size: int = 1000) -> AsyncGenerator[VSQLModelType | Row, None]:
+        """
+        Stream the model items with a server-side cursor, batch_size rows in
+        memory at a time.
+
+        Args:
+            session (AsyncSession): An async session.
+            *where: Filter conditions.
+            columns (Sequence): Columns to load, e.g. to skip large ones. All by default.
+            batch_size (int): Rows fetched per round trip.
+
+        Yields:
+            VSQLModelType | Row: Model items, or rows of the selected columns.
+        """
+        if columns is None:
+            query = select(cls)
+        else:
+            query = select(*(getattr(cls, name) for name in columns))
+        result = await session.stream(query.where(*where).execution_options(yield_per=batch_size))
+        rows = result.scalars() if columns is None else result
+        async for row in rows:
+            yield row
+
+    @classmethod
+    async def delete_all(cls: Type[VSQLModelType], session: AsyncSession) -> int:
 
         """
         Delete all the model items.
@@ -70,12 +136,42 @@ class VSQLModel(SQLModel):
             session (AsyncSession): An async session.
 
         Returns:
-            List[VSQLModelType]: A list of model items that are deleted.
+            int: Number of model items deleted.
         """
-        data = await session.get(cls)
-        await session.delete(data)
-        return data
-        ...
+        return await cls.delete_where(session)
+
+    @classmethod
+    async def delete_where(cls: Type[VSQLModelType], session: AsyncSession, *where: ColumnElement[bool]) -> int:
+        """
+        Delete the model items matching conditions, in one statement.
+
+        Args:
+            session (AsyncSession): An async session.
+            *where: Filter conditions.
+
+        Returns:
+            int: Number of model items deleted.
+        """
+        data = await session.execute(delete(cls).where(*where))
+        return data.rowcount
+
+    @classmethod
+    async def update_where(cls: Type[VSQLModelType], session: AsyncSession, *where: ColumnElement[bool],
+                           **values) -> int:
+        """
+        Update the model items matching conditions, in one statement.
+
+        Args:
+            session (AsyncSession): An async session.
+            *where: Filter conditions.
+            **values: Columns to update.
+
+        Returns:
+            int: Number of model items updated.
+        """
+        values.setdefault("updated_at", datetime.now(timezone.utc))
+        data = await session.execute(update(cls).where(*where).values(**values))
+        return data.rowcount
 
     @classmethod
     async def get_by_id(cls: Type[VSQLModelType], id: UUID, session: AsyncSession) -> VSQLModelType:
@@ -0,0 +1,91 @@
+from uuid import UUID
+from sqlmodel import Field, select
+from sqlalchemy import Index, Text, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Dict, Sequence, Type
+
+from api.schemas.llm import JobConstant
+from database.models.base import VSQLModel, VSQLModelType
+
+
+class Batch(VSQLModel, table=True):
+    """
+    Batch of generation requests, processed by the RabbitMQ workers. Its
+    progress is the status of its items.
+
+    Fields:
+        total: number of items
+    """
+
+    total: int = Field(default=0)
+
+    @classmethod
+    async def get_counts(cls: Type[VSQLModelType], id: UUID,
+                         session: AsyncSession) -> Dict[JobConstant.Status, int]:
+        """
+        Count the items of a batch by status, on the batch status index.
+
+        Args:
+            id (UUID): Batch ID.
+            session (AsyncSession): An async session.
+
+        Returns:
+            dict: Number of items of every status.
+        """
+        data = await session.execute(
+            select(BatchItem.status, func.count())
+            .where(BatchItem.batch_id == id)
+            .group_by(BatchItem.status)
+        )
+        return {status: count for status, count in data.all()}
+
+
+class BatchItem(VSQLModel, table=True):
+    """
+    Request of a batch.
+
+    Fields:
+        batch_id: batch the item belongs to
+        position: order of the item in the batch
+        custom_id: ID given by the client, reported with the result
+        status: current state of the item
+        request: serialized BatchItemRequest
+        result: generated text once the item completed
+        error: error message if the item failed
+        usage: serialized StreamUsage of the generation
+    """
+
+    __table_args__ = (
+        Index("ix_BatchItem_batch_id_position", "batch_id", "position"),
+        Index("ix_BatchItem_batch_id_status", "batch_id", "status"),
+    )
+
+    batch_id: UUID = Field(foreign_key="Batch.id")
+    position: int
+    custom_id: str | None = Field(default=None)
+    status: JobConstant.Status = Field(default=JobConstant.Status.QUEUED)
+    request: str = Field(sa_type=Text)
+    result: str | None = Field(default=None, sa_type=Text)
+    error: str | None = Field(default=None, sa_type=Text)
+    usage: str | None = Field(default=None, sa_type=Text)
+
+    @classmethod
+    async def set_status(cls: Type[VSQLModelType], id: UUID, status: JobConstant.Status, session: AsyncSession,
+                         current: Sequence[JobConstant.Status] | None = None, **values) -> bool:
+        """
+        Update the status of an item, along with any other column given.
+
+        Args:
+            id (UUID): ID.
+            status (JobConstant.Status): New item status.
+            session (AsyncSession): An async session.
+            current (list): Statuses the item may be in to be updated, None for any.
+            **values: Other columns to update, e.g. result or error.
+
+        Returns:
+            bool: True if the item was updated.
+        """
+        where = [cls.id == id]
+        if current is not None:
+            where.append(cls.status.in_(current))
+        return await cls.update_where(session, *where, status=status, **values) > 0
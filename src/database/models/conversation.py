@@ -0,0 +1,68 @@
+from uuid import UUID
+from sqlmodel import Field, select
+from sqlalchemy import Index, Text
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Type
+
+from database.models.base import VSQLModel, VSQLModelType
+
+
+class Conversation(VSQLModel, table=True):
+    """
+    Conversation whose turns are kept, so that requests only send the new messages.
+
+    Fields:
+        model: model the conversation was started with
+    """
+
+    model: str | None = Field(default=None)
+
+    @classmethod
+    async def get_history(cls: Type[VSQLModelType], id: UUID, session: AsyncSession,
+                          limit: int | None = None) -> List["ConversationMessage"] | None:
+        """
+        Get the messages of a conversation, oldest first, in one query on the
+        conversation index.
+
+        Args:
+            id (UUID): Conversation ID.
+            session (AsyncSession): An async session.
+            limit (int): Maximum number of messages, the latest ones are kept.
+
+        Returns:
+            list: The messages, or None if the conversation does not exist.
+        """
+        data = await session.execute(
+            select(cls.id, ConversationMessage)
+            .outerjoin(ConversationMessage, ConversationMessage.conversation_id == cls.id)
+            .where(cls.id == id)
+            .order_by(ConversationMessage.created_at.desc(), ConversationMessage.position.desc())
+            .limit(limit)
+        )
+        rows = data.all()
+        if not rows:
+            return None
+        return [message for _, message in reversed(rows) if message is not None]
+
+
+class ConversationMessage(VSQLModel, table=True):
+    """
+    Message of a conversation.
+
+    Fields:
+        conversation_id: conversation the message belongs to
+        position: order of the message among those of the same turn
+        role: user or assistant
+        content: JSON encoded content, a string or a list of blocks
+        tokens: output tokens of a reply, or its streamed chunks when the backend reported none
+    """
+
+    __table_args__ = (
+        Index("ix_ConversationMessage_conversation_id_created_at", "conversation_id", "created_at"),
+    )
+
+    conversation_id: UUID = Field(foreign_key="Conversation.id")
+    position: int = Field(default=0)
+    role: str
+    content: str = Field(sa_type=Text)
+    tokens: int | None = Field(default=None)
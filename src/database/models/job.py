@@ -0,0 +1,46 @@
+from uuid import UUID
+from sqlmodel import Field
+from sqlalchemy import Text
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Sequence, Type
+
+from api.schemas.llm import JobConstant
+from database.models.base import VSQLModel, VSQLModelType
+
+
+class Job(VSQLModel, table=True):
+    """
+    Generation job processed by the RabbitMQ workers.
+
+    Fields:
+        status: current state of the job
+        request: serialized request body
+        result: generated text once the job completed
+        error: error message if the job failed
+    """
+
+    status: JobConstant.Status = Field(default=JobConstant.Status.QUEUED, index=True)
+    request: str = Field(sa_type=Text)
+    result: str | None = Field(default=None, sa_type=Text)
+    error: str | None = Field(default=None, sa_type=Text)
+
+    @classmethod
+    async def set_status(cls: Type[VSQLModelType], id: UUID, status: JobConstant.Status, session: AsyncSession,
+                         current: Sequence[JobConstant.Status] | None = None, **values) -> bool:
+        """
+        Update the status of a job, along with any other column given.
+
+        Args:
+            id (UUID): ID.
+            status (JobConstant.Status): New job status.
+            session (AsyncSession): An async session.
+            current (list): Statuses the job may be in to be updated, None for any.
+            **values: Other columns to update, e.g. result or error.
+
+        Returns:
+            bool: True if the job was updated.
+        """
+        where = [cls.id == id]
+        if current is not None:
+            where.append(cls.status.in_(current))
+        return await cls.update_where(session, *where, status=status, **values) > 0
@@ -0,0 +1,80 @@
+from datetime import datetime, timezone
+from sqlmodel import Field, select
+from sqlalchemy import DateTime, Text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Type
+
+from database.models.base import VSQLModel, VSQLModelType
+
+
+class CachedResponse(VSQLModel, table=True):
+    """
+    Generated response kept by the response cache, one per request.
+
+    Fields:
+        key: hash of the normalized request
+        chunks: JSON list of the streamed chunks
+        expires_at: when the response stops being served
+    """
+
+    key: str = Field(index=True, unique=True)
+    chunks: str = Field(sa_type=Text)
+    expires_at: datetime = Field(sa_type=DateTime(timezone=True), index=True)
+
+    @classmethod
+    async def get_by_key(cls: Type[VSQLModelType], key: str, session: AsyncSession) -> VSQLModelType | None:
+        """
+        Get the unexpired response of a request.
+
+        Args:
+            key (str): Request hash.
+            session (AsyncSession): An async session.
+
+        Returns:
+            VSQLModelType: A model item, or None.
+        """
+        data = await session.execute(
+            select(cls).where(cls.key == key, cls.expires_at > datetime.now(timezone.utc))
+        )
+        return data.scalar_one_or_none()
+
+    @classmethod
+    async def upsert(cls: Type[VSQLModelType], key: str, chunks: str, expires_at: datetime,
+                     session: AsyncSession) -> None:
+        """
+        Store the response of a request, replacing the one already stored. A
+        response stored at the same time by another process wins.
+
+        Args:
+            key (str): Request hash.
+            chunks (str): JSON list of the streamed chunks.
+            expires_at (datetime): When the response stops being served.
+            session (AsyncSession): An async session.
+        """
+        if await cls.update_where(session, cls.key == key, chunks=chunks, expires_at=expires_at):
+            return
+        try:
+            async with session.begin_nested():
+                session.add(cls(key=key, chunks=chunks, expires_at=expires_at))
+        except IntegrityError:
+            pass
+
+    @classmethod
+    async def evict(cls: Type[VSQLModelType], session: AsyncSession, max_entries: int = 0) -> int:
+        """
+        Delete the expired responses, then the ones expiring first beyond a
+        maximum number of responses.
+
+        Args:
+            session (AsyncSession): An async session.
+            max_entries (int): Maximum number of responses kept, 0 for no limit.
+
+        Returns:
+            int: Number of responses deleted.
+        """
+        deleted = await cls.delete_where(session, cls.expires_at <= datetime.now(timezone.utc))
+        if max_entries:
+            beyond = select(cls.id).order_by(cls.expires_at.desc()).offset(max_entries)
+            deleted += await cls.delete_where(session, cls.id.in_(beyond))
+        return deleted
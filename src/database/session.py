@@ -2,38 +2,125 @@
 Module for database session management.
 """
 
+import os
 from typing import AsyncGenerator
-from contextlib import asynccontextmanager
+from contextlib import AsyncExitStack, asynccontextmanager
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
     AsyncSession,
     async_sessionmaker,
     create_async_engine,
 )
-from sqlalchemy import event
+from sqlalchemy import event, make_url, text
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from database.models import VSQLModel
 
-from core.settings import load_settings
+from core.metrics import track
+from core.settings import DatabaseSettings, load_settings
 
 
 dbs = load_settings("DatabaseSettings")
 
-engine = create_async_engine(
-    dbs.url,
-    echo=dbs.echo,
-    pool_pre_ping=dbs.pool_pre_ping,
-    pool_recycle=dbs.pool_recycle,
-)
 
-@event.listens_for(engine.sync_engine, "connect")
-def enable_foreign_keys(dbapi_connection, connection_record):
-    cursor = dbapi_connection.cursor()
-    cursor.execute("PRAGMA foreign_keys=ON")
-    cursor.close()
+def create_engine(settings: DatabaseSettings) -> AsyncEngine:
+    """
+    Create the async engine of the configured database. The pool settings are
+    applied to the databases served by a connection pool, the pragmas to
+    SQLite only.
 
-AsyncSessionFactory = async_sessionmaker(
-    bind=engine, autoflush=False, expire_on_commit=False
-)
+    Args:
+        settings (DatabaseSettings): Database settings.
+
+    Returns:
+        AsyncEngine: The engine.
+    """
+    url = make_url(settings.url)
+    options = dict(echo=settings.echo, pool_pre_ping=settings.pool_pre_ping, pool_recycle=settings.pool_recycle)
+    sqlite = url.get_backend_name() == "sqlite"
+    in_memory = sqlite and url.database in (None, "", ":memory:")
+    if not in_memory:
+        options.update(pool_size=settings.pool_size, max_overflow=settings.max_overflow,
+                       pool_timeout=settings.pool_timeout)
+    if sqlite and not in_memory:
+        # aiosqlite defaults to opening a connection per session.
+        options.update(poolclass=AsyncAdaptedQueuePool)
+    engine = create_async_engine(url, **options)
+
+    if sqlite:
+        @event.listens_for(engine.sync_engine, "connect")
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA foreign_keys=ON")
+            if not in_memory:
+                cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute(f"PRAGMA cache_size={int(settings.sqlite_cache_size)}")
+            cursor.execute(f"PRAGMA busy_timeout={int(settings.sqlite_busy_timeout)}")
+            cursor.close()
+
+    return engine
+
+
+# Created by get_engine, on the first session or by the lifespan, and not at import.
+engine: AsyncEngine | None = None
+
+AsyncSessionFactory = async_sessionmaker(autoflush=False, expire_on_commit=False)
+
+
+def get_engine() -> AsyncEngine:
+    """
+    Get the engine, and create it on the first call.
+
+    Returns:
+        AsyncEngine: The engine.
+    """
+    global engine
+    if engine is None:
+        engine = create_engine(dbs)
+        AsyncSessionFactory.configure(bind=engine)
+    return engine
+
+
+async def dispose_engine() -> None:
+    """
+    Close the connections of the engine. The next session creates a new one.
+    """
+    global engine
+    if engine is not None:
+        await engine.dispose()
+        engine = None
+
+
+def forget_engine() -> None:
+    """
+    Drop the engine inherited from the parent of a forked process, without
+    closing its connections, as the parent still uses them. The next session
+    creates an engine of this process.
+    """
+    global engine
+    if engine is not None:
+        engine.sync_engine.dispose(close=False)
+        engine = None
+
+
+os.register_at_fork(after_in_child=forget_engine)
+
+
+def pool_stats() -> dict[str, float]:
+    """
+    Get the usage of the connection pool, for the metrics.
+
+    Returns:
+        dict: Pool size, connections checked out and in, and overflow.
+    """
+    if engine is None or not hasattr(engine.pool, "checkedout"):
+        return {}
+    pool = engine.pool
+    return {"size": pool.size(), "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(), "overflow": pool.overflow()}
+
+track("db_pool", "Database connection pool", pool_stats)
 
 
 @asynccontextmanager
@@ -44,6 +131,7 @@ async def get_db_session() -> AsyncGenerator[AsyncSession, None]:
     Yields:
         AsyncSession: An async session.
     """
+    get_engine()
     session = AsyncSessionFactory()
     try:
         yield session
@@ -55,5 +143,23 @@ async def get_db_session() -> AsyncGenerator[AsyncSession, None]:
         await session.close()
 
 
-def init_db():
-    VSQLModel.metadata.create_all(engine)
\ No newline at end of file
+async def init_db() -> None:
+    """
+    Create the tables of all the registered models.
+    """
+    async with get_engine().begin() as connection:
+        await connection.run_sync(VSQLModel.metadata.create_all)
+
+
+async def warm_pool() -> None:
+    """
+    Open the connections of the pool, so that the first requests do not pay
+    for the connection setup.
+    """
+    engine = get_engine()
+    if not dbs.pool_warmup or not hasattr(engine.pool, "size"):
+        return
+    async with AsyncExitStack() as stack:
+        for _ in range(engine.pool.size()):
+            connection = await stack.enter_async_context(engine.connect())
+            await connection.execute(text("SELECT 1"))
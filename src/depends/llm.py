@@ -1,65 +1,383 @@
 
+import time
+from contextlib import aclosing
+from functools import partial
+from typing import Any, AsyncIterator, Callable, Dict, List
+
+from fastapi import Request
 from fastapi.responses import StreamingResponse
 
-from api.schemas.llm import RequestValidation, RequestValidationOllama
-from core.settings import  BusinessLogicConfig
-from exceptions.llm import ServiceError
+from api.schemas.llm import RequestValidation, RequestValidationOllama, SchedulerConstant, StreamUsage
+from core.metrics import instrument, track
+from core.settings import  (AnthropicSettings, BusinessLogicConfig, CacheSettings, ContextSettings,
+                            ResilienceSettings, load_settings)
+from exceptions.llm import Error, ServiceError
 
+from depends.llm_admission import admission
+from depends.llm_cache import ResponseCache, cache_key
+from depends.llm_cancellation import Cancellation
 from depends.llm_client import anthropic_client, ollama_client
+from depends.llm_context import SUMMARY_SYSTEM, ContextManager
+from depends.llm_images import image_processor
+from depends.llm_protocol import stream_encoder
+from depends.llm_resilience import BACKENDS, Candidate, resilience
+from depends.llm_scheduler import ollama_scheduler
+from depends.llm_singleflight import SingleFlight
+from depends.llm_transcripts import transcripts
+
+cache_settings: CacheSettings = load_settings("CacheSettings")
+context_settings: ContextSettings = load_settings("ContextSettings")
+resilience_settings: ResilienceSettings = load_settings("ResilienceSettings")
+anthropic_settings: AnthropicSettings = load_settings("AnthropicSettings")
+
+
+async def summarize(transcript: str) -> str:
+    """
+    Summarize the turns dropped from a conversation.
+
+    Args:
+        transcript (str): The turns as text.
+
+    Returns:
+        str: The summary.
+    """
+    stream = anthropic_client.create_stream(messages=[{"role": "user", "content": transcript}],
+                                            system=SUMMARY_SYSTEM, model=context_settings.summary_model,
+                                            max_tokens=context_settings.summary_max_tokens, temperature=0.2)
+    return "".join([chunk async for chunk in stream])
+
+response_cache = ResponseCache(
+    embed=partial(ollama_client.embed, model=cache_settings.semantic_model) if cache_settings.semantic else None
+)
+flights = SingleFlight()
+context_manager = ContextManager(anthropic_client.get_tokenizer,
+                                 summarize=summarize if context_settings.summarize else None)
+cancellation = Cancellation(tokens=context_manager.tokens)
+
+track("llm_cache", "Response cache", lambda: {
+    "hits": response_cache.hits, "misses": response_cache.misses, "evictions": response_cache.evictions,
+    "entries": len(response_cache.entries), "bytes": response_cache.size,
+}, counters=("hits", "misses", "evictions"))
+track("llm_coalescing", "Request coalescing", lambda: {"flights": len(flights)})
+track("llm_transcripts", "Conversation transcripts", lambda: {
+    "pending": len(transcripts.pending), "written": transcripts.written,
+    "dropped": transcripts.dropped, "failed": transcripts.failed,
+}, counters=("written", "dropped", "failed"))
+track("llm_admission", "Admission control", lambda: {
+    "admitted": admission.admitted, "rate_limited": admission.rate_limited, "overloaded": admission.overloaded,
+    "active_streams": admission.gate.active, "waiting": len(admission.gate.waiters),
+}, counters=("admitted", "rate_limited", "overloaded"))
+track("llm_resilience", "Upstream resilience", lambda: {
+    "retries": resilience.retried, "hedged": resilience.hedged, "fallbacks": resilience.fallbacks,
+    **{f"breaker_trips_{backend}": resilience.breakers[backend].trips for backend in BACKENDS},
+    **{f"breaker_open_{backend}": float(resilience.breakers[backend].state != "closed") for backend in BACKENDS},
+}, counters=("retries", "hedged", "fallbacks", *(f"breaker_trips_{backend}" for backend in BACKENDS)))
+track("llm_stream", "Response streams", lambda: {
+    "chunks": stream_encoder.chunks, "writes": stream_encoder.writes, "heartbeats": stream_encoder.heartbeats,
+}, counters=("chunks", "writes", "heartbeats"))
+track("llm_cancellation", "Cancelled generations", lambda: {
+    "disconnects": cancellation.disconnects, "cancelled": cancellation.cancelled,
+    "delivered_tokens_estimate": cancellation.delivered_tokens,
+}, counters=("disconnects", "cancelled", "delivered_tokens_estimate"))
+track("llm_images", "Image preprocessing", lambda: {
+    "hits": image_processor.hits, "misses": image_processor.misses, "resized": image_processor.resized,
+    "bytes_in": image_processor.bytes_in, "bytes_out": image_processor.bytes_out,
+    "entries": len(image_processor.entries), "bytes": image_processor.size,
+}, counters=("hits", "misses", "resized", "bytes_in", "bytes_out"))
+track("llm_context", "Context window", lambda: {
+    "count_hits": context_manager.hits, "count_misses": context_manager.misses,
+    "trimmed_messages": context_manager.trimmed_messages, "summarized": context_manager.summarized,
+}, counters=("count_hits", "count_misses", "trimmed_messages", "summarized"))
 
 class LLMService:
 
     @staticmethod
-    async def create_stream_anthropic(body: RequestValidation) -> StreamingResponse:
+    def semantic_prompt(system: str | None, messages: List[dict], temperature: float | None) -> str | None:
+        """
+        Get the prompt text compared by the semantic cache. Only requests with a
+        low temperature are close enough to deterministic to share a response.
+
+        Args:
+            system (str): System description.
+            messages (list): Messages as dictionaries.
+            temperature (float): Temperature.
+
+        Returns:
+            str: The prompt text, or None if the request is not eligible.
+        """
+        if not cache_settings.semantic or (temperature or 0.0) > cache_settings.semantic_max_temperature:
+            return None
+        turns = [f"{message['role']}: {message['content']}" for message in messages]
+        return "\n".join([system or "", *turns])
+
+    @staticmethod
+    def serve(key: str, upstream: Callable[[], AsyncIterator[str]],
+              prompt: str | None = None, partition: str = "",
+              usage: StreamUsage | None = None) -> AsyncIterator[str]:
+        """
+        Serve a request through the response cache and the request coalescing,
+        as far as they are enabled.
+
+        Args:
+            key (str): Request key.
+            upstream (Callable): Starts the upstream stream.
+            prompt (str): Prompt text compared by the semantic cache.
+            partition (str): Semantic partition of the request, e.g. the model.
+            usage (StreamUsage): Filled by the upstream, shared with the requests coalesced with it.
+
+        Returns:
+            AsyncIterator: Response chunks.
+        """
+        if cache_settings.coalesce:
+            upstream = partial(flights.stream, key, upstream, usage=usage)
+        if cache_settings.enabled:
+            return response_cache.stream(key, upstream, prompt=prompt, partition=partition)
+        return upstream()
+
+    @staticmethod
+    async def prime(stream: AsyncIterator[str], request: Request | None = None) -> AsyncIterator[str]:
+        """
+        Wait for the first chunk of a stream before the response starts, so that
+        an upstream failure is answered with an error status rather than a cut
+        off response.
+
+        Args:
+            stream (AsyncIterator): Response chunks.
+            request (Request): The request, to stop waiting if its client disconnects.
+
+        Returns:
+            AsyncIterator: The same chunks.
+
+        Raises:
+            ClientDisconnectedError: If the client disconnected first.
+        """
+        try:
+            first = await cancellation.first(stream, request)
+        except StopAsyncIteration:
+            return stream
+
+        async def chunks():
+            yield first
+            async with aclosing(stream):
+                async for chunk in stream:
+                    yield chunk
+
+        return chunks()
+
+    @staticmethod
+    def upstream(model: str, system: str | None, messages: List[Dict[str, Any]], temperature: float | None,
+                 max_tokens: int | None, priority: SchedulerConstant.Priority = SchedulerConstant.Priority.INTERACTIVE,
+                 keep_alive: str | float | None = None, options: Dict[str, Any] | None = None,
+                 usage: StreamUsage | None = None) -> Callable[[], AsyncIterator[str]]:
+        """
+        Get the upstream of a generation: the requested model, then its
+        fallbacks, each on its own backend, under the resilience policy.
+
+        Args:
+            model (str): Model name.
+            system (str): System description.
+            messages (list): Messages as dictionaries.
+            temperature (float): Temperature.
+            max_tokens (int): Maximum tokens.
+            priority (SchedulerConstant.Priority): Ollama scheduling priority.
+            keep_alive (str | float): How long the Ollama model stays loaded.
+            options (dict): Other Ollama model options.
+            usage (StreamUsage): Filled with the usage of the generation once it ends.
+
+        Returns:
+            Callable: Starts the upstream stream.
+        """
+        def anthropic_stream(name: str) -> AsyncIterator[str]:
+            return instrument(anthropic_client.create_stream(messages=anthropic_client.to_messages(messages),
+                                                             system=system, model=name,
+                                                             max_tokens=max_tokens or anthropic_settings.max_tokens,
+                                                             temperature=temperature, usage=usage),
+                              backend="anthropic", model=name, usage=usage)
+
+        def ollama_stream(name: str) -> AsyncIterator[str]:
+            return instrument(ollama_scheduler.create_stream(messages=ollama_client.to_chat_messages(messages, None),
+                                                             system=system, model=name, priority=priority,
+                                                             temperature=temperature, num_predict=max_tokens,
+                                                             keep_alive=keep_alive, options=options,
+                                                             usage=usage),
+                              backend="ollama", model=name, usage=usage)
+
+        model = getattr(model, "value", model)
+        candidates = [Candidate("anthropic", name, partial(anthropic_stream, name)) if name.startswith("claude")
+                      else Candidate("ollama", name, partial(ollama_stream, name))
+                      for name in [model, *resilience_settings.fallbacks.get(model, [])]]
+        return partial(cancellation.watch, partial(resilience.stream, candidates))
+
+    @staticmethod
+    async def fit_context(model: str, system: str | None, messages: List[Dict[str, Any]], max_tokens: int,
+                          window: int | None = None) -> tuple[str | None, List[Dict[str, Any]]]:
+        """
+        Drop or summarize the oldest turns that do not fit the context window.
+
+        Args:
+            model (str): Model name.
+            system (str): System description.
+            messages (list): Messages as dictionaries, oldest first.
+            max_tokens (int): Tokens reserved for the reply.
+            window (int): Context window, defaults to the one of the model.
+
+        Returns:
+            tuple: The system description and the messages to send.
+        """
+        if not context_settings.enabled:
+            return system, messages
+        return await context_manager.fit(model, system, messages, max_tokens, window=window)
+
+    @staticmethod
+    async def prepare_ollama(body: RequestValidationOllama) -> tuple[str | None, List[Dict[str, Any]],
+                                                                     List[Dict[str, Any]]]:
+        """
+        Get the prompt of an Ollama request: the system message, and the request
+        messages, their images downscaled, after the conversation history, fitted
+        in the context window.
+
+        Args:
+            body (RequestValidationOllama): Ollama request validation.
+
+        Returns:
+            tuple: The system description, the messages of this turn and the messages to send.
+        """
+        system = BusinessLogicConfig.get_system_message(system=body.system)
+        turn = ollama_client.to_chat_messages(await image_processor.prepare(body.messages, "ollama"), system=None)
+        messages = turn
+        if body.conversation_id is not None:
+            messages = await transcripts.history(body.conversation_id) + turn
+        system, messages = await LLMService.fit_context(
+            body.model, system, messages,
+            max_tokens=body.num_predict or context_settings.ollama_reserve_tokens,
+            window=(body.options or {}).get("num_ctx") or context_settings.ollama_num_ctx,
+        )
+        return system, turn, messages
+
+    @staticmethod
+    async def prepare_anthropic(body: RequestValidation) -> tuple[str | None, List[Dict[str, Any]],
+                                                                  List[Dict[str, Any]]]:
         """
-        Create stream message on anthropic.
+        Get the prompt of an Anthropic request: the system message, and the
+        request messages, their images downscaled, after the conversation history,
+        fitted in the context window.
 
         Args:
             body (RequestValidation): Anthropic request validation.
 
         Returns:
-            StreamingResponse: Anthropic Message response.
+            tuple: The system description, the messages of this turn and the messages to send.
         """
         system = BusinessLogicConfig.get_system_message(system=body.system)
+        turn = [message.model_dump(mode="json", exclude_none=True)
+                for message in await image_processor.prepare(body.messages, "anthropic")]
+        messages = turn
+        if body.conversation_id is not None:
+            messages = await transcripts.history(body.conversation_id) + turn
+        system, messages = await LLMService.fit_context(body.model, system, messages, max_tokens=body.max_tokens or 0)
+        return system, turn, messages
 
+    @staticmethod
+    async def generate(body: RequestValidation | RequestValidationOllama,
+                       usage: StreamUsage | None = None) -> AsyncIterator[str]:
+        """
+        Start the generation of a request: its prompt is prepared and the reply
+        served through the cache, the coalescing and the upstream, then recorded
+        in its conversation.
+
+        Args:
+            body (RequestValidation | RequestValidationOllama): Anthropic or Ollama request validation.
+            usage (StreamUsage): Filled with the usage of the generation once it ends.
+
+        Returns:
+            AsyncIterator: Response chunks.
+        """
+        if isinstance(body, RequestValidationOllama):
+            system, turn, messages = await LLMService.prepare_ollama(body)
+            upstream = LLMService.upstream(body.model, system, messages, body.temperature, body.num_predict,
+                                           priority=body.priority, keep_alive=body.keep_alive,
+                                           options=body.options, usage=usage)
+            key = cache_key(body.model, system, messages, body.temperature, body.num_predict, options=body.options)
+        else:
+            system, turn, messages = await LLMService.prepare_anthropic(body)
+            upstream = LLMService.upstream(body.model, system, messages, body.temperature, body.max_tokens,
+                                           usage=usage)
+            key = cache_key(body.model, system, messages, body.temperature, body.max_tokens)
+
+        content = LLMService.serve(key, upstream, partition=body.model,
+                                   prompt=LLMService.semantic_prompt(system, messages, body.temperature),
+                                   usage=usage)
+        if body.conversation_id is not None:
+            content = transcripts.transcribe(body.conversation_id, turn, content, usage=usage)
+        return content
+
+    @staticmethod
+    async def complete(body: RequestValidation | RequestValidationOllama) -> tuple[str, StreamUsage]:
+        """
+        Generate the whole reply of a request, e.g. for a batch.
+
+        Args:
+            body (RequestValidation | RequestValidationOllama): Anthropic or Ollama request validation.
+
+        Returns:
+            tuple: The reply and the usage of its generation.
+        """
+        start = time.perf_counter()
+        usage = StreamUsage()
+        chunks = []
+        async with aclosing(await LLMService.generate(body, usage)) as stream:
+            async for chunk in stream:
+                if usage.ttft is None:
+                    usage.ttft = time.perf_counter() - start
+                chunks.append(chunk)
+        usage.latency = time.perf_counter() - start
+        return "".join(chunks), usage
+
+    @staticmethod
+    async def create_stream_anthropic(body: RequestValidation, request: Request | None = None) -> StreamingResponse:
+        """
+        Create stream message on anthropic. The generation is cancelled when the
+        client disconnects.
+
+        Args:
+            body (RequestValidation): Anthropic request validation.
+            request (Request): The request, to watch its client.
+
+        Returns:
+            StreamingResponse: Anthropic Message response.
+        """
+        start = time.perf_counter()
+        usage = StreamUsage()
         try:
-            return StreamingResponse(
-                content=anthropic_client.create_stream(messages=body.messages, system=system,
-                                                       model=body.model,
-                                                       max_tokens=body.max_tokens,
-                                                       temperature=body.temperature),
-                media_type="text/plain")
+            content = await LLMService.generate(body, usage)
+            return stream_encoder.respond(await LLMService.prime(content, request), usage, body.stream_format,
+                                          start)
+        except Error:
+            raise
         except Exception as e:
             raise ServiceError(f"Failed to create stream message on anthropic: {str(e)}")
-        
+
     @staticmethod
-    async def create_stream_ollama(body: RequestValidationOllama) -> StreamingResponse:
+    async def create_stream_ollama(body: RequestValidationOllama,
+                                   request: Request | None = None) -> StreamingResponse:
         """
-        Create stream message on Ollama.
+        Create stream message on Ollama. The generation is cancelled when the
+        client disconnects.
 
         Args:
             body (RequestValidationOllama): Ollama request validation.
+            request (Request): The request, to watch its client.
 
         Returns:
             StreamingResponse: Ollama Message response.
         """
-        system = BusinessLogicConfig.get_system_message(system=body.system)
-
+        start = time.perf_counter()
+        usage = StreamUsage()
         try:
-            return StreamingResponse(
-                content= await ollama_client.create_stream(messages=body.messages, system=system,
-                                                    model=body.model,
-                                                    temperature=body.temperature),
-                media_type="text/plain")
+            content = await LLMService.generate(body, usage)
+            return stream_encoder.respond(await LLMService.prime(content, request), usage, body.stream_format,
+                                          start)
+        except Error:
+            raise
         except Exception as e:
             raise ServiceError(f"Failed to create stream message on Ollama: {str(e)}")
-        
-        # try:
-        #     return await ollama_client.create_stream(
-        #         messages=body.messages,
-        #         system=system,
-        #         temperature=body.temperature,
-        #         model=body.model
-        #     )
-        # except Exception as e:
-        #     raise ServiceError(f"Failed to create stream message on Ollama: {str(e)}")
\ No newline at end of file
@@ -0,0 +1,279 @@
+"""
+Admission control for the LLM endpoints.
+
+Every request takes a token from the bucket of its API key and from the bucket
+of its model, or is rejected at once with 429. Admitted streams then share a
+global cap: past it, requests wait in a bounded queue, and are rejected with 503
+when the queue is full or the wait too long. Both rejections carry Retry-After.
+
+The buckets live in a pluggable backend. The only one keeps them in the process,
+so when the server runs several API processes, each one enforces its share of
+the rates and bursts: the kernel spreads the connections over the processes, so
+the limits hold for the deployment as a whole, give or take the imbalance of
+that spread. The stream cap is per process, as it protects the memory of the
+process. Batches are charged a token per request to the bucket of their API key.
+"""
+
+import abc
+import asyncio
+import time
+from collections import deque
+from contextlib import aclosing
+from typing import AsyncGenerator, AsyncIterator, Awaitable, Callable, Deque, Dict, List
+
+from fastapi import Header, Request
+from fastapi.responses import StreamingResponse
+
+from core.settings import AdmissionSettings, load_settings
+from exceptions.llm import ServiceUnavailableError, TooManyRequestsError
+
+settings: AdmissionSettings = load_settings("AdmissionSettings")
+
+Bucket = tuple[str, float, float]
+
+
+class LimitBackend(abc.ABC):
+    """
+    Storage of the token buckets.
+    """
+
+    @abc.abstractmethod
+    async def take(self, buckets: List[Bucket], cost: float = 1.0) -> float:
+        """
+        Take tokens from buckets, from all of them or from none. A cost above
+        the capacity of a bucket is taken once the bucket is full, and the bucket
+        then owes the difference, which it pays back before it admits anything else.
+
+        Args:
+            buckets (list): Key, refill rate per second and capacity of every bucket.
+            cost (float): Tokens to take from every bucket.
+
+        Returns:
+            float: 0 if the tokens were taken, else the seconds before they are available.
+        """
+
+
+class InMemoryLimitBackend(LimitBackend):
+    def __init__(self, max_keys: int = 100000, processes: int = settings.processes):
+        """
+        Token buckets of the current process. With several API processes, every
+        bucket gets its share of the rate and capacity, but at least one request.
+
+        Args:
+            max_keys (int): Number of buckets above which the full ones are forgotten.
+            processes (int): Number of API processes sharing the limits.
+        """
+        self.max_keys = max_keys
+        self.processes = max(1, processes)
+        self.buckets: Dict[str, tuple[float, float]] = {}
+
+    def _level(self, key: str, rate: float, capacity: float, now: float) -> float:
+        tokens, updated = self.buckets.get(key, (capacity, now))
+        return min(capacity, tokens + (now - updated) * rate)
+
+    async def take(self, buckets: List[Bucket], cost: float = 1.0) -> float:
+        now = time.monotonic()
+        buckets = [(key, rate / self.processes, max(capacity / self.processes, 1.0))
+                   for key, rate, capacity in buckets]
+        levels = [self._level(key, rate, capacity, now) for key, rate, capacity in buckets]
+        wait = max([(min(cost, capacity) - level) / rate
+                    for level, (_, rate, capacity) in zip(levels, buckets) if level < min(cost, capacity)],
+                   default=0.0)
+        if wait > 0:
+            return wait
+        for level, (key, _, _) in zip(levels, buckets):
+            self.buckets[key] = (level - cost, now)
+        if len(self.buckets) > self.max_keys:
+            self.buckets = {key: (tokens, updated) for key, (tokens, updated) in self.buckets.items()
+                            if now - updated < 60}
+        return 0.0
+
+
+LIMIT_BACKENDS: Dict[str, Callable[[], LimitBackend]] = {
+    "memory": InMemoryLimitBackend,
+}
+
+
+class Lease:
+    def __init__(self, gate: "StreamGate"):
+        """
+        Slot of an admitted stream. It is released when the stream ends, or when
+        the response is dropped before streaming.
+
+        Args:
+            gate (StreamGate): Gate the slot belongs to.
+        """
+        self.gate = gate
+        self.released = False
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.gate.release()
+
+    def __del__(self):
+        self.release()
+
+
+class StreamGate:
+    def __init__(self, max_streams: int = settings.max_streams, max_waiting: int = settings.max_waiting,
+                 max_wait: float = settings.max_wait):
+        """
+        Cap the concurrent streams, with a bounded wait queue.
+
+        Args:
+            max_streams (int): Maximum number of concurrent streams.
+            max_waiting (int): Maximum number of requests waiting for a stream.
+            max_wait (float): Seconds a request waits before it is rejected.
+        """
+        self.max_streams = max_streams
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.active = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+
+    async def acquire(self) -> Lease:
+        """
+        Get a stream slot, waiting for one if needed.
+
+        Returns:
+            Lease: The slot.
+
+        Raises:
+            ServiceUnavailableError: If the queue is full or the wait too long.
+        """
+        if self.active < self.max_streams and not self.waiters:
+            self.active += 1
+            return Lease(self)
+        if len(self.waiters) >= self.max_waiting:
+            raise ServiceUnavailableError("Too many streams in progress.", retry_after=self.max_wait)
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.max_wait)
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                waiter.cancel()
+                self.waiters.remove(waiter)
+                raise ServiceUnavailableError("Too many streams in progress.", retry_after=self.max_wait)
+        except asyncio.CancelledError:
+            if waiter.done():
+                # Granted while being cancelled, the slot goes to the next waiter.
+                self.release()
+            else:
+                waiter.cancel()
+                self.waiters.remove(waiter)
+            raise
+        return Lease(self)
+
+    def release(self) -> None:
+        """
+        Hand a slot over to the first waiter, or free it.
+        """
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+class Admission:
+    def __init__(self, backend: LimitBackend, gate: StreamGate, enabled: bool = settings.enabled):
+        """
+        Initialize the admission control.
+
+        Args:
+            backend (LimitBackend): Storage of the token buckets.
+            gate (StreamGate): Cap of the concurrent streams.
+            enabled (bool): If False, every request is admitted.
+        """
+        self.backend = backend
+        self.gate = gate
+        self.enabled = enabled
+        self.admitted = 0
+        self.rate_limited = 0
+        self.overloaded = 0
+
+    async def limit(self, api_key: str, model: str | None = None, cost: int = 1) -> None:
+        """
+        Take request tokens from the buckets of an API key and of a model.
+
+        Args:
+            api_key (str): API key, or client address, of the request.
+            model (str): Model name, None to only charge the API key, e.g. for a batch.
+            cost (int): Number of requests, e.g. the requests of a batch.
+
+        Raises:
+            TooManyRequestsError: If a bucket is empty.
+        """
+        buckets = [(f"key:{api_key}", settings.key_rate, settings.key_burst)]
+        if model is not None:
+            model = getattr(model, "value", model)
+            model_rate, model_burst = settings.model_limits.get(model, (settings.model_rate, settings.model_burst))
+            buckets.append((f"model:{model}", model_rate, model_burst))
+        wait = await self.backend.take(buckets, cost)
+        if wait > 0:
+            self.rate_limited += 1
+            raise TooManyRequestsError("Rate limit exceeded.", retry_after=wait)
+
+    async def guard(self, stream: AsyncIterator[str], lease: Lease) -> AsyncGenerator[str, None]:
+        try:
+            async with aclosing(stream):
+                async for chunk in stream:
+                    yield chunk
+        finally:
+            lease.release()
+
+    async def stream(self, api_key: str, model: str,
+                     respond: Callable[[], Awaitable[StreamingResponse]]) -> StreamingResponse:
+        """
+        Admit a streaming request, and hold its stream slot until the response
+        is sent.
+
+        Args:
+            api_key (str): API key, or client address, of the request.
+            model (str): Model name.
+            respond (Callable): Creates the response.
+
+        Returns:
+            StreamingResponse: The response.
+
+        Raises:
+            TooManyRequestsError: If the API key or the model is over its rate.
+            ServiceUnavailableError: If too many streams are in progress.
+        """
+        if not self.enabled:
+            return await respond()
+        try:
+            await self.limit(api_key, model)
+            lease = await self.gate.acquire()
+        except ServiceUnavailableError:
+            self.overloaded += 1
+            raise
+        try:
+            response = await respond()
+        except BaseException:
+            lease.release()
+            raise
+        self.admitted += 1
+        response.body_iterator = self.guard(response.body_iterator, lease)
+        return response
+
+
+def get_api_key(request: Request, x_api_key: str | None = Header(None)) -> str:
+    """
+    Get the key the rate limits of a request are tracked on: its API key, or its
+    client address when it has none.
+
+    Args:
+        request (Request): The request.
+        x_api_key (str): API key header.
+
+    Returns:
+        str: The key.
+    """
+    return x_api_key or (request.client.host if request.client else "anonymous")
+
+
+admission = Admission(LIMIT_BACKENDS[settings.backend](), StreamGate())
@@ -0,0 +1,216 @@
+"""
+Batch requests.
+
+A batch is stored as one row per request, and every request is published on the
+batch queue on its own, so that the worker pool spreads the batch and a worker
+generates a bounded number of items of every backend at once. The results are
+stored on the items as they complete, and are read back in the order of the batch.
+"""
+
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Awaitable, BinaryIO, Callable, Dict, Iterable, Iterator, List
+from uuid import UUID
+
+from pydantic import ValidationError
+from sqlalchemy import insert, or_
+
+from api.schemas.llm import (BatchItemMessage, BatchItemRequest, BatchItemResult, BatchResponse, JobConstant,
+                             StreamUsage)
+from core.settings import BatchSettings, RabbitMQSettings, load_settings
+from database.models import Batch, BatchItem
+from database.session import get_db_session
+from exceptions.llm import InvalidRequestError, NotFoundError
+from rabbitmq.producer import RabbitMQProducer
+
+settings: BatchSettings = load_settings("BatchSettings")
+rabbitmq_settings: RabbitMQSettings = load_settings("RabbitMQSettings")
+
+DONE = (JobConstant.Status.COMPLETED, JobConstant.Status.FAILED, JobConstant.Status.CANCELLED)
+
+
+def parse_jsonl(file: BinaryIO) -> Iterator[BatchItemRequest]:
+    """
+    Parse a JSONL file of batch requests, one line at a time.
+
+    Args:
+        file (BinaryIO): The file, one BatchItemRequest per line. Blank lines are skipped.
+
+    Yields:
+        BatchItemRequest: The requests.
+
+    Raises:
+        InvalidRequestError: If a line is not a valid request, with its line number.
+    """
+    for number, line in enumerate(file, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield BatchItemRequest.model_validate_json(line)
+        except ValidationError as e:
+            raise InvalidRequestError(f"Invalid request on line {number}.",
+                                      detail={"line": number, "errors": e.errors(include_url=False, include_context=False, include_input=False)})
+
+
+def batch_status(total: int, counts: Dict[JobConstant.Status, int]) -> JobConstant.Status:
+    """
+    Get the status of a batch from the number of items of every status. A batch
+    is completed once every item is done, even if some of them failed.
+
+    Args:
+        total (int): Number of items.
+        counts (dict): Number of items of every status.
+
+    Returns:
+        JobConstant.Status: The status.
+    """
+    if counts.get(JobConstant.Status.CANCELLED, 0) == total:
+        return JobConstant.Status.CANCELLED
+    if sum(counts.get(status, 0) for status in DONE) == total:
+        return JobConstant.Status.COMPLETED
+    if counts.get(JobConstant.Status.QUEUED, 0) == total:
+        return JobConstant.Status.QUEUED
+    return JobConstant.Status.RUNNING
+
+
+async def publish(producer: RabbitMQProducer, batch_id: UUID, item_ids: Iterable[UUID]) -> None:
+    """
+    Publish items on the batch queue, insert_size messages per round trip.
+
+    Args:
+        producer (RabbitMQProducer): The producer.
+        batch_id (UUID): Batch ID.
+        item_ids (Iterable): IDs of the items.
+    """
+    item_ids = list(item_ids)
+    for offset in range(0, len(item_ids), settings.insert_size):
+        await producer.publish_batch(rabbitmq_settings.batch_queue, [
+            RabbitMQProducer.build_message(BatchItemMessage(batch_id=batch_id, item_id=item_id).model_dump_json(),
+                                           message_id=str(item_id), content_type="application/json")
+            for item_id in item_ids[offset:offset + settings.insert_size]
+        ])
+
+
+async def submit(requests: Iterable[BatchItemRequest], producer: RabbitMQProducer,
+                 limit: Callable[..., Awaitable[None]] | None = None) -> BatchResponse:
+    """
+    Store a batch and queue its items. The items are written insert_size rows
+    per statement, and only published once they are all stored, and charged.
+
+    Args:
+        requests (Iterable): The requests, e.g. parsed from a file as they are read.
+        producer (RabbitMQProducer): The producer.
+        limit (Callable): Charges the rate limit for a number of requests, called
+            with their number as cost. None to not limit the batch.
+
+    Returns:
+        BatchResponse: The queued batch.
+
+    Raises:
+        InvalidRequestError: If the batch is empty or larger than max_items.
+        TooManyRequestsError: If the batch is over the rate limit.
+    """
+    batch = Batch()
+    item_ids: List[UUID] = []
+    rows: List[dict] = []
+    async with get_db_session() as session:
+        session.add(batch)
+        await session.flush()
+        for position, request in enumerate(requests):
+            if position >= settings.max_items:
+                raise InvalidRequestError(f"A batch holds at most {settings.max_items} requests.")
+            item = BatchItem(batch_id=batch.id, position=position, custom_id=request.custom_id,
+                             request=request.model_dump_json(exclude_none=True))
+            item_ids.append(item.id)
+            rows.append(item.model_dump())
+            if len(rows) == settings.insert_size:
+                await session.execute(insert(BatchItem), rows)
+                rows = []
+        if rows:
+            await session.execute(insert(BatchItem), rows)
+        if not item_ids:
+            raise InvalidRequestError("A batch holds at least one request.")
+        if limit is not None:
+            # Raised before the commit, the batch is not stored.
+            await limit(cost=len(item_ids))
+        batch.total = len(item_ids)
+
+    await publish(producer, batch.id, item_ids)
+    return BatchResponse(batch_id=batch.id, status=JobConstant.Status.QUEUED, total=batch.total,
+                         counts={JobConstant.Status.QUEUED: batch.total})
+
+
+async def progress(batch_id: UUID) -> BatchResponse:
+    """
+    Get the progress of a batch.
+
+    Args:
+        batch_id (UUID): Batch ID.
+
+    Returns:
+        BatchResponse: The batch and the number of items of every status.
+    """
+    async with get_db_session() as session:
+        batch = await Batch.get_by_id(batch_id, session)
+        if batch is None:
+            raise NotFoundError(f"Batch {batch_id} not found.")
+        counts = await Batch.get_counts(batch_id, session)
+    return BatchResponse(batch_id=batch_id, status=batch_status(batch.total, counts), total=batch.total,
+                         counts=counts)
+
+
+async def results(batch_id: UUID) -> AsyncIterator[str]:
+    """
+    Read the results of the items done so far, in the order of the batch, as
+    JSON lines. Items are read page_size at a time, a session per page.
+
+    Args:
+        batch_id (UUID): Batch ID.
+
+    Yields:
+        str: A BatchItemResult per line.
+    """
+    after = None
+    while True:
+        async with get_db_session() as session:
+            items, after = await BatchItem.get_page(session, BatchItem.batch_id == batch_id,
+                                                    BatchItem.status.in_(DONE), after=after,
+                                                    limit=settings.page_size, order_by=("batch_id", "position"),
+                                                    columns=("position", "custom_id", "status", "result",
+                                                             "error", "usage"))
+        yield "".join(BatchItemResult(position=item.position, custom_id=item.custom_id, status=item.status,
+                                      result=item.result, error=item.error,
+                                      usage=StreamUsage.model_validate_json(item.usage) if item.usage else None)
+                      .model_dump_json() + "\n" for item in items)
+        if after is None:
+            return
+
+
+async def resume(batch_id: UUID, producer: RabbitMQProducer) -> BatchResponse:
+    """
+    Queue again the items of a batch that did not complete: the failed ones,
+    the ones still queued, whose messages may have been lost, and the ones
+    running for longer than stale_after, whose worker likely went away.
+
+    Args:
+        batch_id (UUID): Batch ID.
+        producer (RabbitMQProducer): The producer.
+
+    Returns:
+        BatchResponse: The batch.
+    """
+    stale = datetime.now(timezone.utc) - timedelta(seconds=settings.stale_after)
+    pending = [
+        BatchItem.batch_id == batch_id,
+        or_(BatchItem.status.in_([JobConstant.Status.QUEUED, JobConstant.Status.FAILED]),
+            (BatchItem.status == JobConstant.Status.RUNNING) & (BatchItem.updated_at < stale)),
+    ]
+    async with get_db_session() as session:
+        if await Batch.get_by_id(batch_id, session) is None:
+            raise NotFoundError(f"Batch {batch_id} not found.")
+        item_ids = [item.id async for item in BatchItem.stream(session, *pending, columns=("id",),
+                                                               batch_size=settings.page_size)]
+        for offset in range(0, len(item_ids), settings.insert_size):
+            await BatchItem.update_where(session, BatchItem.id.in_(item_ids[offset:offset + settings.insert_size]),
+                                         status=JobConstant.Status.QUEUED, error=None)
+    await publish(producer, batch_id, item_ids)
+    return await progress(batch_id)
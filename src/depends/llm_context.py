@@ -0,0 +1,230 @@
+"""
+Context window management for the LLM clients.
+
+Messages are counted in tokens, with the counts cached per message hash, so a
+growing conversation only tokenizes its new messages. The oldest turns that do
+not fit the budget of the model are dropped, or replaced by a summary in the
+system message. Summaries are cached per conversation prefix, and a longer
+prefix is summarized from the summary of a shorter one.
+"""
+
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List
+
+import orjson
+
+from api.schemas.llm import AnthropicConstant
+from core.settings import ContextSettings, load_settings
+from exceptions.llm import ContextLengthError
+
+settings: ContextSettings = load_settings("ContextSettings")
+
+Summarize = Callable[[str], Awaitable[str]]
+
+CONTEXT_WINDOWS: Dict[AnthropicConstant.Model, int] = {
+    AnthropicConstant.Model.CLAUDE_3_OPUS_20240229: 200000,
+    AnthropicConstant.Model.CLAUDE_3_SONNET_20240229: 200000,
+    AnthropicConstant.Model.CLAUDE_3_HAIKU_20240307: 200000,
+    AnthropicConstant.Model.CLAUDE_2_1: 200000,
+    AnthropicConstant.Model.CLAUDE_2_0: 100000,
+    AnthropicConstant.Model.CLAUDE_INSTANT_1_2: 100000,
+    AnthropicConstant.Model.LLAMA_3_0: 8192,
+    AnthropicConstant.Model.LLAMA_2_UNCENSORED: 4096,
+}
+
+# Tokens of the role and separators around every message.
+MESSAGE_OVERHEAD = 4
+
+SUMMARY_SYSTEM = ("Summarize the conversation below for an assistant that will continue it. "
+                  "Keep facts, names, decisions and open questions. Answer with the summary only.")
+
+
+def message_hash(message: Dict[str, Any]) -> str:
+    """
+    Hash a message.
+
+    Args:
+        message (dict): Message as a dictionary.
+
+    Returns:
+        str: Hash of the message.
+    """
+    return hashlib.sha256(orjson.dumps(message, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+def message_text(message: Dict[str, Any]) -> tuple[str, int]:
+    """
+    Get the text of a message and its number of images, from Anthropic content
+    blocks or Ollama images.
+
+    Args:
+        message (dict): Message as a dictionary.
+
+    Returns:
+        tuple: The text and the number of images.
+    """
+    content = message.get("content")
+    images = len(message.get("images") or [])
+    if isinstance(content, str):
+        return content, images
+    texts = []
+    for block in content or []:
+        if block.get("type") == AnthropicConstant.TextBlock.Type.TEXT:
+            texts.append(block["text"])
+        else:
+            images += 1
+    return "\n".join(texts), images
+
+
+class ContextManager:
+    def __init__(self, tokenizer: Callable[[], Awaitable[Any]], summarize: Summarize | None = None,
+                 max_entries: int = settings.cache_entries):
+        """
+        Initialize the context manager.
+
+        Args:
+            tokenizer (Callable): Loads the tokenizer, a tokenizers.Tokenizer.
+            summarize (Callable): Summarizes a transcript, None to drop the old turns.
+            max_entries (int): Maximum number of token counts and summaries kept.
+        """
+        self.load_tokenizer = tokenizer
+        self.tokenizer = None
+        self.summarize = summarize
+        self.max_entries = max_entries
+        self.counts: OrderedDict[str, int] = OrderedDict()
+        self.summaries: OrderedDict[str, str] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.trimmed_messages = 0
+        self.summarized = 0
+
+    def _remember(self, entries: OrderedDict, key: str, value: Any) -> None:
+        entries[key] = value
+        entries.move_to_end(key)
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    async def count(self, messages: List[Dict[str, Any]]) -> List[int]:
+        """
+        Count the tokens of messages. Only the messages not seen before are
+        tokenized, in one batch, in a thread.
+
+        Args:
+            messages (list): Messages as dictionaries.
+
+        Returns:
+            list: Tokens of every message.
+        """
+        hashes = [message_hash(message) for message in messages]
+        missing = {}
+        for message, key in zip(messages, hashes):
+            if key in self.counts:
+                self.counts.move_to_end(key)
+                self.hits += 1
+            elif key not in missing:
+                missing[key] = message_text(message)
+                self.misses += 1
+        if missing:
+            if self.tokenizer is None:
+                self.tokenizer = await self.load_tokenizer()
+            # Off the event loop, a long conversation takes a while to tokenize.
+            encodings = await asyncio.to_thread(self.tokenizer.encode_batch, [text for text, _ in missing.values()])
+            for (key, (_, images)), encoding in zip(missing.items(), encodings):
+                self._remember(self.counts, key, len(encoding.ids) + images * settings.image_tokens
+                               + MESSAGE_OVERHEAD)
+        return [self.counts[key] for key in hashes]
+
+    async def tokens(self, text: str) -> int:
+        """
+        Count the tokens of a text, off the event loop.
+
+        Args:
+            text (str): The text.
+
+        Returns:
+            int: Tokens of the text.
+        """
+        if self.tokenizer is None:
+            self.tokenizer = await self.load_tokenizer()
+        return len((await asyncio.to_thread(self.tokenizer.encode, text)).ids)
+
+    async def _summary(self, messages: List[Dict[str, Any]]) -> str:
+        """
+        Summarize messages, starting from the summary of their longest prefix
+        already summarized.
+
+        Args:
+            messages (list): Messages as dictionaries.
+
+        Returns:
+            str: The summary.
+        """
+        prefixes, prefix = [], ""
+        for message in messages:
+            prefix = hashlib.sha256((prefix + message_hash(message)).encode()).hexdigest()
+            prefixes.append(prefix)
+        start, summary = 0, None
+        for index in reversed(range(len(prefixes))):
+            if prefixes[index] in self.summaries:
+                start, summary = index + 1, self.summaries[prefixes[index]]
+                break
+        if start == len(messages):
+            return summary
+
+        turns = [f"{message['role']}: {message_text(message)[0]}" for message in messages[start:]]
+        if summary is not None:
+            turns.insert(0, f"Summary of the earlier conversation: {summary}")
+        summary = await self.summarize("\n\n".join(turns))
+        self.summarized += 1
+        self._remember(self.summaries, prefixes[-1], summary)
+        return summary
+
+    async def fit(self, model: AnthropicConstant.Model, system: str | None, messages: List[Dict[str, Any]],
+                  max_tokens: int, window: int | None = None) -> tuple[str | None, List[Dict[str, Any]]]:
+        """
+        Fit messages in the context window of a model, keeping the latest turns.
+        The conversation kept starts with a user message.
+
+        Args:
+            model (AnthropicConstant.Model): Model name.
+            system (str): System description.
+            messages (list): Messages as dictionaries, oldest first.
+            max_tokens (int): Tokens reserved for the reply.
+            window (int): Context window, defaults to the one of the model.
+
+        Returns:
+            tuple: The system description, with the summary of the dropped turns
+            if enabled, and the messages kept.
+
+        Raises:
+            ContextLengthError: If the last message does not fit.
+        """
+        window = window or CONTEXT_WINDOWS.get(model, settings.default_window)
+        budget = int(window * (1 - settings.margin)) - max_tokens
+        if settings.max_input_tokens:
+            budget = min(budget, settings.max_input_tokens)
+        counts = await self.count(messages)
+        if system:
+            budget -= (await self.count([{"role": "system", "content": system}]))[0]
+        if sum(counts) <= budget:
+            return system, messages
+
+        if self.summarize is not None:
+            budget -= settings.summary_max_tokens
+        start, total = len(messages), 0
+        while start > 0 and total + counts[start - 1] <= budget:
+            start -= 1
+            total += counts[start]
+        while start < len(messages) and messages[start]["role"] != AnthropicConstant.Role.USER:
+            start += 1
+        if start == len(messages):
+            raise ContextLengthError(f"The last message does not fit the {window} tokens context of "
+                                     f"{getattr(model, 'value', model)}.")
+
+        self.trimmed_messages += start
+        if self.summarize is not None:
+            summary = await self._summary(messages[:start])
+            system = f"{system or ''}\n\nSummary of the earlier conversation:\n{summary}".strip()
+        return system, messages[start:]
@@ -0,0 +1,68 @@
+"""
+HTTP clients of the LLM SDKs.
+
+The SDKs hand their request bodies to httpx, which serializes them with the json
+module. These clients serialize them with orjson instead, several times faster on
+the large strings of long conversations and images. The module imports httpx and
+is imported by the clients when they are created.
+"""
+
+from typing import TYPE_CHECKING, Any
+
+import httpx
+import orjson
+
+if TYPE_CHECKING:
+    from ollama import AsyncClient
+
+
+class JSONClient(httpx.AsyncClient):
+    """
+    httpx client serializing JSON bodies with orjson.
+    """
+
+    def build_request(self, method: str, url: Any, *, content: Any = None, json: Any = None,
+                      headers: Any = None, **kwargs) -> httpx.Request:
+        if json is not None and content is None:
+            try:
+                content = orjson.dumps(json)
+            except TypeError:
+                # A type orjson does not know, left to httpx.
+                return super().build_request(method, url, json=json, headers=headers, **kwargs)
+            headers = httpx.Headers(headers)
+            headers.setdefault("Content-Type", "application/json")
+        return super().build_request(method, url, content=content, headers=headers, **kwargs)
+
+
+def ollama_client(host: str, limits: httpx.Limits = httpx.Limits(), **kwargs) -> "AsyncClient":
+    """
+    Create an Ollama client over a JSONClient.
+
+    Args:
+        host (str): Ollama server URL.
+        limits (httpx.Limits): Limits of the connection pool.
+        **kwargs: Other arguments of the httpx client.
+
+    Returns:
+        AsyncClient: The client.
+
+    Raises:
+        RuntimeError: If the installed ollama does not keep its httpx client as expected.
+    """
+    from ollama import AsyncClient
+
+    # The SDK always creates an httpx.AsyncClient, kept as _client, which is
+    # swapped for a JSONClient set up like it. Both are given the same transport,
+    # so the client dropped holds no connection pool of its own.
+    transport = httpx.AsyncHTTPTransport(limits=limits)
+    client = AsyncClient(host, transport=transport, **kwargs)
+    sdk_client = getattr(client, "_client", None)
+    if not isinstance(sdk_client, httpx.AsyncClient):
+        raise RuntimeError("ollama.AsyncClient keeps no httpx client as _client, "
+                           "install the ollama version pinned in requirements.txt.")
+    for name in ("headers", "timeout", "follow_redirects"):
+        kwargs.pop(name, None)
+    client._client = JSONClient(base_url=sdk_client.base_url, headers=sdk_client.headers,
+                                timeout=sdk_client.timeout, follow_redirects=sdk_client.follow_redirects,
+                                transport=transport, **kwargs)
+    return client
@@ -0,0 +1,312 @@
+"""
+Image preprocessing for the LLM clients.
+
+The images of a request are downscaled to the size limits of their backend
+before they are sent: a larger image costs upload time and input tokens, and is
+downscaled by the backend anyway. Processed images are kept in an LRU keyed by
+the hash of their payload, so an image repeated in every turn of a conversation
+is processed once. Decoding, resizing and encoding run in a thread pool, as
+Pillow releases the GIL while it works.
+"""
+
+import asyncio
+import base64
+import binascii
+import hashlib
+import io
+import math
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from os import PathLike, fspath
+from typing import Dict, List, Tuple
+
+from api.schemas.llm import AnthropicConstant, ImageBlock, ImageSource, MessageRequestOllama, MessageRequestValidation
+from core.settings import ImageSettings, load_settings
+from exceptions.llm import InvalidRequestError
+
+settings: ImageSettings = load_settings("ImageSettings")
+
+MediaType = AnthropicConstant.ImageBlock.MediaType
+
+# Base64 characters decoded or hashed at a time, a multiple of 4.
+CHUNK_SIZE = 1 << 20
+# Base64 characters decoded to read the format and size of an image.
+HEADER_SIZE = 1 << 16
+
+# Pillow formats sent as they are, the other ones are converted to PNG.
+FORMATS: Dict[str, MediaType] = {
+    "JPEG": MediaType.JPEG,
+    "PNG": MediaType.PNG,
+    "GIF": MediaType.GIF,
+    "WEBP": MediaType.WEBP,
+}
+
+
+def read_payload(data: str | PathLike) -> str | bytes:
+    """
+    Get the payload of an image source: the base64 string, or the content of
+    the file it points to.
+    """
+    if isinstance(data, PathLike):
+        with open(fspath(data), "rb") as file:
+            return file.read()
+    return data
+
+
+def digest(payload: str | bytes) -> str:
+    """
+    Hash an image payload, CHUNK_SIZE characters at a time so that the string
+    is never copied whole.
+
+    Args:
+        payload (str | bytes): Base64 string or raw image.
+
+    Returns:
+        str: The hash.
+    """
+    sha = hashlib.sha256()
+    for start in range(0, len(payload), CHUNK_SIZE):
+        chunk = payload[start:start + CHUNK_SIZE]
+        sha.update(chunk.encode("ascii", "ignore") if isinstance(chunk, str) else chunk)
+    return sha.hexdigest()
+
+
+def decode(payload: str | bytes) -> bytearray:
+    """
+    Decode a base64 payload in place into a single buffer, CHUNK_SIZE characters
+    at a time, rather than through an encoded copy of the whole string.
+
+    Args:
+        payload (str | bytes): Base64 string, or raw image returned as is.
+
+    Returns:
+        bytearray: The image.
+
+    Raises:
+        InvalidRequestError: If the payload is not valid base64.
+    """
+    if isinstance(payload, bytes):
+        return bytearray(payload)
+    if "\n" in payload or "\r" in payload or " " in payload:
+        # Wrapped base64, the chunks would not be aligned on 4 characters.
+        payload = "".join(payload.split())
+    image = bytearray()
+    try:
+        for start in range(0, len(payload), CHUNK_SIZE):
+            image += binascii.a2b_base64(payload[start:start + CHUNK_SIZE])
+    except (binascii.Error, ValueError):
+        raise InvalidRequestError("Invalid image: the data is not valid base64.")
+    return image
+
+
+def probe(payload: str | bytes) -> Tuple[str, Tuple[int, int]] | None:
+    """
+    Read the format and size of an image from the start of its payload, which
+    holds the header of the common formats.
+
+    Args:
+        payload (str | bytes): Base64 string or raw image.
+
+    Returns:
+        tuple: The Pillow format and the size, or None if the header is further.
+    """
+    from PIL import Image
+
+    try:
+        image = Image.open(io.BytesIO(decode(payload[:HEADER_SIZE])))
+        return image.format, image.size
+    except Exception:
+        return None
+
+
+def resize(payload: str | bytes, media_type: MediaType, max_edge: int, max_pixels: int,
+           quality: int) -> Tuple[str | None, MediaType, bool]:
+    """
+    Downscale an image to fit the limits, keeping its aspect ratio. An image that
+    already fits is only decoded to its header, and JPEG images are decoded at a
+    reduced scale directly.
+
+    Args:
+        payload (str | bytes): Base64 string or raw image.
+        media_type (MediaType): Media type given by the client.
+        max_edge (int): Longest edge, in pixels.
+        max_pixels (int): Maximum pixels.
+        quality (int): JPEG and WebP quality.
+
+    Returns:
+        tuple: The base64 image, or None if the payload is sent as it is, its media
+        type, and True if it was downscaled.
+
+    Raises:
+        InvalidRequestError: If the image cannot be decoded.
+    """
+    from PIL import Image, UnidentifiedImageError
+
+    def fits(size: Tuple[int, int]) -> bool:
+        return max(size) <= max_edge and size[0] * size[1] <= max_pixels
+
+    header = probe(payload)
+    if (header is not None and isinstance(payload, str)
+            and FORMATS.get(header[0]) == media_type and fits(header[1])):
+        return None, media_type, False
+
+    raw = decode(payload)
+    try:
+        image = Image.open(io.BytesIO(raw))
+    except (UnidentifiedImageError, OSError):
+        raise InvalidRequestError("Invalid image: the format is not supported.")
+    detected = FORMATS.get(image.format)
+    if detected is not None and fits(image.size):
+        # Sent as it is, with the media type of its content.
+        data = payload if isinstance(payload, str) else base64.b64encode(raw).decode("ascii")
+        return data, detected, False
+
+    width, height = image.size
+    scale = min(1.0, max_edge / max(width, height), math.sqrt(max_pixels / (width * height)))
+    size = (max(1, int(width * scale)), max(1, int(height * scale)))
+    try:
+        image.thumbnail(size, Image.Resampling.LANCZOS)
+    except OSError:
+        raise InvalidRequestError("Invalid image: the data is truncated.")
+    # An animated GIF is sent as its first frame, other formats as PNG.
+    format = image.format if detected in (MediaType.JPEG, MediaType.WEBP) else "PNG"
+    if format == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    output = io.BytesIO()
+    image.save(output, format=format, quality=quality)
+    return base64.b64encode(output.getbuffer()).decode("ascii"), FORMATS[format], True
+
+
+class ImageProcessor:
+    def __init__(self, limits: Dict[str, Tuple[int, int]], quality: int = settings.quality,
+                 workers: int = settings.workers, max_entries: int = settings.cache_entries,
+                 max_bytes: int = settings.cache_bytes):
+        """
+        Initialize the image processor.
+
+        Args:
+            limits (dict): Longest edge and maximum pixels of the images of every backend.
+            quality (int): JPEG and WebP quality of the resized images.
+            workers (int): Threads decoding and resizing images.
+            max_entries (int): Maximum number of processed images kept.
+            max_bytes (int): Maximum size of the processed images kept.
+        """
+        self.limits = limits
+        self.quality = quality
+        self.workers = workers
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.executor: ThreadPoolExecutor | None = None
+
+        self.entries: OrderedDict[str, ImageSource] = OrderedDict()
+        self.pending: Dict[str, asyncio.Future] = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.resized = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    async def run(self, function, *args):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="images")
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def _remember(self, key: str, source: ImageSource) -> None:
+        size = len(source.data) if isinstance(source.data, str) else 0
+        if size > self.max_bytes:
+            return
+        self.entries[key] = source
+        self.size += size
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted.data) if isinstance(evicted.data, str) else 0
+
+    async def process(self, source: ImageSource, backend: str) -> ImageSource:
+        """
+        Get an image downscaled to the limits of a backend, from the cache if it
+        was already processed. Concurrent requests with the same image share its
+        processing.
+
+        Args:
+            source (ImageSource): The image.
+            backend (str): Backend the image is sent to.
+
+        Returns:
+            ImageSource: The image to send, base64 encoded.
+
+        Raises:
+            InvalidRequestError: If the image cannot be decoded.
+        """
+        payload = source.data if isinstance(source.data, str) else await self.run(read_payload, source.data)
+        key = f"{backend}:{await self.run(digest, payload)}"
+        cached = self.entries.get(key)
+        if cached is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return cached
+        if key in self.pending:
+            self.hits += 1
+            return await asyncio.shield(self.pending[key])
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = future
+        try:
+            max_edge, max_pixels = self.limits[backend]
+            data, media_type, resized = await self.run(resize, payload, source.media_type, max_edge, max_pixels,
+                                                       self.quality)
+            processed = source if data is None else source.model_copy(update={"data": data,
+                                                                             "media_type": media_type})
+            self.resized += resized
+            self.bytes_in += len(payload)
+            self.bytes_out += len(processed.data)
+            self._remember(key, processed)
+            future.set_result(processed)
+            return processed
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Retrieved, so that a processing nobody else waits for is not reported.
+            future.exception()
+            raise
+        finally:
+            del self.pending[key]
+
+    async def prepare(self, messages: MessageRequestOllama | List[MessageRequestValidation],
+                      backend: str) -> MessageRequestOllama | List[MessageRequestValidation]:
+        """
+        Process the images of request messages, all at once.
+
+        Args:
+            messages (MessageRequestOllama | list): A single input or chat messages.
+            backend (str): Backend the messages are sent to.
+
+        Returns:
+            MessageRequestOllama | list: The messages, with their images processed.
+        """
+        if isinstance(messages, MessageRequestOllama):
+            return messages
+        images = [block for message in messages if not isinstance(message.content, str)
+                  for block in message.content if isinstance(block, ImageBlock)]
+        if not settings.enabled or not images:
+            return messages
+        sources = dict(zip(map(id, images), await asyncio.gather(*(self.process(block.source, backend)
+                                                                   for block in images))))
+        return [message if isinstance(message.content, str) else message.model_copy(update={"content": [
+            block.model_copy(update={"source": sources[id(block)]}) if isinstance(block, ImageBlock) else block
+            for block in message.content
+        ]}) for message in messages]
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+image_processor = ImageProcessor({
+    "anthropic": (settings.anthropic_max_edge, settings.anthropic_max_pixels),
+    "ollama": (settings.ollama_max_edge, settings.ollama_max_pixels),
+})
@@ -0,0 +1,228 @@
+"""
+Wire formats of the response streams.
+
+Responses are sent as plain text, as server-sent events or as newline delimited
+JSON. Chunks are coalesced before they are written: the first one goes out at
+once, the next ones are buffered until enough text is waiting or the oldest one
+waited long enough, so a response takes a few writes rather than one per token.
+SSE and NDJSON streams send heartbeats while idle, so that proxies keep them
+open, and end with an event carrying the stop reason, token counts and latency
+of the generation.
+"""
+
+import asyncio
+import json
+import time
+from contextlib import aclosing
+from typing import Any, AsyncGenerator, AsyncIterator
+
+import anyio
+from fastapi.responses import StreamingResponse
+from starlette.types import Send
+
+from api.schemas.llm import JobConstant, StreamConstant, StreamUsage
+from core.settings import StreamSettings, load_settings
+from exceptions.llm import Error
+from rabbitmq.stream import format_sse
+
+settings: StreamSettings = load_settings("StreamSettings")
+
+MEDIA_TYPES = {
+    StreamConstant.Format.TEXT: "text/plain",
+    StreamConstant.Format.SSE: "text/event-stream",
+    StreamConstant.Format.NDJSON: "application/x-ndjson",
+}
+
+# Marks the end of a stream in the read-ahead queue.
+END = object()
+
+
+def frame(format: StreamConstant.Format, event: JobConstant.Event, data: Any = None) -> str:
+    """
+    Format an event of an SSE or NDJSON stream.
+
+    Args:
+        format (StreamConstant.Format): Wire format.
+        event (JobConstant.Event): Event type.
+        data (Any): Event data, text or a JSON serializable value.
+
+    Returns:
+        str: The event, ready to be written on the response.
+    """
+    if format == StreamConstant.Format.SSE:
+        if event == JobConstant.Event.HEARTBEAT:
+            return ": heartbeat\n\n"
+        return format_sse(None, event, data if isinstance(data, str) else json.dumps(data))
+    if data is None:
+        return json.dumps({"event": event.value}) + "\n"
+    return json.dumps({"event": event.value, "data": data}, ensure_ascii=False) + "\n"
+
+
+class GenerationResponse(StreamingResponse):
+    """
+    Streaming response that closes its stream as soon as it stops, e.g. when
+    the client disconnects, rather than when it is garbage collected, so that
+    the upstream generation is aborted at once.
+    """
+
+    async def stream_response(self, send: Send) -> None:
+        try:
+            await super().stream_response(send)
+        finally:
+            # Shielded, as the cancel scope of a disconnect would interrupt the cleanup.
+            with anyio.CancelScope(shield=True):
+                await self.body_iterator.aclose()
+
+
+class StreamEncoder:
+    def __init__(self, size: int = settings.coalesce_size, delay: float = settings.coalesce_delay,
+                 heartbeat: float = settings.heartbeat):
+        """
+        Initialize the stream encoder.
+
+        Args:
+            size (int): Characters buffered before they are written, 0 to write every chunk.
+            delay (float): Seconds a buffered chunk waits at most before it is written.
+            heartbeat (float): Idle seconds after which a heartbeat is sent, 0 to disable.
+        """
+        self.size = size
+        self.delay = delay
+        self.heartbeat = heartbeat
+        self.chunks = 0
+        self.writes = 0
+        self.heartbeats = 0
+
+    async def coalesce(self, stream: AsyncIterator[str], heartbeat: float = 0) -> AsyncGenerator[str | None, None]:
+        """
+        Coalesce the chunks of a stream. The stream is read ahead in a task, so
+        that buffered chunks are written on time even when the next one is late.
+
+        Args:
+            stream (AsyncIterator): Response chunks.
+            heartbeat (float): Idle seconds after which None is yielded, 0 for never.
+
+        Yields:
+            str: Coalesced chunks, or None for a heartbeat.
+        """
+        if not self.delay and not heartbeat:
+            async with aclosing(stream):
+                async for chunk in stream:
+                    self.chunks += 1
+                    self.writes += 1
+                    yield chunk
+            return
+
+        queue: asyncio.Queue = asyncio.Queue(maxsize=settings.queue_size)
+
+        async def pump() -> None:
+            try:
+                async for chunk in stream:
+                    await queue.put(chunk)
+            except Exception as e:
+                await queue.put(e)
+            else:
+                await queue.put(END)
+
+        loop = asyncio.get_running_loop()
+        task = asyncio.create_task(pump())
+        buffer, buffered, deadline, first = [], 0, 0.0, True
+        try:
+            while True:
+                try:
+                    async with asyncio.timeout(deadline - loop.time() if buffer else heartbeat or None):
+                        item = await queue.get()
+                except TimeoutError:
+                    if buffer:
+                        self.writes += 1
+                        yield "".join(buffer)
+                        buffer, buffered = [], 0
+                    else:
+                        yield None
+                    continue
+                if item is END or isinstance(item, Exception):
+                    if buffer:
+                        self.writes += 1
+                        yield "".join(buffer)
+                    if item is END:
+                        return
+                    raise item
+                if not item:
+                    continue
+                self.chunks += 1
+                if first:
+                    # Sent at once, so that coalescing does not delay the first token.
+                    first = False
+                    self.writes += 1
+                    yield item
+                    continue
+                if not buffer:
+                    deadline = loop.time() + self.delay
+                buffer.append(item)
+                buffered += len(item)
+                if buffered >= self.size or loop.time() >= deadline:
+                    self.writes += 1
+                    yield "".join(buffer)
+                    buffer, buffered = [], 0
+        finally:
+            task.cancel()
+            await asyncio.wait([task])
+            await stream.aclose()
+
+    async def encode(self, stream: AsyncIterator[str], usage: StreamUsage, format: StreamConstant.Format,
+                     start: float) -> AsyncGenerator[str, None]:
+        """
+        Encode a stream in a wire format. An error raised once the response
+        started is sent as an error event, except in plain text.
+
+        Args:
+            stream (AsyncIterator): Response chunks.
+            usage (StreamUsage): Usage of the generation, filled by the client when it ends.
+            format (StreamConstant.Format): Wire format.
+            start (float): When the request was received, from time.perf_counter.
+
+        Yields:
+            str: The response body.
+        """
+        text = format == StreamConstant.Format.TEXT
+        try:
+            async with aclosing(self.coalesce(stream, heartbeat=0 if text else self.heartbeat)) as chunks:
+                async for chunk in chunks:
+                    if chunk is None:
+                        self.heartbeats += 1
+                        yield frame(format, JobConstant.Event.HEARTBEAT)
+                        continue
+                    if usage.ttft is None:
+                        usage.ttft = time.perf_counter() - start
+                    yield chunk if text else frame(format, JobConstant.Event.CHUNK, chunk)
+        except Exception as e:
+            if text:
+                raise
+            yield frame(format, JobConstant.Event.ERROR, e.dict() if isinstance(e, Error) else {"message": str(e)})
+            return
+        usage.latency = time.perf_counter() - start
+        if not text:
+            yield frame(format, JobConstant.Event.DONE, usage.model_dump(mode="json"))
+
+    def respond(self, stream: AsyncIterator[str], usage: StreamUsage, format: StreamConstant.Format | None,
+                start: float) -> StreamingResponse:
+        """
+        Create the streaming response of a generation.
+
+        Args:
+            stream (AsyncIterator): Response chunks.
+            usage (StreamUsage): Usage of the generation.
+            format (StreamConstant.Format): Wire format, defaults to the configured one.
+            start (float): When the request was received, from time.perf_counter.
+
+        Returns:
+            StreamingResponse: The response.
+        """
+        format = StreamConstant.Format(format or settings.format)
+        headers = None
+        if format != StreamConstant.Format.TEXT:
+            headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        return GenerationResponse(content=self.encode(stream, usage, format, start), media_type=MEDIA_TYPES[format],
+                                  headers=headers)
+
+
+stream_encoder = StreamEncoder()
@@ -0,0 +1,339 @@
+"""
+Resilient upstream streams.
+
+A generation is served by a chain of candidates: the requested model, then the
+fallback models of the policy. Every candidate is retried with jittered
+exponential backoff until its first chunk; once a chunk is sent, the stream is
+not restarted, as it would repeat it. Every backend has a circuit breaker that
+skips it while it keeps failing. Optionally, a candidate that is slower than
+usual to send its first chunk is hedged with the next one, and the first to
+answer wins.
+"""
+
+import asyncio
+import math
+import random
+import sys
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from typing import AsyncGenerator, AsyncIterator, Callable, Deque, Dict, List
+
+from core.settings import ResilienceSettings, load_settings
+from exceptions.llm import ServiceUnavailableError
+
+settings: ResilienceSettings = load_settings("ResilienceSettings")
+
+Start = Callable[[], AsyncIterator[str]]
+
+BACKENDS = ("anthropic", "ollama")
+
+
+@dataclass
+class Candidate:
+    """
+    Upstream able to serve a generation.
+
+    Attributes:
+        backend (str): Backend name, e.g. anthropic or ollama.
+        model (str): Model name.
+        start (Callable): Starts the stream.
+    """
+    backend: str
+    model: str
+    start: Start
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Tell if an error is transient, i.e. a connection error, a timeout, a rate
+    limit or a server error. Errors of the configuration, e.g. a backend that is
+    not set up, are not: retrying them only opens the circuit.
+
+    Args:
+        error (Exception): Error of an upstream call.
+
+    Returns:
+        bool: True if the call may succeed when retried.
+    """
+    # ServiceUnavailableError is raised by the Ollama pool when no backend is healthy.
+    if isinstance(error, (asyncio.TimeoutError, ServiceUnavailableError)):
+        return True
+    # The SDKs are only imported once their backend is used, an error cannot come
+    # from one that is not.
+    anthropic, httpx, ollama = (sys.modules.get(name) for name in ("anthropic", "httpx", "ollama"))
+    if httpx is not None and isinstance(error, httpx.TransportError):
+        return True
+    if anthropic is not None:
+        if isinstance(error, (anthropic.APIConnectionError, anthropic.RateLimitError,
+                              anthropic.InternalServerError)):
+            return True
+        if isinstance(error, anthropic.APIStatusError):
+            return error.status_code == 429 or error.status_code >= 500
+    if ollama is not None and isinstance(error, ollama.ResponseError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+
+class CircuitBreaker:
+    def __init__(self, failures: int = settings.breaker_failures, reset_timeout: float = settings.breaker_reset):
+        """
+        Fail fast on a backend that keeps failing. After a number of failures in
+        a row the circuit opens; after the reset timeout one request is let
+        through, and closes the circuit if it succeeds.
+
+        Args:
+            failures (int): Failures in a row that open the circuit.
+            reset_timeout (float): Seconds before a request is let through an open circuit.
+        """
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.count = 0
+        self.opened_at: float | None = None
+        self.probing = False
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def allow(self) -> bool:
+        """
+        Tell if a request may be sent to the backend.
+
+        Returns:
+            bool: True if the circuit is closed, or half open with no probe in progress.
+        """
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def success(self) -> None:
+        self.count = 0
+        self.opened_at = None
+        self.probing = False
+
+    def release(self) -> None:
+        """
+        End a probe that got no answer, e.g. cancelled, so that the next request
+        probes again.
+        """
+        self.probing = False
+
+    def failure(self) -> None:
+        self.count += 1
+        self.probing = False
+        if self.count >= self.failures or self.opened_at is not None:
+            if self.opened_at is None:
+                self.trips += 1
+            self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    def __init__(self, window: int = settings.hedge_window, min_samples: int = settings.hedge_min_samples):
+        """
+        Keep the latest times to first chunk of every backend and model.
+
+        Args:
+            window (int): Number of samples kept.
+            min_samples (int): Samples needed before a percentile is given.
+        """
+        self.min_samples = min_samples
+        self.samples: Dict[tuple[str, str], Deque[float]] = defaultdict(lambda: deque(maxlen=window))
+
+    def observe(self, backend: str, model: str, seconds: float) -> None:
+        self.samples[(backend, str(model))].append(seconds)
+
+    def percentile(self, backend: str, model: str, percentile: float) -> float | None:
+        samples = self.samples.get((backend, str(model)))
+        if samples is None or len(samples) < self.min_samples:
+            return None
+        # Linear interpolation between the closest ranks, as numpy.percentile.
+        ordered = sorted(samples)
+        rank = (len(ordered) - 1) * percentile / 100
+        low = math.floor(rank)
+        high = min(low + 1, len(ordered) - 1)
+        return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+class Resilience:
+    def __init__(self, retries: int = settings.retries, backoff_base: float = settings.backoff_base,
+                 backoff_max: float = settings.backoff_max, first_token_timeout: float = settings.first_token_timeout,
+                 hedge: bool = settings.hedge, hedge_percentile: float = settings.hedge_percentile):
+        """
+        Initialize the resilience policy.
+
+        Args:
+            retries (int): Retries of a candidate before its first chunk.
+            backoff_base (float): Seconds before the first retry, doubled at every retry.
+            backoff_max (float): Maximum seconds between two retries.
+            first_token_timeout (float): Seconds to wait for the first chunk of an attempt.
+            hedge (bool): If True, a slow candidate is hedged with the next one.
+            hedge_percentile (float): Percentile of the time to first chunk past which a candidate is hedged.
+        """
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.first_token_timeout = first_token_timeout
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.breakers: Dict[str, CircuitBreaker] = defaultdict(CircuitBreaker)
+        self.latency = LatencyTracker()
+        self.retried = 0
+        self.hedged = 0
+        self.fallbacks = 0
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Get the delay before a retry, with full jitter.
+
+        Args:
+            attempt (int): Number of the retry, from 0.
+
+        Returns:
+            float: Seconds to wait.
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def _first(self, candidate: Candidate) -> tuple[AsyncIterator[str], str | None]:
+        """
+        Start a candidate and wait for its first chunk.
+
+        Returns:
+            tuple: The stream and its first chunk, None if it sent nothing.
+        """
+        stream = candidate.start()
+        start = time.perf_counter()
+        try:
+            async with asyncio.timeout(self.first_token_timeout):
+                first = await anext(stream)
+        except StopAsyncIteration:
+            first = None
+        except BaseException:
+            await stream.aclose()
+            raise
+        self.latency.observe(candidate.backend, candidate.model, time.perf_counter() - start)
+        return stream, first
+
+    async def _attempt(self, candidate: Candidate) -> tuple[AsyncIterator[str], str | None]:
+        """
+        Start a candidate, retrying until its first chunk.
+
+        Returns:
+            tuple: The stream and its first chunk.
+
+        Raises:
+            Exception: The last error, if every attempt failed or the circuit opened.
+        """
+        breaker = self.breakers[candidate.backend]
+        attempt = 0
+        while True:
+            try:
+                result = await self._first(candidate)
+            except Exception as e:
+                if not is_retryable(e):
+                    # The backend answered, only not with a stream: it is up.
+                    breaker.success()
+                    raise
+                breaker.failure()
+                if attempt >= self.retries or not breaker.allow():
+                    raise
+            except BaseException:
+                # Cancelled, e.g. the client went away or a hedge won: the probe, if any, did not end.
+                breaker.release()
+                raise
+            else:
+                breaker.success()
+                return result
+            await asyncio.sleep(self.backoff(attempt))
+            attempt += 1
+            self.retried += 1
+
+    async def _hedged(self, primary: Candidate,
+                      secondary: Candidate) -> tuple[Candidate, AsyncIterator[str], str | None]:
+        """
+        Start a candidate, and the next one too if the first chunk is late. The
+        first to send a chunk wins, the other is cancelled.
+
+        Returns:
+            tuple: The winning candidate, its stream and its first chunk.
+        """
+        delay = self.latency.percentile(primary.backend, primary.model, self.hedge_percentile)
+        tasks = {asyncio.create_task(self._attempt(primary)): primary}
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done and self.breakers[secondary.backend].allow():
+            self.hedged += 1
+            tasks[asyncio.create_task(self._attempt(secondary))] = secondary
+        winner = None
+        try:
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        stream, first = task.result()
+                        return tasks[task], stream, first
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None:
+                    # The losing stream also started, close it.
+                    await task.result()[0].aclose()
+
+    async def stream(self, candidates: List[Candidate]) -> AsyncGenerator[str, None]:
+        """
+        Stream a generation from the first candidate able to serve it.
+
+        Args:
+            candidates (list): The requested model first, then its fallbacks.
+
+        Yields:
+            str: Response chunks.
+
+        Raises:
+            ServiceUnavailableError: If every candidate is failing.
+            Exception: The error of a candidate, if it is not transient.
+        """
+        errors = []
+        for index, candidate in enumerate(candidates):
+            if not self.breakers[candidate.backend].allow():
+                errors.append(f"{candidate.backend}: circuit open")
+                continue
+            if index:
+                self.fallbacks += 1
+            try:
+                if self.hedge and index + 1 < len(candidates):
+                    _, stream, first = await self._hedged(candidate, candidates[index + 1])
+                else:
+                    stream, first = await self._attempt(candidate)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                errors.append(f"{candidate.backend}/{candidate.model}: {e!r}")
+                continue
+            try:
+                if first is not None:
+                    yield first
+                async for chunk in stream:
+                    yield chunk
+            finally:
+                await stream.aclose()
+            return
+        raise ServiceUnavailableError("Every upstream failed.", detail={"errors": errors},
+                                      retry_after=settings.breaker_reset)
+
+
+resilience = Resilience()
@@ -0,0 +1,224 @@
+"""
+Dynamic batching scheduler for the Ollama backends.
+
+Requests are held for a short window so that compatible ones, i.e. same model
+and options, are dispatched together to the same backend, and to the next one
+once its slots are taken. Every backend runs at most as many requests as it has
+parallel slots, the requests without a free slot wait for one to be released.
+Waiting requests are served by priority class, except for the ones that waited
+longer than the maximum queue delay, which go first. A batch goes to the backend
+that last ran the prompt prefix of its first request while that one has a free
+slot, see OllamaBackendPool.affine. Until the scheduler is started, requests go
+straight to the backend pool.
+"""
+
+import asyncio
+import json
+import time
+from collections import defaultdict
+from contextlib import aclosing
+from typing import Any, AsyncGenerator, Dict, List
+
+from api.schemas.llm import AnthropicConstant, SchedulerConstant
+from core.settings import load_settings, OllamaSettings, SchedulerSettings
+from depends.llm_client import OllamaBackend, OllamaBackendPool, ollama_client
+from exceptions.llm import ServiceUnavailableError
+
+settings: SchedulerSettings = load_settings("SchedulerSettings")
+ollama_settings: OllamaSettings = load_settings("OllamaSettings")
+
+PRIORITIES = list(SchedulerConstant.Priority)
+
+
+class Ticket:
+    def __init__(self, model: str, options: Dict[str, Any] | None, priority: SchedulerConstant.Priority,
+                 prefix: str | None = None):
+        """
+        Initialize a request waiting for a backend slot.
+
+        Args:
+            model (str): Model name.
+            options (dict): Ollama model options.
+            priority (SchedulerConstant.Priority): Priority class.
+            prefix (str): Key of the prompt prefix, see OllamaBackendPool.prefix_key.
+        """
+        self.model = model
+        self.prefix = prefix
+        self.group = (str(model), json.dumps(options or {}, sort_keys=True))
+        self.rank = PRIORITIES.index(priority)
+        self.enqueued_at = time.monotonic()
+        self.future: asyncio.Future[OllamaBackend] = asyncio.get_running_loop().create_future()
+
+
+class BatchScheduler:
+    def __init__(self, pool: OllamaBackendPool, enabled: bool = settings.enabled,
+                 window: float = settings.window,
+                 max_queue_delay: float = settings.max_queue_delay,
+                 parallel_slots: int = settings.parallel_slots, max_batch: int = settings.max_batch):
+        """
+        Initialize the scheduler.
+
+        Args:
+            pool (OllamaBackendPool): Backends the requests are dispatched to.
+            enabled (bool): If False, the scheduler never starts.
+            window (float): Seconds requests are held to be grouped.
+            max_queue_delay (float): Seconds after which a request goes first.
+            parallel_slots (int): Concurrent requests per backend.
+            max_batch (int): Maximum number of requests dispatched together.
+        """
+        self.pool = pool
+        self.enabled = enabled
+        self.window = window
+        self.max_queue_delay = max_queue_delay
+        self.parallel_slots = parallel_slots
+        self.max_batch = max_batch
+
+        self.pending: List[Ticket] = []
+        self.granted: dict[OllamaBackend, int] = defaultdict(int)
+        # Set when a request arrives or a slot is released.
+        self.wake = asyncio.Event()
+        self.arrived = False
+        self.task: asyncio.Task = None
+
+    to_chat_messages = staticmethod(OllamaBackendPool.to_chat_messages)
+
+    async def embed(self, text: str, model: str) -> List[float]:
+        return await self.pool.embed(text, model=model)
+
+    def start(self) -> None:
+        """
+        Start dispatching requests.
+        """
+        if self.enabled and not self.task:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def next_batch(self) -> List[Ticket]:
+        """
+        Take the most urgent request and the compatible ones waiting behind it.
+
+        Returns:
+            list: The requests, in dispatch order.
+        """
+        now = time.monotonic()
+        self.pending.sort(key=lambda ticket: (now - ticket.enqueued_at < self.max_queue_delay,
+                                              ticket.rank, ticket.enqueued_at))
+        group = self.pending[0].group
+        batch = [ticket for ticket in self.pending if ticket.group == group][:self.max_batch]
+        self.pending = [ticket for ticket in self.pending if ticket not in batch]
+        return batch
+
+    def assign(self, batch: List[Ticket]) -> List[Ticket]:
+        """
+        Grant the requests of a batch a slot on a single backend: the one that
+        last ran the prompt prefix of the first request, or else the one with the
+        most free slots. Once its slots are taken, the rest of the batch goes to
+        the next backend with free slots.
+
+        Args:
+            batch (list): Compatible requests, in dispatch order.
+
+        Returns:
+            list: The requests left without a slot, to dispatch once one is released.
+        """
+        try:
+            candidates = self.pool.candidates(batch[0].model)
+        except ServiceUnavailableError as e:
+            for ticket in batch:
+                ticket.future.set_exception(e)
+            return []
+        free = {backend: self.parallel_slots - self.granted[backend] for backend in candidates}
+        target = None
+        for index, ticket in enumerate(batch):
+            if target is None or not free[target]:
+                available = [backend for backend in candidates if free[backend]]
+                if not available:
+                    return batch[index:]
+                target = (self.pool.affine(ticket.prefix, available,
+                                           {backend: self.granted[backend] for backend in available})
+                          or max(available, key=lambda backend: (free[backend], -backend.latency)))
+            self.granted[target] += 1
+            free[target] -= 1
+            ticket.future.set_result(target)
+        return []
+
+    def dispatch(self) -> None:
+        """
+        Dispatch the waiting requests, batch by batch in order of urgency. A batch
+        whose backends are all busy keeps waiting without holding back the
+        batches behind it, e.g. of another model.
+        """
+        waiting = []
+        while self.pending:
+            # The client of a request may have gone away while it waited.
+            batch = [ticket for ticket in self.next_batch() if not ticket.future.done()]
+            if batch:
+                waiting += self.assign(batch)
+        self.pending = waiting
+
+    async def release(self, backend: OllamaBackend) -> None:
+        self.granted[backend] -= 1
+        self.wake.set()
+
+    async def run(self) -> None:
+        while True:
+            await self.wake.wait()
+            self.wake.clear()
+            if self.arrived:
+                # Hold new requests for the window, so that compatible ones are grouped.
+                self.arrived = False
+                await asyncio.sleep(self.window)
+            self.dispatch()
+
+    async def create_stream(self, model: AnthropicConstant.Model = ollama_settings.model,
+                            priority: SchedulerConstant.Priority = SchedulerConstant.Priority.INTERACTIVE,
+                            options: Dict[str, Any] | None = None,
+                            **kwargs) -> AsyncGenerator[str, None]:
+        """
+        Create stream message on Ollama once the scheduler dispatched the request.
+
+        Args:
+            model (str): Model name.
+            priority (SchedulerConstant.Priority): Priority class.
+            options (dict): Other Ollama model options.
+            **kwargs: See OllamaClient.create_stream.
+
+        Yields:
+            str: Ollama streaming responses.
+        """
+        if not self.task:
+            async with aclosing(self.pool.create_stream(model=model, options=options, **kwargs)) as stream:
+                async for chunk in stream:
+                    yield chunk
+            return
+
+        prefix = self.pool.prefix_key(model, kwargs.get("system"), kwargs.get("messages"))
+        ticket = Ticket(model, options, priority, prefix)
+        self.pending.append(ticket)
+        self.arrived = True
+        self.wake.set()
+        try:
+            backend = await ticket.future
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled() and not ticket.future.exception():
+                # Cancelled right after a slot was granted.
+                await self.release(ticket.future.result())
+            raise
+        try:
+            async with aclosing(self.pool.create_stream(model=model, backend=backend, prefix=prefix,
+                                                        options=options, **kwargs)) as stream:
+                async for chunk in stream:
+                    yield chunk
+        finally:
+            await self.release(backend)
+
+
+ollama_scheduler = BatchScheduler(ollama_client)
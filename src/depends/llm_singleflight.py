@@ -0,0 +1,116 @@
+"""
+Request coalescing for the LLM clients.
+
+Identical requests in flight share a single upstream stream. The first request
+starts it, the next ones replay what was already generated and then follow it
+live, and get the usage of its generation once it ends.
+"""
+
+import asyncio
+from typing import AsyncGenerator, AsyncIterator, Callable, List
+
+from api.schemas.llm import StreamUsage
+from exceptions.llm import ServiceUnavailableError
+
+# Measured by every request on its own response, rather than shared.
+TIMINGS = {"ttft", "latency"}
+
+
+class Flight:
+    def __init__(self, upstream: AsyncIterator[str], usage: StreamUsage | None = None):
+        """
+        Start pumping an upstream stream into a shared buffer.
+
+        Args:
+            upstream (AsyncIterator): Upstream stream.
+            usage (StreamUsage): Filled by the upstream stream once it ends.
+        """
+        self.chunks: List[str] = []
+        self.usage = usage
+        self.done = False
+        self.error: Exception | None = None
+        self.subscribers = 0
+        self.condition = asyncio.Condition()
+        self.task = asyncio.create_task(self._pump(upstream))
+
+    async def _pump(self, upstream: AsyncIterator[str]) -> None:
+        try:
+            async for chunk in upstream:
+                async with self.condition:
+                    self.chunks.append(chunk)
+                    self.condition.notify_all()
+        except Exception as e:
+            self.error = e
+        except asyncio.CancelledError:
+            # The subscribers left must not take the cut off reply as complete, nor cache it.
+            self.error = ServiceUnavailableError("The shared generation was cancelled.")
+            raise
+        finally:
+            self.done = True
+            async with self.condition:
+                self.condition.notify_all()
+
+    async def subscribe(self) -> AsyncGenerator[str, None]:
+        """
+        Stream the buffered chunks, then the live ones.
+
+        Yields:
+            str: Response chunks.
+
+        Raises:
+            Exception: The error of the upstream stream, if any.
+        """
+        index = 0
+        while True:
+            async with self.condition:
+                await self.condition.wait_for(lambda: index < len(self.chunks) or self.done)
+                chunks = self.chunks[index:]
+            for chunk in chunks:
+                yield chunk
+            index += len(chunks)
+            if self.done and index == len(self.chunks):
+                break
+        if self.error is not None:
+            raise self.error
+
+
+class SingleFlight:
+    def __init__(self):
+        self.flights: dict[str, Flight] = {}
+
+    async def stream(self, key: str, upstream: Callable[[], AsyncIterator[str]],
+                     usage: StreamUsage | None = None) -> AsyncGenerator[str, None]:
+        """
+        Stream a response, sharing the upstream stream of an identical request in
+        flight. The buffer is freed once its last subscriber is done, and the
+        upstream stream is cancelled if they all left before it ended.
+
+        Args:
+            key (str): Request key, see depends.llm_cache.cache_key.
+            upstream (Callable): Starts the upstream stream.
+            usage (StreamUsage): Filled by the upstream stream of this request if
+                it starts one, else with the usage of the one it shares once it ends.
+
+        Yields:
+            str: Response chunks.
+        """
+        flight = self.flights.get(key)
+        if flight is None or flight.error is not None:
+            flight = self.flights[key] = Flight(upstream(), usage)
+        flight.subscribers += 1
+        try:
+            async for chunk in flight.subscribe():
+                yield chunk
+            if usage is not None and flight.usage is not None and usage is not flight.usage:
+                for field, value in flight.usage.model_dump(exclude=TIMINGS).items():
+                    setattr(usage, field, value)
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+                if not flight.task.done():
+                    flight.task.cancel()
+
+    def __len__(self) -> int:
+        return len(self.flights)
@@ -0,0 +1,174 @@
+"""
+Conversation transcripts.
+
+Completed turns are buffered in memory and written by a background task in
+batched multi-row inserts, so that saving a transcript adds no database round
+trip to a stream. The buffer is bounded: when the database falls behind, new
+turns are dropped rather than held. Turns still buffered are merged into the
+history, so a follow-up sent before the next flush sees them.
+"""
+
+import asyncio
+import json
+from contextlib import aclosing
+from datetime import datetime, timezone
+from typing import Any, AsyncGenerator, AsyncIterator, Dict, List
+from uuid import UUID
+
+from sqlalchemy import insert
+from sqlalchemy.exc import SQLAlchemyError
+
+from api.schemas.llm import StreamUsage
+from core.settings import ConversationSettings, load_settings
+from database.models import Conversation, ConversationMessage
+from database.session import get_db_session
+from exceptions.llm import NotFoundError
+
+settings: ConversationSettings = load_settings("ConversationSettings")
+
+
+class TranscriptWriter:
+    def __init__(self, max_pending: int = settings.max_pending, batch_size: int = settings.batch_size,
+                 flush_interval: float = settings.flush_interval):
+        """
+        Write conversation turns in batches, off the request path.
+
+        Args:
+            max_pending (int): Maximum number of messages waiting to be written.
+            batch_size (int): Maximum number of messages per insert.
+            flush_interval (float): Seconds between two writes.
+        """
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending: List[ConversationMessage] = []
+        self.flushing: List[ConversationMessage] = []
+        self.full = asyncio.Event()
+        self.task: asyncio.Task | None = None
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def record(self, conversation_id: UUID, messages: List[Dict[str, Any]], reply: str, tokens: int,
+               created_at: datetime) -> None:
+        """
+        Buffer a completed turn.
+
+        Args:
+            conversation_id (UUID): Conversation ID.
+            messages (list): Messages sent by the client for this turn.
+            reply (str): Generated reply.
+            tokens (int): Output tokens of the reply, or its chunks when the backend reported none.
+            created_at (datetime): When the request was received.
+        """
+        if len(self.pending) + len(messages) + 1 > self.max_pending:
+            self.dropped += len(messages) + 1
+            return
+        for position, message in enumerate(messages):
+            self.pending.append(ConversationMessage(
+                conversation_id=conversation_id, position=position, role=message["role"],
+                content=json.dumps(message["content"]), created_at=created_at, updated_at=created_at,
+            ))
+        self.pending.append(ConversationMessage(
+            conversation_id=conversation_id, role="assistant", content=json.dumps(reply), tokens=tokens,
+        ))
+        if len(self.pending) >= self.batch_size:
+            self.full.set()
+
+    async def transcribe(self, conversation_id: UUID, messages: List[Dict[str, Any]],
+                         stream: AsyncIterator[str], usage: StreamUsage | None = None) -> AsyncGenerator[str, None]:
+        """
+        Relay a stream and record the turn once it completed. A failed or
+        cancelled stream is not recorded.
+
+        Args:
+            conversation_id (UUID): Conversation ID.
+            messages (list): Messages sent by the client for this turn.
+            stream (AsyncIterator): Reply stream.
+            usage (StreamUsage): Usage of the generation, filled once the stream ends.
+
+        Yields:
+            str: The chunks of the stream.
+        """
+        created_at = datetime.now(timezone.utc)
+        chunks = []
+        async with aclosing(stream):
+            async for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+        tokens = usage.output_tokens if usage is not None and usage.output_tokens is not None else len(chunks)
+        self.record(conversation_id, messages, "".join(chunks), tokens, created_at)
+
+    async def history(self, conversation_id: UUID,
+                      limit: int | None = settings.history_limit) -> List[Dict[str, Any]]:
+        """
+        Get the messages of a conversation, including the turns not written yet.
+
+        Args:
+            conversation_id (UUID): Conversation ID.
+            limit (int): Maximum number of messages, the latest ones are kept.
+
+        Returns:
+            list: Messages as dictionaries, oldest first.
+
+        Raises:
+            NotFoundError: If the conversation does not exist.
+        """
+        async with get_db_session() as session:
+            stored = await Conversation.get_history(conversation_id, session, limit=limit)
+        if stored is None:
+            raise NotFoundError(f"Conversation {conversation_id} not found.")
+        # A batch written while the history was read may be both stored and buffered.
+        ids = {message.id for message in stored}
+        buffered = [message for message in self.flushing + self.pending
+                    if message.conversation_id == conversation_id and message.id not in ids]
+        messages = (stored + buffered)[-limit:] if limit else stored + buffered
+        return [{"role": message.role, "content": json.loads(message.content)} for message in messages]
+
+    async def flush(self) -> None:
+        """
+        Write the buffered messages.
+        """
+        while self.pending:
+            self.flushing, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+            try:
+                async with get_db_session() as session:
+                    await session.execute(insert(ConversationMessage),
+                                          [message.model_dump() for message in self.flushing])
+                self.written += len(self.flushing)
+            except asyncio.CancelledError:
+                self.pending = self.flushing + self.pending
+                raise
+            except SQLAlchemyError:
+                self.failed += len(self.flushing)
+            finally:
+                self.flushing = []
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.full.clear()
+            await self.flush()
+
+    def start(self) -> None:
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        """
+        Stop the background task and write what is left.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+
+
+transcripts = TranscriptWriter()
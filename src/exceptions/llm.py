@@ -1,3 +1,4 @@
+import math
 import sys
 from http import HTTPStatus
 from typing import Dict
@@ -6,6 +7,7 @@ from typing import Dict
 class Error(Exception):
     message: str = "Unexpected error occurred."
     status_code: HTTPStatus = HTTPStatus.INTERNAL_SERVER_ERROR
+    headers: Dict[str, str] | None = None
 
     def __init__(self, message: str = None, *, detail: Dict = None, caught_exception: Exception = None) -> None:
         if message is not None:
@@ -29,4 +31,46 @@ class HTTPError(Error):
 class ServiceError(HTTPError):
     """Exception raised from service calls"""
     status_code: HTTPStatus = HTTPStatus.INTERNAL_SERVER_ERROR
-    message = "Service Error"
\ No newline at end of file
+    message = "Service Error"
+
+class NotFoundError(HTTPError):
+    """Exception raised when a requested resource does not exist"""
+    status_code: HTTPStatus = HTTPStatus.NOT_FOUND
+    message = "Not Found"
+
+class InvalidRequestError(HTTPError):
+    """Exception raised when a request body cannot be parsed"""
+    status_code: HTTPStatus = HTTPStatus.UNPROCESSABLE_ENTITY
+    message = "Invalid Request"
+
+class ContextLengthError(HTTPError):
+    """Exception raised when a request does not fit the context window of the model"""
+    status_code: HTTPStatus = HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+    message = "Context Length Exceeded"
+
+class RetryableError(HTTPError):
+    """Exception raised when a request may be retried later"""
+
+    def __init__(self, message: str = None, *, retry_after: float = 1, **kwargs) -> None:
+        super().__init__(message, **kwargs)
+        self.headers = {"Retry-After": str(max(1, math.ceil(retry_after)))}
+
+class TooManyRequestsError(RetryableError):
+    """Exception raised when a client is over its rate limit"""
+    status_code: HTTPStatus = HTTPStatus.TOO_MANY_REQUESTS
+    message = "Too Many Requests"
+
+class ServiceUnavailableError(RetryableError):
+    """Exception raised when the service is overloaded"""
+    status_code: HTTPStatus = HTTPStatus.SERVICE_UNAVAILABLE
+    message = "Service Unavailable"
+
+class QueueFullError(ServiceUnavailableError):
+    """Exception raised when the broker refused a job as its queue is full"""
+    message = "Queue Full"
+
+class ClientDisconnectedError(HTTPError):
+    """Exception raised when the client went away before the response started"""
+    # Client Closed Request, as nginx logs it. Nobody receives the response.
+    status_code = 499
+    message = "Client Disconnected"
@@ -1,9 +1,14 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST
 
 from api.routers.llm import router as llm_router
+from core.lifespan import lifespan
+from core.metrics import exposition
+from exceptions.llm import Error
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 
 origins = ["*"]
@@ -15,9 +20,18 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.exception_handler(Error)
+async def error_handler(request: Request, exc: Error) -> JSONResponse:
+    return JSONResponse(status_code=exc.status_code, content=exc.dict(), headers=exc.headers)
+
 @app.get("/")
 def read_root():
     return {"message": "Welcome to LLM Chat Backend"}
 
 
+@app.get("/metrics", include_in_schema=False)
+def metrics() -> Response:
+    return Response(content=exposition(), media_type=CONTENT_TYPE_LATEST)
+
+
 app.include_router(llm_router)
\ No newline at end of file
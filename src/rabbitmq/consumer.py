@@ -3,28 +3,137 @@ Consumer for RabbitMQ.
 """
 
 import asyncio
+import traceback
+from functools import partial
+from typing import Awaitable, Callable, List
 
-from aio_pika import connect, IncomingMessage, Connection
+from aio_pika import connect_robust, Channel, IncomingMessage, Connection, Exchange, Message, Queue
+from aio_pika.exceptions import DeliveryError
+
+from core.metrics import QUEUE_RETRIES
+from rabbitmq.queues import RETRIES_HEADER, declare_queue, remaining
+
+MessageHandler = Callable[[IncomingMessage], Awaitable[None]]
 
 class RabbitMQClient:
-    def __init__(self, amqp_url: str):
+    def __init__(self, amqp_url: str, handler: MessageHandler | None = None,
+                 consumers: int = 1, prefetch_count: int = 1, max_retries: int = 0):
+        """
+        Initialize the consumer.
+
+        Args:
+            amqp_url (str): AMQP connection URL.
+            handler (MessageHandler): Coroutine called with every message.
+            consumers (int): Number of channels consuming the queue.
+            prefetch_count (int): Unacknowledged messages each channel may hold.
+            max_retries (int): Times a message whose handler raised is queued again
+                before it is rejected.
+        """
         self.amqp_url = amqp_url
+        self.handler = handler
+        self.consumers = consumers
+        self.prefetch_count = prefetch_count
+        self.max_retries = max_retries
         self.connection: Connection = None
+        self.retry_channel: Channel = None
         self.consume_task: asyncio.Task = None
+        self.consumer_tags: List[tuple[Queue, str]] = []
+        self.active = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
 
     async def connect(self):
         if not self.connection:
-            self.connection = await connect(self.amqp_url)
+            self.connection = await connect_robust(self.amqp_url)
+
+    async def on_message(self, exchange: Exchange, queue_name: str, message: IncomingMessage) -> None:
+        """
+        Process a message. The message is acknowledged once the handler returns.
+        If the handler raises, the message is published again at the back of the
+        queue, up to max_retries times, then rejected without requeue, which
+        dead-letters it on the job queues. A poison message therefore costs a
+        few attempts rather than blocking a consumer. The copy is published with
+        a confirmation, and the message acknowledged only once the broker took
+        it: a copy refused, e.g. by a full queue, dead-letters the message.
+        """
+        self.active += 1
+        self.idle.clear()
+        try:
+            async with message.process(requeue=False):
+                assert message.body
+                if self.handler:
+                    try:
+                        await self.handler(message)
+                    except Exception:
+                        retries = int((message.headers or {}).get(RETRIES_HEADER, 0))
+                        if retries >= self.max_retries:
+                            raise
+                        traceback.print_exc()
+                        try:
+                            await exchange.publish(self.retry_message(message, retries + 1), routing_key=queue_name)
+                        except DeliveryError:
+                            print(f"Retry refused by the queue {queue_name}, the message is dead-lettered")
+                            raise
+                        QUEUE_RETRIES.labels(queue_name).inc()
+        finally:
+            self.active -= 1
+            if not self.active:
+                self.idle.set()
+
+    @staticmethod
+    def retry_message(message: IncomingMessage, retries: int) -> Message:
+        """
+        Copy a message to publish it again. The copy keeps the deadline of the
+        message, rather than its whole time to live.
 
-    async def on_message(self, message: IncomingMessage) -> None:
-        async with message.process():
-            assert message.body
+        Args:
+            message (IncomingMessage): The message.
+            retries (int): Number of the retry.
+
+        Returns:
+            Message: The copy.
+        """
+        left = remaining(message)
+        return Message(message.body, headers={**(message.headers or {}), RETRIES_HEADER: retries},
+                       content_type=message.content_type, delivery_mode=message.delivery_mode,
+                       priority=message.priority, message_id=message.message_id,
+                       expiration=max(left, 0.001) if left is not None else None)
 
     async def consume(self, queue_name: str):
+        """
+        Start the consumers. Each one gets its own channel so that the prefetch
+        window, and therefore the number of concurrent messages, is per consumer.
+        The queue is declared with its arguments, see rabbitmq.queues.
+        """
         await self.connect()
-        channel = await self.connection.channel()
-        queue = await channel.declare_queue(queue_name)
-        await queue.consume(self.on_message, no_ack=False)        
+        if not self.retry_channel:
+            self.retry_channel = await self.connection.channel(publisher_confirms=True)
+        for _ in range(self.consumers):
+            channel = await self.connection.channel()
+            await channel.set_qos(prefetch_count=self.prefetch_count)
+            queue = await declare_queue(channel, queue_name)
+            handler = partial(self.on_message, self.retry_channel.default_exchange, queue_name)
+            self.consumer_tags.append((queue, await queue.consume(handler, no_ack=False)))
+
+    async def drain(self, timeout: float) -> bool:
+        """
+        Stop consuming, then wait for the messages being processed. The ones
+        still unacknowledged when the connection closes are requeued by the broker.
+
+        Args:
+            timeout (float): Seconds to wait for the messages being processed.
+
+        Returns:
+            bool: True if every message was processed in time.
+        """
+        for queue, consumer_tag in self.consumer_tags:
+            await queue.cancel(consumer_tag)
+        self.consumer_tags.clear()
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
 
     async def start_consume(self, queue_name: str):
         self.consume_task = asyncio.create_task(self.consume(queue_name))
@@ -39,4 +148,4 @@ class RabbitMQClient:
             except Exception as unexpected_exception:
                 print("Unexpected exception has occurred")
         if self.connection:
-            await self.connection.close()
\ No newline at end of file
+            await self.connection.close()
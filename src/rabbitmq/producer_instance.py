@@ -1,6 +1,9 @@
+import os
+
 from rabbitmq.producer import RabbitMQProducer
 
 producer_instance = RabbitMQProducer()
+os.register_at_fork(after_in_child=producer_instance.forget)
 
 def get_producer() -> RabbitMQProducer:
     return producer_instance
\ No newline at end of file
@@ -0,0 +1,107 @@
+"""
+Declaration of the job queues.
+
+The job queues are priority queues, so that interactive jobs overtake the bulk
+ones, whose rejected and expired messages go to a dead-letter exchange. The Ollama
+queue is also bounded in length: once full, the broker refuses new jobs, and the
+API sheds them. The broker refuses to redeclare a queue with other arguments, so
+the producer and the consumers declare them with the same ones, from here.
+
+The job streams are deleted by the broker too: a message naming the stream waits
+out the stream TTL in a queue nobody consumes, and is then dead-lettered to a
+queue the workers consume to delete it, see JobStream.expire.
+"""
+
+import time
+from typing import Any, Dict
+
+from aio_pika import Channel, ExchangeType, Queue
+from aio_pika.abc import AbstractMessage
+
+from api.schemas.llm import SchedulerConstant
+from core.settings import load_settings, RabbitMQSettings
+
+settings: RabbitMQSettings = load_settings("RabbitMQSettings")
+
+# Epoch time after which the job of a message is no longer wanted.
+DEADLINE_HEADER = "x-deadline"
+# Number of times a message was published again after its handler failed.
+RETRIES_HEADER = "x-retries"
+
+
+def queue_arguments(queue_name: str) -> Dict[str, Any]:
+    """
+    Get the arguments a job queue is declared with.
+
+    Args:
+        queue_name (str): Queue name.
+
+    Returns:
+        dict: The queue arguments, empty for queues that are not job queues.
+    """
+    if queue_name == settings.stream_expiry_queue:
+        # Through the default exchange, straight to the queue of expired streams.
+        return {"x-dead-letter-exchange": "", "x-dead-letter-routing-key": settings.stream_expired_queue}
+    if queue_name not in (settings.ollama_queue, settings.batch_queue):
+        return {}
+    arguments: Dict[str, Any] = {"x-dead-letter-exchange": settings.dead_letter_exchange}
+    if settings.max_priority:
+        arguments["x-max-priority"] = settings.max_priority
+    if queue_name == settings.ollama_queue and settings.max_queue_length:
+        arguments["x-max-length"] = settings.max_queue_length
+        arguments["x-overflow"] = "reject-publish"
+    return arguments
+
+
+async def declare_queue(channel: Channel, queue_name: str) -> Queue:
+    """
+    Declare a durable queue with its arguments. The dead-letter exchange of a
+    queue is declared first, with the queue it routes to, as the broker drops
+    the messages dead-lettered to an exchange or a queue that does not exist.
+
+    Args:
+        channel (Channel): Channel to declare on.
+        queue_name (str): Queue name.
+
+    Returns:
+        Queue: The queue.
+    """
+    arguments = queue_arguments(queue_name)
+    if "x-dead-letter-routing-key" in arguments:
+        await channel.declare_queue(arguments["x-dead-letter-routing-key"], durable=True)
+    elif "x-dead-letter-exchange" in arguments:
+        exchange = await channel.declare_exchange(settings.dead_letter_exchange, ExchangeType.FANOUT, durable=True)
+        dead_letter_queue = await channel.declare_queue(settings.dead_letter_queue, durable=True)
+        await dead_letter_queue.bind(exchange)
+    return await channel.declare_queue(queue_name, durable=True, arguments=arguments or None)
+
+
+def message_priority(priority: SchedulerConstant.Priority) -> int:
+    """
+    Get the AMQP priority of a scheduling priority class.
+
+    Args:
+        priority (SchedulerConstant.Priority): Priority class.
+
+    Returns:
+        int: The message priority, from 0 to max_priority.
+    """
+    if priority == SchedulerConstant.Priority.INTERACTIVE:
+        return settings.max_priority
+    if priority == SchedulerConstant.Priority.NORMAL:
+        return settings.max_priority // 2
+    return 0
+
+
+def remaining(message: AbstractMessage) -> float | None:
+    """
+    Get the seconds left before the deadline of a message.
+
+    Args:
+        message (AbstractMessage): The message.
+
+    Returns:
+        float: Seconds left, negative once past, None if the message has no deadline.
+    """
+    deadline = (message.headers or {}).get(DEADLINE_HEADER)
+    return None if deadline is None else float(deadline) - time.time()
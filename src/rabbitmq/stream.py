@@ -0,0 +1,132 @@
+"""
+Per-job RabbitMQ streams.
+
+Workers publish every chunk of a generation on a stream dedicated to the job,
+and the API relays it to HTTP clients. Streams keep their messages after they
+are read, so a client that disconnects can attach again from the offset of the
+last chunk it received. Once the job ends, the broker deletes its stream after
+the stream TTL, see rabbitmq.queues.
+"""
+
+from typing import AsyncGenerator
+from uuid import UUID
+
+from aio_pika import Channel, Message, DeliveryMode
+from aio_pika.exceptions import ChannelNotFoundEntity
+
+from api.schemas.llm import JobConstant
+from core.settings import load_settings, RabbitMQSettings
+from rabbitmq.queues import declare_queue
+
+settings: RabbitMQSettings = load_settings("RabbitMQSettings")
+
+
+class JobStream:
+    def __init__(self, channel: Channel, job_id: UUID):
+        """
+        Initialize a job stream.
+
+        Args:
+            channel (Channel): Channel used to declare, publish and read the stream.
+            job_id (UUID): Job ID.
+        """
+        self.channel = channel
+        self.job_id = job_id
+        self.name = f"{settings.stream_prefix}{job_id}"
+
+    async def declare(self, passive: bool = False):
+        """
+        Declare the stream queue.
+
+        Args:
+            passive (bool): If True, only check that the stream exists.
+
+        Raises:
+            ChannelNotFoundEntity: If passive and the stream does not exist.
+        """
+        return await self.channel.declare_queue(
+            self.name, durable=True, passive=passive,
+            arguments=None if passive else {"x-queue-type": "stream",
+                                            "x-max-age": settings.stream_max_age},
+        )
+
+    async def exists(self) -> bool:
+        """
+        Check whether the stream exists. The broker closes the channel when it
+        does not, so the check should be done on a channel of its own.
+
+        Returns:
+            bool: True if the stream exists.
+        """
+        try:
+            await self.declare(passive=True)
+            return True
+        except ChannelNotFoundEntity:
+            return False
+
+    async def publish(self, event: JobConstant.Event, data: str = "") -> None:
+        """
+        Publish an event on the stream.
+
+        Args:
+            event (JobConstant.Event): Event type.
+            data (str): Event data, e.g. the text of a chunk.
+        """
+        await self.channel.default_exchange.publish(
+            Message(data.encode(), delivery_mode=DeliveryMode.PERSISTENT,
+                    headers={"event": event.value}),
+            routing_key=self.name,
+        )
+
+    async def read(self, offset: int = 0) -> AsyncGenerator[tuple[int, JobConstant.Event, str], None]:
+        """
+        Read the stream from an offset until the job is done or failed.
+
+        Args:
+            offset (int): Offset of the first event to read.
+
+        Yields:
+            tuple: The offset, type and data of every event.
+        """
+        await self.channel.set_qos(prefetch_count=settings.stream_prefetch_count)
+        queue = await self.declare()
+        async with queue.iterator(arguments={"x-stream-offset": offset}) as iterator:
+            async for message in iterator:
+                await message.ack()
+                event = JobConstant.Event(message.headers["event"])
+                yield message.headers["x-stream-offset"], event, message.body.decode()
+                if event != JobConstant.Event.CHUNK:
+                    return
+
+    async def expire(self) -> None:
+        """
+        Have the stream deleted after the stream TTL, once clients had the time to
+        read it. The deletion is scheduled on the broker, so it happens even if
+        this process is gone by then: the name of the stream is published with the
+        TTL as expiration on a queue nobody consumes, which dead-letters it to the
+        queue of expired streams once the TTL is over, see rabbitmq.worker.delete_stream.
+        """
+        await declare_queue(self.channel, settings.stream_expiry_queue)
+        await self.channel.default_exchange.publish(
+            Message(self.name.encode(), delivery_mode=DeliveryMode.PERSISTENT,
+                    expiration=settings.stream_ttl),
+            routing_key=settings.stream_expiry_queue,
+        )
+
+
+def format_sse(id: int | None, event: JobConstant.Event, data: str) -> str:
+    """
+    Format a server-sent event.
+
+    Args:
+        id (int): Event ID, sent back by the client on reconnection, None for no ID.
+        event (JobConstant.Event): Event type.
+        data (str): Event data.
+
+    Returns:
+        str: The event, ready to be written on the response.
+    """
+    lines = "".join(f"data: {line}\n" for line in data.split("\n"))
+    if id is None:
+        return f"event: {event.value}\n{lines}\n"
+    return f"id: {id}\nevent: {event.value}\n{lines}\n"
@@ -0,0 +1,347 @@
+"""
+Worker for the Ollama job queue.
+
+Consumes generation jobs published by the API, runs them against Ollama,
+publishes every chunk on the job stream and stores the result on the job.
+The items of batch requests are consumed from their own queue, a bounded number
+per backend at a time, and their results stored on the items.
+Cancellations are broadcast to every worker on a fanout exchange, and stop the
+generation of the job wherever it runs. A job past its deadline is failed rather
+than run, and a message whose handling keeps failing is retried a few times, then
+dead-lettered: the worker consumes the dead letters to fail their jobs and items,
+so that their clients learn about it. The job streams are deleted once the
+broker expired them, see JobStream.expire. On SIGTERM, the worker stops consuming
+and lets its running jobs finish before it closes its connections; the ones
+still running after the graceful timeout are run again by another worker. Run with:
+
+    python -m rabbitmq.worker
+"""
+
+import asyncio
+import signal
+import time
+from contextlib import aclosing
+from datetime import datetime, timezone
+from typing import Any, Dict, List
+from uuid import UUID
+
+from aio_pika import Channel, ExchangeType, IncomingMessage
+from prometheus_client import start_http_server
+
+from api.schemas.llm import (BatchConstant, BatchItemMessage, BatchItemRequest, JobConstant, JobMessage,
+                             RequestValidationOllama, SchedulerConstant, StreamUsage)
+from core.metrics import CONSUMER_LAG, DEAD_LETTERS, QUEUE_DEPTH, QUEUE_EXPIRED
+from core.settings import BatchSettings, RabbitMQSettings, ServerSettings, load_settings
+from database.models import BatchItem, Job
+from database.session import dispose_engine, get_db_session, init_db, warm_pool
+from depends.llm import LLMService
+from depends.llm_client import start_clients, stop_clients
+from depends.llm_images import image_processor
+from depends.llm_protocol import stream_encoder
+from depends.llm_scheduler import ollama_scheduler
+from depends.llm_transcripts import transcripts
+from rabbitmq.consumer import RabbitMQClient
+from rabbitmq.queues import RETRIES_HEADER, remaining
+from rabbitmq.stream import JobStream
+
+settings: RabbitMQSettings = load_settings("RabbitMQSettings")
+batch_settings: BatchSettings = load_settings("BatchSettings")
+server_settings: ServerSettings = load_settings("ServerSettings")
+
+stream_channel: Channel = None
+
+# Generations in progress, by job ID.
+running: Dict[UUID, asyncio.Task] = {}
+
+# Batch items generated at once by this process, per backend.
+batch_slots: Dict[BatchConstant.Backend, asyncio.Semaphore] = {
+    BatchConstant.Backend.ANTHROPIC: asyncio.Semaphore(batch_settings.anthropic_concurrency),
+    BatchConstant.Backend.OLLAMA: asyncio.Semaphore(batch_settings.ollama_concurrency),
+}
+
+
+async def generate(body: RequestValidationOllama, job_stream: JobStream, usage: StreamUsage,
+                   start: float) -> tuple[List[Dict[str, Any]], List[str], datetime]:
+    """
+    Generate the reply of a job, publishing its chunks on the job stream.
+
+    Args:
+        body (RequestValidationOllama): Request of the job.
+        job_stream (JobStream): Stream of the job.
+        usage (StreamUsage): Filled with the usage of the generation.
+        start (float): When the job started, from time.perf_counter.
+
+    Returns:
+        tuple: The messages of the turn, the chunks of the reply and when the job started.
+    """
+    created_at = datetime.now(timezone.utc)
+    system, turn, messages = await LLMService.prepare_ollama(body)
+    stream = LLMService.upstream(body.model, system, messages, body.temperature, body.num_predict,
+                                 priority=body.priority, keep_alive=body.keep_alive, options=body.options,
+                                 usage=usage)()
+    chunks = []
+    # Coalesced, so that a job publishes a few messages rather than one per token.
+    async with aclosing(stream_encoder.coalesce(stream)) as coalesced:
+        async for chunk in coalesced:
+            if usage.ttft is None:
+                usage.ttft = time.perf_counter() - start
+            chunks.append(chunk)
+            await job_stream.publish(JobConstant.Event.CHUNK, chunk)
+    return turn, chunks, created_at
+
+
+async def fail_job(job_id: UUID, error: str, current: List[JobConstant.Status]) -> None:
+    """
+    Fail a job that will not run, and publish the error on its stream for the
+    clients waiting on it.
+
+    Args:
+        job_id (UUID): Job ID.
+        error (str): Error of the job.
+        current (list): Statuses the job may be in to be failed.
+    """
+    async with get_db_session() as session:
+        if not await Job.set_status(job_id, JobConstant.Status.FAILED, session, current=current, error=error):
+            return
+    job_stream = JobStream(stream_channel, job_id)
+    await job_stream.declare()
+    await job_stream.publish(JobConstant.Event.ERROR, error)
+    await job_stream.expire()
+
+
+async def run_job(message: IncomingMessage) -> None:
+    """
+    Run the generation job carried by a message. A job cancelled while queued
+    is skipped, and a job past its deadline failed: its client gave up on it.
+    A job whose message is delivered again, after its handler failed or its
+    worker went away, is claimed again even though it was left running.
+
+    Args:
+        message (IncomingMessage): Message with a serialized JobMessage body.
+    """
+    if "published_at" in (message.headers or {}):
+        CONSUMER_LAG.labels(settings.ollama_queue).observe(time.time() - message.headers["published_at"])
+
+    job = JobMessage.model_validate_json(message.body)
+    body = job.body
+
+    left = remaining(message)
+    if left is not None and left <= 0:
+        QUEUE_EXPIRED.labels(settings.ollama_queue).inc()
+        await fail_job(job.job_id, "Job expired in the queue.", current=[JobConstant.Status.QUEUED])
+        return
+
+    claimable = [JobConstant.Status.QUEUED]
+    if message.redelivered or RETRIES_HEADER in (message.headers or {}):
+        claimable.append(JobConstant.Status.RUNNING)
+    async with get_db_session() as session:
+        if not await Job.set_status(job.job_id, JobConstant.Status.RUNNING, session, current=claimable):
+            return
+
+    job_stream = JobStream(stream_channel, job.job_id)
+    await job_stream.declare()
+    usage = StreamUsage()
+    start = time.perf_counter()
+    generation = asyncio.create_task(generate(body, job_stream, usage, start))
+    running[job.job_id] = generation
+    try:
+        turn, chunks, created_at = await generation
+    except asyncio.CancelledError:
+        if asyncio.current_task().cancelling():
+            raise
+        # Cancelled by cancel_job, the job status is already set.
+        await job_stream.publish(JobConstant.Event.CANCELLED)
+        return
+    except Exception as e:
+        await job_stream.publish(JobConstant.Event.ERROR, str(e))
+        async with get_db_session() as session:
+            await Job.set_status(job.job_id, JobConstant.Status.FAILED, session,
+                                 current=[JobConstant.Status.RUNNING], error=str(e))
+        return
+    finally:
+        del running[job.job_id]
+        await job_stream.expire()
+
+    if body.conversation_id is not None:
+        transcripts.record(body.conversation_id, turn, "".join(chunks), usage.output_tokens or len(chunks),
+                           created_at)
+    usage.latency = time.perf_counter() - start
+    await job_stream.publish(JobConstant.Event.DONE, usage.model_dump_json())
+    async with get_db_session() as session:
+        await Job.set_status(job.job_id, JobConstant.Status.COMPLETED, session,
+                             current=[JobConstant.Status.RUNNING], result="".join(chunks))
+
+
+async def run_batch_item(message: IncomingMessage) -> None:
+    """
+    Generate the reply of a batch item once a slot of its backend is free. The
+    item is claimed first, so an item queued twice, e.g. after a resume, is
+    generated once, unless its message is delivered again after a failure, see
+    run_job. Ollama items run at the batch priority, behind interactive requests.
+
+    Args:
+        message (IncomingMessage): Message with a serialized BatchItemMessage body.
+    """
+    if "published_at" in (message.headers or {}):
+        CONSUMER_LAG.labels(settings.batch_queue).observe(time.time() - message.headers["published_at"])
+
+    task = BatchItemMessage.model_validate_json(message.body)
+    claimable = [JobConstant.Status.QUEUED]
+    if message.redelivered or RETRIES_HEADER in (message.headers or {}):
+        claimable.append(JobConstant.Status.RUNNING)
+    async with get_db_session() as session:
+        item = await BatchItem.get_by_id(task.item_id, session)
+    if item is None or item.status not in claimable:
+        return
+    request = BatchItemRequest.model_validate_json(item.request)
+    body = request.body
+    if isinstance(body, RequestValidationOllama):
+        body = body.model_copy(update={"priority": SchedulerConstant.Priority.BATCH})
+
+    async with batch_slots[request.backend]:
+        async with get_db_session() as session:
+            if not await BatchItem.set_status(item.id, JobConstant.Status.RUNNING, session, current=claimable):
+                return
+        try:
+            result, usage = await LLMService.complete(body)
+        except Exception as e:
+            async with get_db_session() as session:
+                await BatchItem.set_status(item.id, JobConstant.Status.FAILED, session,
+                                           current=[JobConstant.Status.RUNNING], error=str(e))
+            return
+    async with get_db_session() as session:
+        await BatchItem.set_status(item.id, JobConstant.Status.COMPLETED, session,
+                                   current=[JobConstant.Status.RUNNING], result=result,
+                                   usage=usage.model_dump_json(exclude_none=True))
+
+
+async def dead_letter(message: IncomingMessage) -> None:
+    """
+    Fail the job or batch item of a dead-lettered message, i.e. a message
+    expired in its queue or rejected after its retries.
+
+    Args:
+        message (IncomingMessage): Message dead-lettered from a job queue.
+    """
+    headers = message.headers or {}
+    death = (headers.get("x-death") or [{}])[0]
+    queue = headers.get("x-first-death-queue", death.get("queue"))
+    reason = headers.get("x-first-death-reason", death.get("reason"))
+    DEAD_LETTERS.labels(queue, reason).inc()
+    error = "expired in the queue" if reason == "expired" else f"failed after {settings.max_retries} retries"
+
+    if queue == settings.ollama_queue:
+        job = JobMessage.model_validate_json(message.body)
+        await fail_job(job.job_id, f"Job {error}.",
+                       current=[JobConstant.Status.QUEUED, JobConstant.Status.RUNNING])
+    elif queue == settings.batch_queue:
+        task = BatchItemMessage.model_validate_json(message.body)
+        async with get_db_session() as session:
+            await BatchItem.set_status(task.item_id, JobConstant.Status.FAILED, session,
+                                       current=[JobConstant.Status.QUEUED, JobConstant.Status.RUNNING],
+                                       error=f"Item {error}.")
+
+
+async def delete_stream(message: IncomingMessage) -> None:
+    """
+    Delete a job stream whose TTL is over.
+
+    Args:
+        message (IncomingMessage): Message dead-lettered from the stream expiry queue, with the stream name as body.
+    """
+    await stream_channel.queue_delete(message.body.decode())
+
+
+async def cancel_job(message: IncomingMessage) -> None:
+    """
+    Cancel the generation of a job, if this worker runs it.
+
+    Args:
+        message (IncomingMessage): Message with the job ID as body.
+    """
+    async with message.process():
+        generation = running.get(UUID(message.body.decode()))
+        if generation is not None:
+            generation.cancel()
+
+
+async def sample_queue_depth(channel: Channel) -> None:
+    """
+    Sample the number of jobs waiting in the queue, and of dead letters, for the metrics.
+
+    Args:
+        channel (Channel): Channel used to check the queues.
+    """
+    while True:
+        for queue_name in (settings.ollama_queue, settings.dead_letter_queue):
+            queue = await channel.declare_queue(queue_name, passive=True)
+            QUEUE_DEPTH.labels(queue_name).set(queue.declaration_result.message_count)
+        await asyncio.sleep(settings.metrics_interval)
+
+
+async def main() -> None:
+    global stream_channel
+
+    await init_db()
+    await warm_pool()
+    client = RabbitMQClient(settings.url, handler=run_job,
+                            consumers=settings.consumers,
+                            prefetch_count=settings.prefetch_count,
+                            max_retries=settings.max_retries)
+    await client.connect()
+    stream_channel = await client.connection.channel()
+    await client.consume(settings.ollama_queue)
+    # The slots bound the batch items generated at once, the prefetch only
+    # keeps enough of them at hand to fill the slots.
+    batch_client = RabbitMQClient(settings.url, handler=run_batch_item, consumers=1,
+                                  prefetch_count=batch_settings.anthropic_concurrency
+                                  + batch_settings.ollama_concurrency,
+                                  max_retries=settings.max_retries)
+    await batch_client.consume(settings.batch_queue)
+    dead_letter_client = RabbitMQClient(settings.url, handler=dead_letter, consumers=1,
+                                        prefetch_count=settings.prefetch_count)
+    await dead_letter_client.consume(settings.dead_letter_queue)
+    expiry_client = RabbitMQClient(settings.url, handler=delete_stream, consumers=1,
+                                   prefetch_count=settings.prefetch_count)
+    await expiry_client.consume(settings.stream_expired_queue)
+    cancel_channel = await client.connection.channel()
+    cancel_exchange = await cancel_channel.declare_exchange(settings.cancel_exchange, ExchangeType.FANOUT,
+                                                            durable=True)
+    cancel_queue = await cancel_channel.declare_queue(exclusive=True)
+    await cancel_queue.bind(cancel_exchange)
+    await cancel_queue.consume(cancel_job)
+    start_clients()
+    ollama_scheduler.start()
+    transcripts.start()
+    start_http_server(settings.metrics_port)
+    sampler = asyncio.create_task(sample_queue_depth(await client.connection.channel()))
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    try:
+        await stop.wait()
+        # No new jobs are taken, the running ones finish and publish their result.
+        drained = await asyncio.gather(client.drain(server_settings.graceful_timeout),
+                                       batch_client.drain(server_settings.graceful_timeout),
+                                       dead_letter_client.drain(server_settings.graceful_timeout),
+                                       expiry_client.drain(server_settings.graceful_timeout))
+        if not all(drained):
+            # Their messages are redelivered once the connection closes, and claimed again, see run_job.
+            print(f"Jobs still running after {server_settings.graceful_timeout}s, "
+                  "they are requeued and run again from the start")
+    finally:
+        sampler.cancel()
+        await ollama_scheduler.stop()
+        await transcripts.stop()
+        await stop_clients()
+        image_processor.shutdown()
+        await expiry_client.close()
+        await dead_letter_client.close()
+        await batch_client.close()
+        await client.close()
+        await dispose_engine()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,178 @@
+"""
+Multi-process server of the API.
+
+Binds the port once and runs SERVER_WORKERS API processes on it, each one a
+uvicorn server with its own event loop, backend clients, database pool and AMQP
+connection, optionally pinned to its own CPU. The processes are spawned rather
+than forked, so that they import the application themselves and share nothing
+with the supervisor. A process that dies is replaced.
+
+On SIGTERM or SIGINT, every process stops accepting connections, lets its
+in-flight requests and streams finish for up to SERVER_GRACEFUL_TIMEOUT seconds,
+then runs the shutdown of the lifespan, which closes its connections. Run with:
+
+    SERVER_WORKERS=4 SERVER_CPU_AFFINITY=true python -m server
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+from multiprocessing.context import SpawnProcess
+from typing import List
+
+import uvicorn
+
+from core.settings import ServerSettings, load_settings
+
+settings: ServerSettings = load_settings("ServerSettings")
+
+logger = logging.getLogger("uvicorn.error")
+
+# Seconds the supervisor waits, past the graceful timeout, for a process to exit.
+EXIT_GRACE = 5
+
+
+def available_cpus() -> List[int]:
+    """
+    Get the CPUs this process may run on, e.g. the ones of its container.
+
+    Returns:
+        list: The CPU numbers.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def config() -> uvicorn.Config:
+    return uvicorn.Config("main:app", host=settings.host, port=settings.port, log_level=settings.log_level,
+                          timeout_graceful_shutdown=settings.graceful_timeout)
+
+
+def serve(sock: socket.socket, cpu: int | None) -> None:
+    """
+    Run an API process on the shared socket.
+
+    Args:
+        sock (socket.socket): The listening socket.
+        cpu (int): CPU the process is pinned to, None to leave it unpinned.
+    """
+    # Out of the process group of the supervisor, so that a Ctrl+C only reaches
+    # the supervisor: a second signal would make uvicorn skip the graceful shutdown.
+    os.setpgid(0, 0)
+    if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+    uvicorn.Server(config()).run(sockets=[sock])
+
+
+class Supervisor:
+    def __init__(self, workers: int, cpus: List[int] | None = None):
+        """
+        Initialize the supervisor of the API processes.
+
+        Args:
+            workers (int): Number of API processes.
+            cpus (list): CPUs the processes are pinned to, one each in turn, None to leave them unpinned.
+        """
+        self.workers = workers
+        self.cpus = cpus
+        self.context = multiprocessing.get_context("spawn")
+        self.processes: List[SpawnProcess] = []
+        self.should_exit = threading.Event()
+
+    def spawn(self, sock: socket.socket, index: int) -> SpawnProcess:
+        cpu = self.cpus[index % len(self.cpus)] if self.cpus else None
+        process = self.context.Process(target=serve, args=(sock, cpu), name=f"api-{index}")
+        process.start()
+        logger.info("Started API process %s [%d]%s", index, process.pid, f" on CPU {cpu}" if cpu is not None else "")
+        return process
+
+    def handle_exit(self, signum: int, frame) -> None:
+        self.should_exit.set()
+
+    @staticmethod
+    async def create_tables() -> None:
+        from database.session import dispose_engine, init_db
+
+        await init_db()
+        await dispose_engine()
+
+    def run(self) -> None:
+        """
+        Run the API processes until SIGTERM or SIGINT, then stop them gracefully.
+        """
+        multiprocess_dir = None
+        if self.workers > 1 and "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+            # The metrics of the processes are aggregated from their files, see core.metrics.
+            multiprocess_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="prometheus-")
+        # The rate limits are kept per process, each one enforces its share, see depends.llm_admission.
+        os.environ["ADMISSION_PROCESSES"] = str(self.workers)
+        signal.signal(signal.SIGTERM, self.handle_exit)
+        signal.signal(signal.SIGINT, self.handle_exit)
+
+        # Once, rather than by every process at once, which may race on the catalog.
+        asyncio.run(self.create_tables())
+        sock = config().bind_socket()
+        try:
+            self.processes = [self.spawn(sock, index) for index in range(self.workers)]
+            while not self.should_exit.wait(0.5):
+                for index, process in enumerate(self.processes):
+                    if not process.is_alive():
+                        logger.warning("API process %s [%d] exited with %s, restarting it", index, process.pid,
+                                       process.exitcode)
+                        self.mark_dead(process)
+                        self.processes[index] = self.spawn(sock, index)
+            # New connections are refused once every process closed its copy too.
+            sock.close()
+            self.stop()
+        finally:
+            sock.close()
+            if multiprocess_dir:
+                shutil.rmtree(multiprocess_dir, ignore_errors=True)
+
+    def stop(self) -> None:
+        """
+        Ask every process to stop, and kill the ones still running once the
+        graceful timeout is over.
+        """
+        logger.info("Stopping %d API processes", len(self.processes))
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join(settings.graceful_timeout + EXIT_GRACE)
+            if process.is_alive():
+                logger.warning("API process [%d] did not exit in time, killing it", process.pid)
+                process.kill()
+                process.join()
+            self.mark_dead(process)
+
+    @staticmethod
+    def mark_dead(process: SpawnProcess) -> None:
+        if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+            from prometheus_client import multiprocess
+
+            multiprocess.mark_process_dead(process.pid)
+
+
+def main() -> None:
+    logging.basicConfig(level=settings.log_level.upper(), format="%(levelname)s:     %(message)s")
+    cpus = available_cpus()
+    workers = settings.workers or len(cpus)
+    if workers == 1 and not settings.cpu_affinity:
+        # A single process needs no supervisor.
+        uvicorn.Server(config()).run()
+        return
+    if settings.cpu_affinity and not hasattr(os, "sched_setaffinity"):
+        logger.warning("CPU affinity is not supported on this platform, the processes are not pinned")
+    Supervisor(workers, cpus if settings.cpu_affinity and hasattr(os, "sched_setaffinity") else None).run()
+
+
+if __name__ == "__main__":
+    main()